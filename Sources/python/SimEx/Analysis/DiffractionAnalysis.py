@@ -23,13 +23,16 @@
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt, mpl
 from matplotlib.colors import Normalize
 
+import collections
 import h5py
+import hashlib
 import math
 import numpy
 import os
 import tempfile
 
 import pyFAI
+import scipy.sparse
 
 class DiffractionAnalysis(AbstractAnalysis):
     """
@@ -40,7 +43,8 @@ class DiffractionAnalysis(AbstractAnalysis):
                  input_path=None,
                  pattern_indices=None,
                  poissonize=True,
-                 mask=None
+                 mask=None,
+                 geometry_cache_path=None,
             ):
         """
 
@@ -60,6 +64,9 @@ class DiffractionAnalysis(AbstractAnalysis):
         :param mask: Mask to multiply on each pattern.
         :type mask: numpy.array
 
+        :param geometry_cache_path: Directory in which to keep q map and solid angles of the detector geometry across sessions (default None, i.e. only cache in memory). The memory cache holds the most recently used geometries, see clearGeometryCache().
+        :type geometry_cache_path: str
+
         """
 
         # Initialize base class. This takes care of parameter checking.
@@ -74,6 +81,7 @@ class DiffractionAnalysis(AbstractAnalysis):
         self.parameters = diffractionParameters(self.input_path)
 
         self.mask = mask
+        self.__geometry_cache_path = geometry_cache_path
 
     @property
     def parameters(self):
@@ -144,57 +152,17 @@ class DiffractionAnalysis(AbstractAnalysis):
     def solid_angles(self):
         """ Solid angle of each pixel """
         """ Note: the pixel is assumed to be square """
+        """ Note: the returned array is shared by all analyses of the same geometry and is read-only. """
 
-        # pixel number (py, px)
-        pn = self.parameters['geom']['mask'].shape
-        # initialize array
-        solidAngles = numpy.zeros_like(pn)
-        y, x = numpy.indices(pn)
-        # pixel size (meter)
-        ph = self.parameters['geom']['pixelHeight']
-        pw = self.parameters['geom']['pixelWidth']
-        # sample to detector distance (meter)
-        s2d = self.parameters['geom']['detectorDist']
-
-        center_x = 0.5*(pn[1]-1)
-        center_y = 0.5*(pn[0]-1)
-        rx = (x - center_x)*pw
-        ry = (y - center_y)*ph
-        r = numpy.sqrt(rx**2 + ry**2)
-        pixDist = numpy.sqrt(r**2 + s2d**2)
-        alpha = numpy.arctan2(pw,2*pixDist)
-        solidAngles = 4*numpy.arcsin(numpy.sin(alpha)**2)
-
-        return solidAngles
+        return _cachedGeometryArray('solid_angles', self.parameters, _solidAngles, self.__geometry_cache_path)
 
     @property
     def q_map(self):
         """ q of each pixel """
         """ q = 4*pi*sin(twotheta/2)/lmd """
+        """ Note: the returned array is shared by all analyses of the same geometry and is read-only. """
 
-        # pixel number (py, px)
-        pn = self.parameters['geom']['mask'].shape
-        # initialize array
-        qMap = numpy.zeros_like(pn)
-        y, x = numpy.indices(pn)
-        # pixel size (meter)
-        ph = self.parameters['geom']['pixelHeight']
-        pw = self.parameters['geom']['pixelWidth']
-        # sample to detector distance (meter)
-        s2d = self.parameters['geom']['detectorDist']
-
-        E0 = self.parameters['beam']['photonEnergy']
-        lmd = 12398 / E0 #Angstrom
-
-        center_x = 0.5*(pn[1]-1)
-        center_y = 0.5*(pn[0]-1)
-        rx = (x - center_x)*pw
-        ry = (y - center_y)*ph
-        r = numpy.sqrt(rx**2 + ry**2)
-        twotheta = numpy.arctan2(r,s2d)
-        qMap = 4*numpy.pi*numpy.sin(twotheta/2)/lmd
-
-        return qMap
+        return _cachedGeometryArray('q_map', self.parameters, _qMap, self.__geometry_cache_path)
 
     @property
     def mask(self):
@@ -244,6 +212,11 @@ class DiffractionAnalysis(AbstractAnalysis):
 
             # Open file for reading
             with h5py.File(path, 'r') as h5:
+                if _isConsolidated(h5):
+                    for h5_file, path_to_data, row in self._patternSources():
+                        yield h5[path_to_data][row]*self.mask
+                    return
+
                 if indices is None or indices == 'all':
                     indices = [key for key in h5['data'].keys()]
                 else:
@@ -259,7 +232,150 @@ class DiffractionAnalysis(AbstractAnalysis):
 
                     yield diffr*self.mask
 
+    def patternBlockGenerator(self, block_size=64):
+        """ Yield the selected patterns in blocks of consecutive patterns.
+
+        :param block_size: Maximum number of patterns per block (default 64).
+        :type block_size: int
+
+        :return: Iterator over 3D numpy.arrays of shape (number of patterns in block, ny, nx).
+        :note: The yielded array is a view on a buffer that is reused for the next block. Copy it if it is needed after the next iteration.
+
+        """
+        if not (isinstance(block_size, int) and block_size > 0):
+            raise TypeError('The parameter "block_size" must be a positive int.')
 
+        # The mask is only applied to v0.2 files and only unreadable legacy files are skipped, as in patternGenerator().
+        is_legacy = os.path.isdir(self.input_path)
+        if is_legacy:
+            mask = None
+        else:
+            mask = self.mask
+
+        buffer = None
+        number_in_block = 0
+        h5 = None
+        h5_path = None
+        try:
+            for h5_file, path_to_data, row in self._patternSources():
+                # Consecutive patterns from the same file share the file handle.
+                if h5_file != h5_path:
+                    if h5 is not None:
+                        h5.close()
+                    h5_path = h5_file
+                    h5 = None
+                    try:
+                        h5 = h5py.File(h5_file, 'r')
+                    except (IOError, OSError):
+                        if not is_legacy:
+                            raise
+                if is_legacy and (h5 is None or path_to_data not in h5):
+                    continue
+
+                dataset = h5[path_to_data]
+                if row is None:
+                    source_selection = None
+                    shape = dataset.shape
+                else:
+                    source_selection = numpy.s_[row]
+                    shape = dataset.shape[1:]
+                if buffer is None:
+                    dtype = dataset.dtype
+                    if mask is not None:
+                        dtype = numpy.result_type(dtype, numpy.asarray(mask).dtype)
+                    buffer = numpy.empty((block_size,) + shape, dtype=dtype)
+
+                dataset.read_direct(buffer, source_sel=source_selection, dest_sel=numpy.s_[number_in_block])
+                number_in_block += 1
+
+                if number_in_block == block_size:
+                    if mask is not None:
+                        buffer *= mask
+                    yield buffer
+                    number_in_block = 0
+
+            if number_in_block > 0:
+                block = buffer[:number_in_block]
+                if mask is not None:
+                    block *= mask
+                yield block
+
+        finally:
+            if h5 is not None:
+                h5.close()
+
+    def _patternSources(self):
+        """ """
+        """ Get file, dataset path and row of each selected pattern.
+
+        :return: List of (file name, path to dataset, row) tuples. Row is None unless all patterns are stored in one dataset.
+        """
+        indices = self.pattern_indices
+        path = self.input_path
+        if self.poissonize:
+            data_name = 'data'
+        else:
+            data_name = 'diffr'
+
+        if os.path.isdir(path): # legacy format.
+            dir_listing = os.listdir(path)
+            dir_listing.sort()
+            if indices != 'all':
+                selected = set(indices)
+                dir_listing = [d for (i,d) in enumerate(dir_listing) if i in selected]
+            return [(os.path.join(path, f), '/data/' + data_name, None) for f in dir_listing if f.split('.')[-1] == "h5"]
+
+        # v0.2
+        with h5py.File(path, 'r') as h5:
+            # All patterns in one dataset, rows are looked up by pattern id.
+            if _isConsolidated(h5):
+                pattern_ids = h5['data/pattern_id'][()]
+                if indices is None or indices == 'all':
+                    rows = list(range(len(pattern_ids)))
+                else:
+                    row_of_id = dict((pattern_id, row) for (row, pattern_id) in enumerate(pattern_ids))
+                    rows = [row_of_id[ix] for ix in indices]
+                return [(path, '/data/' + data_name, row) for row in rows]
+
+            if indices is None or indices == 'all':
+                keys = [key for key in h5['data'].keys()]
+            else:
+                keys = ["%0.7d" % ix for ix in indices]
+
+        return [(path, '/data/%s/%s' % (key, data_name), None) for key in keys]
+
+    def _patternStack(self):
+        """ """
+        """ Read all selected patterns into one 3D numpy.array. """
+        sources = self._patternSources()
+        stack = None
+        number_of_patterns = 0
+        for block in self.patternBlockGenerator():
+            if stack is None:
+                stack = numpy.empty((len(sources),) + block.shape[1:], dtype=block.dtype)
+            stack[number_of_patterns:number_of_patterns+len(block)] = block
+            number_of_patterns += len(block)
+
+        if stack is None:
+            return numpy.array([])
+
+        return stack[:number_of_patterns]
+
+    def _reducePatterns(self, operation):
+        """ """
+        """ Apply the operation along the pattern axis of all selected patterns.
+
+        Sums, means, standard deviations, variances, minima and maxima are computed block by block in constant memory, other operations are applied to the full stack of patterns.
+
+        :param operation: The operation to apply.
+        :type operation: python function
+
+        :return: The reduced 2D pattern.
+        """
+        if operation in STREAMING_OPERATIONS:
+            return streamingReduction(self.patternBlockGenerator(), operation)
+
+        return operation(self._patternStack(), axis=0)
 
     def numpyPattern(self, operation=None):
         """ Return the pattern after opentation over the patterns defined in DiffractionAnalysis class.
@@ -276,7 +392,7 @@ class DiffractionAnalysis(AbstractAnalysis):
             if len(self.pattern_indices) == 1:
                 pattern_to_dump = next(pi)
             else:
-                pattern_to_dump = numpy.array([p for p in pi])
+                pattern_to_dump = self._patternStack()
 
         # Handle operation
         else:
@@ -286,7 +402,7 @@ class DiffractionAnalysis(AbstractAnalysis):
             if len(self.pattern_indices) == 1:
                 pattern_to_dump = next(pi)
             else:
-                pattern_to_dump = operation(numpy.array([p for p in pi]), axis=0)
+                pattern_to_dump = self._reducePatterns(operation)
 
         return pattern_to_dump
 
@@ -314,11 +430,56 @@ class DiffractionAnalysis(AbstractAnalysis):
         if len(self.pattern_indices) == 1:
             pattern_to_plot = next(pi)
         else:
-            pattern_to_plot = operation(numpy.array([p for p in pi]), axis=0)
+            pattern_to_plot = self._reducePatterns(operation)
 
         # Plot radial projection.
         plotRadialProjection(pattern_to_plot, self.__parameters, logscale,offset,unit)
 
+    def radialProfiles(self, unit="q_nm^-1", npt=None, block_size=64, output_path=None):
+        """ Compute the radial profile of each selected pattern.
+
+        The patterns are read in blocks and binned by one sparse matrix product per block.
+
+        :param unit: Unit of the radial coordinate, can be "q_nm^-1", "q_A^-1", "2th_deg", "2th_rad", "r_mm" (default "q_nm^-1").
+        :type unit: str
+
+        :param npt: Number of radial bins (default None, i.e. as in azimuthalIntegration()).
+        :type npt: int
+
+        :param block_size: Number of patterns to read at once (default 64).
+        :type block_size: int
+
+        :param output_path: HDF5 file to write the profiles to, e.g. the input file (default None, i.e. do not write).
+        :type output_path: str
+
+        :return: The radial bin centers and the profiles as numpy.array of shape (number of patterns, npt).
+        :note: The profiles differ from those of azimuthalIntegration(): pixels are not split between bins, the bins span the range of the pixel centers, and each bin is normalized by its total solid angle.
+
+        """
+        if npt is None:
+            npt = min(self.__parameters['geom']['mask'].shape[0], 1024)
+
+        positions, bin_matrix = _radialBinMatrix(self.__parameters, npt, unit)
+
+        profiles = numpy.empty((len(self._patternSources()), npt))
+        number_of_patterns = 0
+        for block in self.patternBlockGenerator(block_size):
+            number_in_block = len(block)
+            profiles[number_of_patterns:number_of_patterns+number_in_block] = bin_matrix.T.dot(block.reshape(number_in_block, -1).T).T
+            number_of_patterns += number_in_block
+        profiles = profiles[:number_of_patterns]
+
+        if output_path is not None:
+            with h5py.File(output_path, 'a') as h5:
+                if 'radial_profiles' in h5:
+                    del h5['radial_profiles']
+                group = h5.create_group('radial_profiles')
+                group.attrs['unit'] = str(unit)
+                group.create_dataset('positions', data=positions)
+                group.create_dataset('intensities', data=profiles, chunks=(min(block_size, max(number_of_patterns, 1)), npt))
+
+        return positions, profiles
+
     def plotPatterns(self, logscale=False, offset=1e-1, symlog=False, *argv, **kwargs):
         """ Plot patterns in the class.
 
@@ -381,7 +542,7 @@ class DiffractionAnalysis(AbstractAnalysis):
         if len(self.pattern_indices) == 1:
             pattern_to_plot = next(pi)
         else:
-            pattern_to_plot = operation(numpy.array([p for p in pi]), axis=0)
+            pattern_to_plot = self._reducePatterns(operation)
 
         # Plot image and colorbar.
         pattern_to_plot = numpy.squeeze(pattern_to_plot)
@@ -426,24 +587,24 @@ class DiffractionAnalysis(AbstractAnalysis):
         # Pixel numbers corresponding to resolution rings.
         N = Ddet/apix * numpy.tan(numpy.arcsin(lmd/2./ds)*2)
 
-        pi = self.patterns_iterator
-        stack = numpy.array([p for p in pi])
+        photons = []
+        for block in self.patternBlockGenerator():
+            if len(photons) == 0:
+                y, x = numpy.indices(block[0].shape)
+                r = numpy.sqrt((x-center)**2 + (y-center)**2)
+                mask = (abs(r-N) <= 0.5)
 
-        y, x = numpy.indices(stack[0].shape)
-        r = numpy.sqrt((x-center)**2 + (y-center)**2)
-        mask = (abs(r-N) <= 0.5)
+                plt.figure()
+                plt.imshow(block[0]*mask)
+                plt.title('Frame 0')
 
-        for i in range(len(stack)):
-            stack[i] *= mask
+                a = mask[mask==True]
+                nShannonPixel = len(a)
 
-        plt.figure()
-        plt.imshow(stack[0])
-        plt.title('Frame 0')
+            photons.append(numpy.sum(block*mask, axis=(1,2)))
 
-        a = mask[mask==True]
-        nShannonPixel = len(a)
         # Mean number of expected photons per Shannon pixel
-        photons = numpy.sum(stack,axis=(1,2))/nShannonPixel
+        photons = numpy.concatenate(photons)/nShannonPixel
         avg_photons = numpy.mean(photons)
         rms_photons = numpy.std(photons)
 
@@ -457,10 +618,21 @@ class DiffractionAnalysis(AbstractAnalysis):
     def statistics(self):
         """ Get statistics of photon numbers per pattern (mean and rms) over selected patterns and plot a historgram. """
 
-        pi = self.patterns_iterator
-        stack = numpy.array([p for p in pi])
-
-        photonStatistics(stack)
+        photons = []
+        meanPerPattern = []
+        maxPerPattern = []
+        minPerPattern = []
+        for block in self.patternBlockGenerator():
+            photons.append(numpy.sum(block, axis=(1,2)))
+            meanPerPattern.append(numpy.mean(block, axis=(1,2)))
+            maxPerPattern.append(numpy.max(block, axis=(1,2)))
+            minPerPattern.append(numpy.min(block, axis=(1,2)))
+
+        _photonStatistics(numpy.concatenate(photons),
+                          numpy.concatenate(meanPerPattern),
+                          numpy.concatenate(maxPerPattern),
+                          numpy.concatenate(minPerPattern),
+                          )
 
     def animatePatterns(self, output_path=None, logscale=False, offset=1e-1):
         """
@@ -494,23 +666,22 @@ class DiffractionAnalysis(AbstractAnalysis):
 
         # Make tempdir.
         tmp_out_dir = tempfile.mkdtemp()
-        stack = numpy.array([p for p in self.patternGenerator()])
-
-        mn, mx = stack.min(), stack.max()
-        x_range, y_range = stack.shape[1:]
-        for i,img in enumerate(stack):
-            plotImage(img, logscale=logscale, offset=offset)
-
-            # Save image.
-            if self.pattern_indices != "all":
-                png_filename = "%07d.png" % (self.pattern_indices[i])
-            else:
-                png_filename = "%07d.png" % (i)
+        i = 0
+        for block in self.patternBlockGenerator():
+            for img in block:
+                plotImage(img, logscale=logscale, offset=offset)
+
+                # Save image.
+                if self.pattern_indices != "all":
+                    png_filename = "%07d.png" % (self.pattern_indices[i])
+                else:
+                    png_filename = "%07d.png" % (i)
 
-            plt.savefig(os.path.join(tmp_out_dir, png_filename) )
+                plt.savefig(os.path.join(tmp_out_dir, png_filename) )
 
-            # Clear figure.
-            plt.clf()
+                # Clear figure.
+                plt.clf()
+                i += 1
 
         # Render the animated gif.
         os.system("convert -delay 100 %s %s" %(os.path.join(tmp_out_dir, "*.png"), output_path) )
@@ -545,6 +716,108 @@ def plotRadialProjection(pattern, parameters, logscale=True, offset=1.e-5, unit=
 
 def azimuthalIntegration(pattern, parameters, unit="q_nm^-1" ):
 
+    # Number of pixels in each dimension
+    Npix = parameters['geom']['mask'].shape[0]
+
+    azimuthal_integrator = _azimuthalIntegrator(parameters)
+
+    qs, intensities = azimuthal_integrator.integrate1d(
+            pattern,
+            min(Npix,1024),
+            unit=unit
+            #unit="q_nm^-1",
+            #unit="2th_deg",
+            )
+
+    return qs, intensities
+
+# Geometry derived arrays and integrators, keyed by name, geometry and photon energy, least recently used first.
+_geometry_cache = collections.OrderedDict()
+# Maximum number of entries in the geometry cache, i.e. a few geometries.
+_GEOMETRY_CACHE_SIZE = 8
+
+def clearGeometryCache():
+    """ Remove all geometry derived arrays and integrators from the memory cache. Arrays kept on disk are not removed. """
+    _geometry_cache.clear()
+
+def _geometryCacheGet(key):
+    """ """
+    """ Get an entry of the geometry cache and mark it as most recently used, None if the key is not cached. """
+    if key not in _geometry_cache:
+        return None
+    _geometry_cache.move_to_end(key)
+
+    return _geometry_cache[key]
+
+def _geometryCachePut(key, value):
+    """ """
+    """ Store an entry in the geometry cache, removing the least recently used entries beyond the cache size. """
+    _geometry_cache[key] = value
+    _geometry_cache.move_to_end(key)
+    while len(_geometry_cache) > _GEOMETRY_CACHE_SIZE:
+        _geometry_cache.popitem(last=False)
+
+def _geometryKey(parameters):
+    """ """
+    """ Key identifying the detector geometry and photon energy in the given parameters. """
+    geom = parameters['geom']
+    beam = parameters['beam']
+
+    return (tuple(geom['mask'].shape),
+            float(geom['pixelWidth']),
+            float(geom['pixelHeight']),
+            float(geom['detectorDist']),
+            float(beam['photonEnergy']),
+            )
+
+def _cachedGeometryArray(name, parameters, function, cache_path=None):
+    """ """
+    """ Get a geometry derived array from the memory cache, the disk cache, or by computing it.
+
+    :param name: Name of the array.
+    :type name: str
+
+    :param parameters: The beam and geometry parameters.
+    :type parameters: dict
+
+    :param function: Function computing the array from the parameters.
+    :type function: python function
+
+    :param cache_path: Directory of the disk cache (default None, i.e. no disk cache).
+    :type cache_path: str
+
+    :return: The read-only array.
+    """
+    key = (name,) + _geometryKey(parameters)
+    cached = _geometryCacheGet(key)
+    if cached is not None:
+        return cached
+
+    array = None
+    if cache_path is not None:
+        cache_file = os.path.join(cache_path, "%s_%s.npy" % (name, hashlib.sha1(repr(key).encode('utf-8')).hexdigest()))
+        if os.path.isfile(cache_file):
+            array = numpy.load(cache_file)
+
+    if array is None:
+        array = function(parameters)
+        if cache_path is not None:
+            os.makedirs(cache_path, exist_ok=True)
+            numpy.save(cache_file, array)
+
+    array.flags.writeable = False
+    _geometryCachePut(key, array)
+
+    return array
+
+def _azimuthalIntegrator(parameters):
+    """ """
+    """ Get the pyFAI integrator for the given geometry. The integrator is reused so its lookup tables are only built once. """
+    key = ('integrator',) + _geometryKey(parameters)
+    cached = _geometryCacheGet(key)
+    if cached is not None:
+        return cached
+
     # Extract parameters.
     beam = parameters['beam']
     geom = parameters['geom']
@@ -579,15 +852,90 @@ def azimuthalIntegration(pattern, parameters, unit="q_nm^-1" ):
             pixelX=apix*1e6,
             pixelY=apix*1e6,
             )
-    qs, intensities = azimuthal_integrator.integrate1d(
-            pattern,
-            min(Npix,1024),
-            unit=unit
-            #unit="q_nm^-1",
-            #unit="2th_deg",
-            )
 
-    return qs, intensities
+    _geometryCachePut(key, azimuthal_integrator)
+
+    return azimuthal_integrator
+
+def _radialBinMatrix(parameters, npt, unit):
+    """ """
+    """ Get the bin centers and the sparse (number of pixels, npt) matrix mapping a flattened pattern onto its solid angle corrected radial profile. """
+    key = ('radial_bins', npt, str(unit)) + _geometryKey(parameters)
+    cached = _geometryCacheGet(key)
+    if cached is not None:
+        return cached
+
+    azimuthal_integrator = _azimuthalIntegrator(parameters)
+    shape = parameters['geom']['mask'].shape
+
+    radial = azimuthal_integrator.array_from_unit(shape, "center", unit, scale=True).ravel()
+    solid_angle = azimuthal_integrator.solidAngleArray(shape).ravel()
+
+    edges = numpy.linspace(radial.min(), radial.max(), npt+1)
+    bins = numpy.clip(numpy.searchsorted(edges, radial, side='right') - 1, 0, npt-1)
+
+    # Normalize each bin by its total solid angle.
+    norm = numpy.bincount(bins, weights=solid_angle, minlength=npt)
+    weights = numpy.zeros_like(radial, dtype=numpy.float64)
+    filled = norm[bins] > 0
+    weights[filled] = 1.0 / norm[bins][filled]
+
+    bin_matrix = scipy.sparse.csr_matrix((weights, (numpy.arange(radial.size), bins)), shape=(radial.size, npt))
+    positions = 0.5*(edges[1:] + edges[:-1])
+
+    _geometryCachePut(key, (positions, bin_matrix))
+
+    return positions, bin_matrix
+
+def _solidAngles(parameters):
+    """ """
+    """ Compute the solid angle of each pixel. """
+
+    # pixel number (py, px)
+    pn = parameters['geom']['mask'].shape
+    y, x = numpy.indices(pn)
+    # pixel size (meter)
+    ph = parameters['geom']['pixelHeight']
+    pw = parameters['geom']['pixelWidth']
+    # sample to detector distance (meter)
+    s2d = parameters['geom']['detectorDist']
+
+    center_x = 0.5*(pn[1]-1)
+    center_y = 0.5*(pn[0]-1)
+    rx = (x - center_x)*pw
+    ry = (y - center_y)*ph
+    r = numpy.sqrt(rx**2 + ry**2)
+    pixDist = numpy.sqrt(r**2 + s2d**2)
+    alpha = numpy.arctan2(pw,2*pixDist)
+    solidAngles = 4*numpy.arcsin(numpy.sin(alpha)**2)
+
+    return solidAngles
+
+def _qMap(parameters):
+    """ """
+    """ Compute q of each pixel. """
+
+    # pixel number (py, px)
+    pn = parameters['geom']['mask'].shape
+    y, x = numpy.indices(pn)
+    # pixel size (meter)
+    ph = parameters['geom']['pixelHeight']
+    pw = parameters['geom']['pixelWidth']
+    # sample to detector distance (meter)
+    s2d = parameters['geom']['detectorDist']
+
+    E0 = parameters['beam']['photonEnergy']
+    lmd = 12398 / E0 #Angstrom
+
+    center_x = 0.5*(pn[1]-1)
+    center_y = 0.5*(pn[0]-1)
+    rx = (x - center_x)*pw
+    ry = (y - center_y)*ph
+    r = numpy.sqrt(rx**2 + ry**2)
+    twotheta = numpy.arctan2(r,s2d)
+    qMap = 4*numpy.pi*numpy.sin(twotheta/2)/lmd
+
+    return qMap
 
 def diffractionParameters(path):
     """ Extract beam parameters and geometry from given file or directory.
@@ -742,20 +1090,27 @@ def plotResolutionRings(parameters,rings=(10, 5.0, 3.5),half=True):
 def photonStatistics(stack):
     """ """
 
-    number_of_images = stack.shape[0]
     photons = numpy.sum(stack, axis=(1,2))
+    meanPerPattern = numpy.mean(stack, axis=(1,2))
+    maxPerPattern = numpy.max(stack, axis=(1,2))
+    minPerPattern = numpy.min(stack, axis=(1,2))
+
+    _photonStatistics(photons, meanPerPattern, maxPerPattern, minPerPattern)
+
+def _photonStatistics(photons, meanPerPattern, maxPerPattern, minPerPattern):
+    """ """
+    """ Print and plot photon statistics from per-pattern photon numbers and per-pattern mean, max, and min pixel values. """
+
+    number_of_images = photons.shape[0]
     avg_photons = numpy.mean(photons)
     rms_photons =  numpy.std(photons)
 
-    meanPerPattern = numpy.mean(stack, axis=(1,2))
     # average over the mean nphotons of each pattern in the stack
     avg_mean = numpy.mean(meanPerPattern)
 
-    maxPerPattern = numpy.max(stack, axis=(1,2))
     # average over the max nphotons of each pattern in the stack
     avg_max = numpy.mean(maxPerPattern)
 
-    minPerPattern = numpy.min(stack, axis=(1,2))
     # average over the min nphotons of each pattern in the stack
     avg_min = numpy.mean(minPerPattern)
 
@@ -789,8 +1144,82 @@ def photonStatistics(stack):
     plt.title("Photon number histogram")
 
 
+# Operations that streamingReduction() can compute block by block.
+STREAMING_OPERATIONS = [numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min, numpy.amin, numpy.max, numpy.amax]
+
+def streamingReduction(blocks, operation):
+    """ Reduce a sequence of pattern blocks along the pattern axis in constant memory.
+
+    :param blocks: Iterable over 3D numpy.arrays of shape (number of patterns in block, ny, nx).
+    :type blocks: iterable
+
+    :param operation: The reduction, one of numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min, numpy.max.
+    :type operation: python function
+
+    :return: The reduced 2D numpy.array, equivalent to operation(stack, axis=0) on the stack of all blocks.
+    """
+
+    if operation not in STREAMING_OPERATIONS:
+        raise ValueError("Operation %s cannot be computed by streaming reduction." % (operation))
+
+    result = None
+    count = 0
+    # Running mean and sum of squared deviations (Welford/Chan update) for mean, var, std.
+    mean = None
+    m2 = None
+    for block in blocks:
+        block_count = block.shape[0]
+        if block_count == 0:
+            continue
+
+        if operation is numpy.sum:
+            block_sum = numpy.sum(block, axis=0)
+            result = block_sum if result is None else result + block_sum
+
+        elif operation in (numpy.min, numpy.amin):
+            block_min = numpy.min(block, axis=0)
+            result = block_min if result is None else numpy.minimum(result, block_min)
+
+        elif operation in (numpy.max, numpy.amax):
+            block_max = numpy.max(block, axis=0)
+            result = block_max if result is None else numpy.maximum(result, block_max)
+
+        else:
+            block_mean = numpy.mean(block, axis=0)
+            block_m2 = numpy.sum((block - block_mean)**2, axis=0)
+            if mean is None:
+                mean = block_mean
+                m2 = block_m2
+            else:
+                total = count + block_count
+                delta = block_mean - mean
+                mean = mean + delta * (block_count / total)
+                m2 = m2 + block_m2 + delta**2 * (count * block_count / total)
+
+        count += block_count
+
+    if count == 0:
+        raise ValueError("No patterns to reduce.")
+
+    if operation is numpy.mean:
+        return mean
+    if operation is numpy.var:
+        return m2 / count
+    if operation is numpy.std:
+        return numpy.sqrt(m2 / count)
+
+    return result
+
 def totalNPattern(input_path):
     """ get the number of the diffraction patterns in the h5file"""
     with h5py.File(input_path, 'r') as h5:
-        npattern = len(h5['data'])
+        if _isConsolidated(h5):
+            npattern = len(h5['data/pattern_id'])
+        else:
+            npattern = len(h5['data'])
     return npattern
+
+def _isConsolidated(h5):
+    """ """
+    """ Whether all patterns in the open file are stored in one dataset '/data/data'. """
+    return isinstance(h5.get('data/data'), h5py.Dataset) and 'data/pattern_id' in h5
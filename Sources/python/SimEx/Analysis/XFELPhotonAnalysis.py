@@ -23,24 +23,51 @@
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt, mpl
 
 import os,shutil
+import collections
 import copy
+import h5py
 import numpy
 import wpg
 
+# Mesh parameters needed for the power and fluence analyses.
+_MeshParameters = collections.namedtuple("_MeshParameters",
+        ["nx", "ny", "nSlices", "xMin", "xMax", "yMin", "yMax", "sliceMin", "sliceMax", "wDomain"])
+
+# Time or frequency resolved statistics of the intensity.
+_IntensityStatistics = collections.namedtuple("_IntensityStatistics",
+        ["power", "on_axis", "integrated", "mesh"])
+
+# Memory budget for the time slices read at once in lazy mode.
+_SLAB_BYTES = 256 * 1024**2
+
 class XFELPhotonAnalysis(AbstractAnalysis):
     """
     :class XFELPhotonAnalysis: Class that implements common data analysis tasks for wavefront (radiation field) data.
     """
 
-    def __init__(self, input_path=None,):
+    def __init__(self, input_path=None, lazy=False):
         """
         :param input_path: Name of file or directory that contains data to analyse.
         :type input_path: str
+
+        :param lazy: Whether to defer loading the wavefront until it is needed (default False). Total power, on-axis power density and FWHM in the time domain are then computed by streaming over the time slices in the input file.
+        :type lazy: bool
         """
         print("\n Start initialization.")
         # Initialize base class. This takes care of parameter checking.
         super(XFELPhotonAnalysis, self).__init__(input_path)
 
+        # Init intensity.
+        self.__intensity = None
+        self.__wavefront = None
+        self.__statistics = {}
+
+        if not lazy:
+            self.__loadWavefront()
+
+    def __loadWavefront(self):
+        """ """
+        """ Private method to load the wavefront from the input file. """
         # Get wavefront file name.
         wavefront = wpg.Wavefront()
 
@@ -48,31 +75,33 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         wavefront.load_hdf5(self.input_path)
         print(" ... done.")
 
-        # Init intensity.
-        self.__intensity = None
-
         # Init wavefront, triggers assignment of intensity.
         self.wavefront = wavefront
 
-
     @property
     def intensity(self):
         """ Query for the intensity. """
+        if self.__intensity is None and self.__wavefront is None:
+            self.__loadWavefront()
         return self.__intensity
     @intensity.setter
     def intensity(self, val):
         """ Set the intensity. """
         self.__intensity = val
+        self.__statistics = {}
 
 
     @property
     def wavefront(self):
         """ Query for the wavefront. """
+        if self.__wavefront is None:
+            self.__loadWavefront()
         return self.__wavefront
     @wavefront.setter
     def wavefront(self, val):
         """ Query for the wavefront. """
         self.__wavefront = val
+        self.__statistics = {}
 
         # Get intensities and mask nans
         print("\n Getting intensities.")
@@ -130,10 +159,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Setup new figure.
         plt.figure()
 
-        wf = self.wavefront
-        wf_intensity = self.intensity
-
-
         # Switch to q-space if requested.
         if qspace:
             print("\n Switching to reciprocal space.")
@@ -144,15 +169,17 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             wf_intensity = wf.get_intensity()
             nans = mask_nans(wf_intensity)
 
-        # Get average and time slicing.
-        wf_intensity = wf_intensity.sum(axis=-1)
+            # Get average and time slicing.
+            wf_intensity = wf_intensity.sum(axis=-1)
+
+            # Get limits.
+            xmin, xmax, ymax, ymin = wf.get_limits()
 
-        nslices = wf.params.Mesh.nSlices
-        if (nslices>1):
-            dt = (wf.params.Mesh.sliceMax-wf.params.Mesh.sliceMin)/(nslices-1)
-            t0 = dt*nslices/2 + wf.params.Mesh.sliceMin
         else:
-            t0 = (wf.params.Mesh.sliceMax+wf.params.Mesh.sliceMin)/2
+            statistics = self._intensityStatistics()
+            wf_intensity = statistics.integrated
+            mesh = statistics.mesh
+            xmin, xmax, ymax, ymin = mesh.xMin, mesh.xMax, mesh.yMin, mesh.yMax
 
         # Setup a figure.
         figure = plt.figure(figsize=(10, 10), dpi=100)
@@ -160,8 +187,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Profile plot.
         profile = plt.subplot2grid((3, 3), (1, 0), colspan=2, rowspan=2)
 
-        # Get limits.
-        xmin, xmax, ymax, ymin = wf.get_limits()
         mn, mx = wf_intensity.min(), wf_intensity.max()
 
         # Plot profile as 2D colorcoded map.
@@ -205,6 +230,46 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         if qspace:
             del wf
 
+    def _intensityStatistics(self, spectrum=False):
+        """ """
+        """ Private method to query the total power, on-axis power density and time integrated intensity.
+
+        The results are computed once per domain and memoized. In the time domain, they are streamed from the input
+        file if the wavefront is not loaded. The frequency domain requires the loaded wavefront, which is switched to
+        frequency representation once and back.
+
+        :param spectrum: Whether to query the frequency (True) or time (False, default) domain statistics.
+        :type spectrum: bool
+
+        :return: The statistics.
+        :rtype: _IntensityStatistics
+        """
+        domain = 'f' if spectrum else 't'
+        if domain in self.__statistics:
+            return self.__statistics[domain]
+
+        if not spectrum and self.__wavefront is None:
+            print("\n Streaming intensities from %s." % (self.input_path))
+            statistics = _streamIntensityStatistics(self.input_path)
+
+        elif not spectrum:
+            statistics = _intensityStatisticsFromArray(self.intensity, _meshParameters(self.wavefront))
+
+        else:
+            print("\n Switching to frequency domain.")
+            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 'f')
+            intensity = self.wavefront.get_intensity()
+            mask_nans(intensity)
+            statistics = _intensityStatisticsFromArray(intensity, _meshParameters(self.wavefront))
+            del intensity
+
+            # Switch back to time domain, the time domain intensity is unchanged.
+            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
+
+        self.__statistics[domain] = statistics
+
+        return statistics
+
     def numpyTotalPower(self, spectrum=False, all=False):
         """ Method to dump meaningful total power.
 
@@ -217,31 +282,15 @@ class XFELPhotonAnalysis(AbstractAnalysis):
 
         """ Adapted from github:Samoylv/WPG/wpg/wpg_uti_wf.integral_intensity() """
 
-        # Switch to frequency (energy) domain if requested.
-        if spectrum:
-            print("Switching to frequency domain.")
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 'f')
-            self.intensity = self.wavefront.get_intensity()
-        else:
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
+        statistics = self._intensityStatistics(spectrum)
 
         # Get dimensions.
-        mesh = self.wavefront.params.Mesh
-        dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-        dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
-
-        # Get intensity by integrating over transverse dimensions.
-        int0 = self.intensity.sum(axis=(0,1))
+        mesh = statistics.mesh
 
         # Get power
-        int0 = int0*(dx*dy*1.e6)
+        int0 = statistics.power
         int0max = int0.max()
 
-        # Get center pixel numbers.
-        center_nx = int(mesh.nx/2)
-        center_ny = int(mesh.ny/2)
-
         # Get meaningful slices.
         if all:
             aw = numpy.arange(len(int0))
@@ -249,10 +298,9 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             aw = [a[0] for a in numpy.argwhere(int0 > int0max*0.01)]
         int0_mean = int0[min(aw):max(aw)+1]  # meaningful range of pulse
         dSlice = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
-        xs = numpy.arange(mesh.nSlices)*dSlice+ mesh.sliceMin
         xs_mf = numpy.arange(min(aw), max(aw)+1)*dSlice + mesh.sliceMin
 
-        if(self.wavefront.params.wDomain=='time'):
+        if(mesh.wDomain=='time'):
             print('x: Time (fs)')
             print('y: Power (W)')
             dt = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
@@ -263,10 +311,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             print('x: eV')
             print('y: J/eV')
 
-            # Switch back to time domain.
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
-
             return(xs_mf, int0_mean)
 
     def plotTotalPower(self, spectrum=False):
@@ -282,35 +326,22 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Setup new figure.
         plt.figure()
 
-        # Switch to frequency (energy) domain if requested.
-        if spectrum:
-            print("\n Switching to frequency domain.")
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 'f')
-            self.intensity = self.wavefront.get_intensity()
+        statistics = self._intensityStatistics(spectrum)
 
         # Get dimensions.
-        mesh = self.wavefront.params.Mesh
-        dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-        dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
+        mesh = statistics.mesh
 
-        # Get intensity by integrating over transverse dimensions.
-        int0 = self.intensity.sum(axis=(0,1))
-
-        # Scale to get unit W/mm^2
-        int0 = int0*(dx*dy*1.e6) #  amplitude units sqrt(W/mm^2)
+        # Power in W, scaled from unit W/mm^2.
+        int0 = statistics.power
         int0max = int0.max()
 
-        # Get center pixel numbers.
-        center_nx = int(mesh.nx/2)
-        center_ny = int(mesh.ny/2)
-
         # Get meaningful slices.
         aw = [a[0] for a in numpy.argwhere(int0 > int0max*0.01)]
         int0_mean = int0[min(aw):max(aw)+1]  # meaningful range of pulse
         dSlice = (mesh.sliceMax - mesh.sliceMin)/(mesh.nSlices - 1)
         xs = numpy.arange(mesh.nSlices)*dSlice+ mesh.sliceMin
         xs_mf = numpy.arange(min(aw), max(aw)+1)*dSlice + mesh.sliceMin
-        if(self.wavefront.params.wDomain=='time'):
+        if(mesh.wDomain=='time'):
             plt.plot(xs*1e15, int0) # time axis converted to fs.
             plt.plot(xs_mf*1e15, int0_mean, 'ro')
             plt.title('Power')
@@ -326,10 +357,6 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             plt.xlabel('eV')
             plt.ylabel('J/eV')
 
-            # Switch back to time domain.
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
-
     def plotOnAxisPowerDensity(self, spectrum=False):
         """ Method to plot the on-axis power density.
 
@@ -343,26 +370,14 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         # Setup new figure.
         plt.figure()
 
-        # Switch to frequency (energy) domain if requested.
-        if spectrum:
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 'f')
-            self.intensity = self.wavefront.get_intensity()
+        statistics = self._intensityStatistics(spectrum)
 
         # Get dimensions.
-        mesh = self.wavefront.params.Mesh
-        dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
-        dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
-
-        # Get center pixel numbers.
-        center_nx = int(mesh.nx/2)
-        center_ny = int(mesh.ny/2)
-
-        # Get time slices of intensity.
-        intensity = self.intensity
+        mesh = statistics.mesh
 
         # Get on-axis intensity.
-        int0_00 = intensity[center_ny, center_nx, :]
-        int0 = intensity.sum(axis=(0,1))*(dx*dy*1.e6) #  amplitude units sqrt(W/mm^2)
+        int0_00 = statistics.on_axis
+        int0 = statistics.power
         int0max = int0.max()
 
         # Get meaningful slices.
@@ -376,7 +391,7 @@ class XFELPhotonAnalysis(AbstractAnalysis):
         xs_mf = numpy.arange(min(aw), max(aw)+1)*dSlice + mesh.sliceMin
 
         # Plot.
-        if(self.wavefront.params.wDomain=='time'):
+        if(mesh.wDomain=='time'):
             plt.plot(xs*1e15,int0_00)
             plt.plot(xs_mf*1e15, int0_00[min(aw):max(aw)+1], 'ro')
             plt.title('On-Axis Power Density')
@@ -389,9 +404,82 @@ class XFELPhotonAnalysis(AbstractAnalysis):
             plt.xlabel('photon energy (eV)')
             plt.ylabel(r'fluence (J/eV/mm${}^{2}$)')
 
-            # Switch back to time domain.
-            wpg.srwlib.srwl.SetRepresElecField(self.wavefront._srwl_wf, 't')
-            self.intensity = self.wavefront.get_intensity()
+    def fwhm(self):
+        """ Calculate the FWHM of the time integrated beam through the center of the image, see calculate_fwhm().
+
+        :return: {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y} in [m]
+        """
+        statistics = self._intensityStatistics()
+
+        return _fwhm(statistics.integrated, statistics.mesh)
+
+def _meshParameters(wavefront):
+    """ """
+    """ Private (hidden) utility to take a snapshot of the wavefront mesh parameters. """
+    mesh = wavefront.params.Mesh
+
+    return _MeshParameters(nx=mesh.nx, ny=mesh.ny, nSlices=mesh.nSlices,
+                           xMin=mesh.xMin, xMax=mesh.xMax,
+                           yMin=mesh.yMin, yMax=mesh.yMax,
+                           sliceMin=mesh.sliceMin, sliceMax=mesh.sliceMax,
+                           wDomain=wavefront.params.wDomain)
+
+def _intensityStatisticsFromArray(intensity, mesh):
+    """ """
+    """ Private (hidden) utility to compute the intensity statistics from the full intensity array (y, x, slice). """
+    dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
+    dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
+
+    # Get intensity by integrating over transverse dimensions, scaled from W/mm^2 to W.
+    power = intensity.sum(axis=(0,1))*(dx*dy*1.e6)
+    on_axis = intensity[int(mesh.ny/2), int(mesh.nx/2), :]
+
+    return _IntensityStatistics(power=power, on_axis=on_axis, integrated=intensity.sum(axis=-1), mesh=mesh)
+
+def _streamIntensityStatistics(input_path, slab_size=None):
+    """ """
+    """ Private (hidden) utility to compute the time domain intensity statistics from a wpg file.
+
+    The intensity |E_hor|^2 + |E_ver|^2 is computed for slabs of consecutive time slices, so only one slab of the
+    field is held in memory at any time.
+    """
+    with h5py.File(input_path, 'r') as h5:
+        params = h5['params']
+        wDomain = params['wDomain'][()]
+        if isinstance(wDomain, bytes):
+            wDomain = wDomain.decode()
+
+        mesh = _MeshParameters(nx=params['Mesh/nx'][()], ny=params['Mesh/ny'][()], nSlices=params['Mesh/nSlices'][()],
+                               xMin=params['Mesh/xMin'][()], xMax=params['Mesh/xMax'][()],
+                               yMin=params['Mesh/yMin'][()], yMax=params['Mesh/yMax'][()],
+                               sliceMin=params['Mesh/sliceMin'][()], sliceMax=params['Mesh/sliceMax'][()],
+                               wDomain=wDomain)
+
+        ehor = h5['data/arrEhor']
+        ever = h5['data/arrEver']
+        number_of_slices = ehor.shape[2]
+        if slab_size is None:
+            slab_size = max(1, _SLAB_BYTES // (4 * ehor.dtype.itemsize * ehor.shape[0] * ehor.shape[1]))
+
+        power = numpy.empty(number_of_slices)
+        on_axis = numpy.empty(number_of_slices)
+        integrated = numpy.zeros(ehor.shape[:2])
+
+        for slab_start in range(0, number_of_slices, slab_size):
+            slab = slice(slab_start, min(slab_start + slab_size, number_of_slices))
+
+            intensity = numpy.square(ehor[:, :, slab, :], dtype=numpy.float64).sum(axis=-1)
+            intensity += numpy.square(ever[:, :, slab, :], dtype=numpy.float64).sum(axis=-1)
+            numpy.nan_to_num(intensity, copy=False, nan=0.0)
+
+            power[slab] = intensity.sum(axis=(0,1))
+            on_axis[slab] = intensity[int(mesh.ny/2), int(mesh.nx/2), :]
+            integrated += intensity.sum(axis=-1)
+
+    dx = (mesh.xMax - mesh.xMin)/(mesh.nx - 1)
+    dy = (mesh.yMax - mesh.yMin)/(mesh.ny - 1)
+
+    return _IntensityStatistics(power=power*(dx*dy*1.e6), on_axis=on_axis, integrated=integrated, mesh=mesh)
 
 def mask_nans(a, replacement=0.0):
     """ Find nans in an array and replace.
@@ -420,8 +508,11 @@ def calculate_fwhm(wfr):
     """
     intens = wfr.get_intensity(polarization='total').sum(axis=-1);
 
+    return _fwhm(intens, wfr.params.Mesh)
 
-    mesh = wfr.params.Mesh
+def _fwhm(intens, mesh):
+    """ """
+    """ Private (hidden) utility to calculate the FWHM of a time integrated intensity map, see calculate_fwhm(). """
     dx = (mesh.xMax-mesh.xMin)/mesh.nx
     dy = (mesh.yMax-mesh.yMin)/mesh.ny
 
@@ -4,13 +4,15 @@
 import h5py
 import numpy
 import os
-import pylab
 import periodictable as pte
 
 ELEMENT_SYMBOL = ['All'] + [e.symbol for e in pte.elements]
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt
 from SimEx.Utilities.IOUtilities import loadPDB
 
+# Upper limit for the memory taken by the arrays of one block of snapshots.
+_BLOCK_BYTES = 256 * 1024**2
+
 
 class XMDYNPhotonMatterAnalysis(AbstractAnalysis):
     """:class XMDYNPhotonMatterAnalysis: Class to encapsulate diagnostics of photon matter interaction trajectories. """
@@ -131,19 +133,12 @@ class XMDYNPhotonMatterAnalysis(AbstractAnalysis):
         """ Load snapshot data from hdf5 file into memory. """
 
         snp = snapshot_index
-        dbase_root = "/data/snp_" + str( snp ).zfill(self.__num_digits) + "/"
-        xsnp = dict()
-
-        with h5py.File(self.input_path) as fp:
-            xsnp['Z'] = fp.get(dbase_root+ 'Z').value
-            xsnp['T'] = fp.get(dbase_root + 'T').value
-            xsnp['ff'] = fp.get(dbase_root + 'ff').value
-            xsnp['xyz'] = fp.get(dbase_root + 'xyz').value
-            xsnp['r'] = fp.get(dbase_root + 'r').value
-            xsnp['Nph'] = fp.get(dbase_root + 'Nph').value
-            N = xsnp['Z'].size
-            xsnp['q'] = numpy.array([xsnp['ff'][pylab.find(xsnp['T']==x), 0] for x in xsnp['xyz']]).reshape(N,)
-            xsnp['snp'] = snp ;
+
+        with h5py.File(self.input_path, 'r') as fp:
+            xsnp = read_snapshot(fp, snp, keys=['Z', 'T', 'ff', 'xyz', 'r', 'Nph'], num_digits=self.__num_digits)
+
+        xsnp['q'] = lookup_ion_charge(xsnp['T'], xsnp['ff'], xsnp['xyz'])
+        xsnp['snp'] = snp
 
         return xsnp
 
@@ -177,14 +172,20 @@ class XMDYNPhotonMatterAnalysis(AbstractAnalysis):
         """ Plot the evolution of MD energies over the simulation time. """
         raise RuntimeError("Not implemented yet.")
 
-    def load_trajectory(self):
-        """ Load the selected snapshots and extract data to analyze. """
+    def load_trajectory(self, block_size=None):
+        """ Load the selected snapshots and extract data to analyze.
+
+        The input file is opened once and the snapshots are processed in blocks. Displacements and charges are
+        averaged per atomic species with grouped sums over all snapshots of a block.
+
+        :param block_size: Number of snapshots to process at a time (default None, i.e. as many as fit into 256 MB).
+        :type block_size: int
+
+        """
 
         trajectory = dict()
 
         sample = None
-        disp = []
-        charge = []
         time = []
         # Read sample data.
         try:
@@ -193,17 +194,40 @@ class XMDYNPhotonMatterAnalysis(AbstractAnalysis):
             sample = loadPDB(self.sample_path)
 
         snapshot_indices = self.snapshot_indices
-        if snapshot_indices == "All":
+        if list(snapshot_indices) == ["All"]:
             snapshot_indices = range(1, self.number_of_snapshots() + 1)
+        snapshot_indices = list(snapshot_indices)
+
+        r0 = numpy.asarray(sample['r'])
+        labels, counts = _species_labels(sample, len(r0))
+
+        if block_size is None:
+            # Per snapshot, a block holds positions and displacements, charges and distances as float64.
+            snapshot_bytes = (2 * r0.size + 2 * len(r0)) * numpy.dtype(numpy.float64).itemsize
+            block_size = max(1, _BLOCK_BYTES // max(1, snapshot_bytes))
+
+        disp = numpy.zeros((len(snapshot_indices), len(counts)))
+        charge = numpy.zeros((len(snapshot_indices), len(counts)))
+
+        with h5py.File(self.input_path, 'r') as fp:
+            for start in range(0, len(snapshot_indices), block_size):
+                block = snapshot_indices[start:start+block_size]
 
-        for si in snapshot_indices:
-            snapshot = self.load_snapshot(si)
+                r = numpy.empty((len(block),) + r0.shape)
+                q = numpy.empty((len(block), len(r0)))
+                for i, si in enumerate(block):
+                    snapshot = read_snapshot(fp, si, keys=['T', 'ff', 'xyz', 'r'], num_digits=self.__num_digits)
+                    r[i] = snapshot['r']
+                    q[i] = lookup_ion_charge(snapshot['T'], snapshot['ff'], snapshot['xyz'])
 
-            disp.append(calculate_displacement(snapshot, r0=sample['r'], sample=sample))
-            charge.append(calculate_ion_charge(snapshot, sample))
+                dr = r - r0
+                distance = numpy.sqrt(numpy.einsum('ijk,ijk->ij', dr, dr))
 
-        trajectory['displacement'] = numpy.array(disp)
-        trajectory['charge'] = numpy.array(charge)
+                disp[start:start+len(block)] = _grouped_mean(distance, labels, counts) / 1e-10
+                charge[start:start+len(block)] = _grouped_mean(q, labels, counts)
+
+        trajectory['displacement'] = disp
+        trajectory['charge'] = charge
         trajectory['time'] = numpy.array(time)
 
         self.__trajectory = trajectory
@@ -224,7 +248,7 @@ def load_sample(sample_path) :
     sample['selZ'] = dict()
 
     for sel_Z in numpy.unique(sample['Z']) :
-        sample['selZ'][sel_Z] = pylab.find(sel_Z == sample['Z'])
+        sample['selZ'][sel_Z] = numpy.flatnonzero(sel_Z == sample['Z'])
 
     return sample
 
@@ -234,6 +258,88 @@ def read_h5_dataset( path , dataset ) :
         data = xfp.get( dataset ).value
     return data
 
+def read_snapshot(h5, snapshot_index, keys, num_digits=7):
+    """ Read the given datasets of a snapshot from an open hdf5 file.
+
+    :param h5: The open pmi output file.
+    :type h5: h5py.File
+
+    :param snapshot_index: The snapshot to read.
+    :type snapshot_index: int
+
+    :param keys: The datasets to read, e.g. ['r', 'xyz'].
+    :type keys: list
+
+    :param num_digits: Number of digits in the snapshot group names (default 7).
+    :type num_digits: int
+
+    :return: The snapshot data.
+    :rtype: dict
+
+    """
+    group = h5["data/snp_" + str(snapshot_index).zfill(num_digits)]
+
+    return dict((key, group[key][()]) for key in keys)
+
+def lookup_ion_charge(T, ff, xyz):
+    """ Map the electronic configuration of each atom to its number of bound electrons.
+
+    :param T: The electronic configurations present in the snapshot.
+    :type T: numpy.array (shape=(Nconfigurations,))
+
+    :param ff: The form factors of the configurations, the forward scattering (first column) being the number of bound electrons.
+    :type ff: numpy.array (shape=(Nconfigurations, Nq))
+
+    :param xyz: The electronic configuration of each atom.
+    :type xyz: numpy.array (shape=(Natoms,))
+
+    :return: The number of bound electrons of each atom.
+    :rtype: numpy.array (shape=(Natoms,))
+
+    """
+    T = numpy.ravel(T)
+    xyz = numpy.ravel(xyz)
+
+    order = numpy.argsort(T, kind='stable')
+    positions = numpy.searchsorted(T, xyz, sorter=order)
+    positions = numpy.minimum(positions, len(T) - 1)
+    indices = order[positions]
+
+    if numpy.any(T[indices] != xyz):
+        raise ValueError("Electronic configurations of some atoms are missing in the snapshot.")
+
+    return ff[indices, 0]
+
+def _species_labels(sample, number_of_atoms):
+    """ """
+    """ Label each atom with the position of its species in sample['selZ']. Atoms not in any species get the label -1.
+
+    :return: The labels and the number of atoms per species.
+    :rtype: tuple
+
+    """
+    labels = numpy.full(number_of_atoms, -1, dtype=numpy.int64)
+    for label, sel_Z in enumerate(sample['selZ'].keys()):
+        labels[sample['selZ'][sel_Z]] = label
+
+    counts = numpy.bincount(labels[labels >= 0], minlength=len(sample['selZ']))
+
+    return labels, counts
+
+def _grouped_mean(values, labels, counts):
+    """ """
+    """ Average the values over the atoms of each species, for each row if values is two dimensional. """
+    values = numpy.atleast_2d(values)
+    rows = values.shape[0]
+    number_of_species = len(counts)
+
+    selected = labels >= 0
+    bins = (numpy.arange(rows)[:, None] * number_of_species + labels[selected]).ravel()
+    sums = numpy.bincount(bins, weights=values[:, selected].ravel(), minlength=rows*number_of_species)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums.reshape(rows, number_of_species) / counts
+
 def calculate_displacement(snapshot, r0, sample) :
     """ Calculate the average displacement per atomic species in a snapshot.
 
@@ -249,17 +355,12 @@ def calculate_displacement(snapshot, r0, sample) :
 
     """
 
-    num_Z = len( list(sample['selZ'].keys()) )
-    all_disp = numpy.zeros( ( num_Z , ) )
+    labels, counts = _species_labels(sample, len(r0))
 
-    count = 0
+    dr = snapshot['r'] - r0
+    distance = numpy.sqrt( numpy.sum( dr * dr , axis = 1 ) )
 
-    for sel_Z in list(sample['selZ'].keys()) :
-        dr = snapshot['r'][sample['selZ'][sel_Z],:] - r0[sample['selZ'][sel_Z],:]
-        all_disp[count] = numpy.mean( numpy.sqrt( numpy.sum( dr * dr , axis = 1 ) ) ) / 1e-10
-        count = count + 1
-
-    return numpy.array(all_disp)
+    return _grouped_mean(distance, labels, counts)[0] / 1e-10
 
 def calculate_ion_charge(snapshot, sample):
     """ Calculate the remaining electric charge per atomic species of a given snapshot.
@@ -272,12 +373,6 @@ def calculate_ion_charge(snapshot, sample):
 
     """
 
-    num_Z = len( list(sample['selZ'].keys()) )
-    all_numE = numpy.zeros( ( num_Z , ) )
-    count = 0
-
-    for sel_Z in list(sample['selZ'].keys()) :
-        all_numE[count] = numpy.mean( snapshot['q'][sample['selZ'][sel_Z]] )
-        count = count + 1
+    labels, counts = _species_labels(sample, len(snapshot['q']))
 
-    return numpy.array(all_numE)
+    return _grouped_mean(snapshot['q'], labels, counts)[0]
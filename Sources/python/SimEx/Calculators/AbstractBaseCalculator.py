@@ -26,7 +26,9 @@ from SimEx.AbstractBaseClass import AbstractBaseClass
 from SimEx.Parameters.AbstractCalculatorParameters import AbstractCalculatorParameters
 from SimEx.Utilities import ParallelUtilities
 from SimEx.Utilities.EntityChecks import checkAndSetInstance
+from SimEx.Utilities.ResultCache import ResultCache, hashContent, hashObject, referencedFiles
 import dill
+import hashlib
 import os
 import sys
 
@@ -130,6 +132,77 @@ class AbstractBaseCalculator(AbstractBaseClass, metaclass=ABCMeta):
         return result
         # Can be reimplemented by specialized calculator.
 
+    def cacheInputs(self):
+        """
+        Query for files and directories the calculation depends on in addition to its parameters and input_path, e.g. a sample file passed to the constructor.
+
+        :return: The paths whose content enters the cache key.
+        :rtype: list
+        """
+        # Can be reimplemented by specialized calculator.
+        return []
+
+    def cacheOutputs(self):
+        """
+        Query for all files and directories written by backengine() and saveH5().
+
+        :return: The paths to store in and restore from a ResultCache.
+        :rtype: list
+        """
+        # Can be reimplemented by specialized calculator.
+        return [self.output_path]
+
+    def cacheKey(self):
+        """
+        Query for the key identifying this calculation in a ResultCache.
+
+        :return: Hash of the calculator class, its parameters, the content of its input, of files referenced in its parameters, and of its cacheInputs().
+        :rtype: str
+        """
+        hasher = hashlib.sha256()
+        hasher.update(
+            (self.__class__.__module__ + '.' + self.__class__.__name__).encode('utf-8'))
+        hashObject(self.parameters, hasher)
+        hashContent(self.input_path, hasher)
+        hashContent(referencedFiles(self.parameters), hasher)
+        hashContent(self.cacheInputs(), hasher)
+
+        return hasher.hexdigest()
+
+    def runCached(self, cache=None):
+        """
+        Run _readH5(), backengine() and saveH5(), unless the cache holds the output of an identical calculation.
+
+        :param cache: The cache to query and update (default None, i.e. no caching).
+        :type cache: ResultCache
+
+        :return: True if the output was taken from the cache, False if it was computed.
+        """
+        cache = checkAndSetInstance(ResultCache, cache, None)
+
+        if cache is not None:
+            try:
+                key = self.cacheKey()
+            except TypeError as error:
+                print("WARNING: Running %s without cache: %s" % (self.__class__.__name__, error))
+                cache = None
+
+        if cache is not None:
+            # Query before running, saveH5() may change output_path.
+            output_paths = self.cacheOutputs()
+            if cache.fetch(key, output_paths):
+                print("Reusing cached output for %s." % (self.__class__.__name__))
+                return True
+
+        self._readH5()
+        self.backengine()
+        self.saveH5()
+
+        if cache is not None:
+            cache.store(key, output_paths)
+
+        return False
+
     def dumpToFile(self, fname):
         """
         dump class instance to file.
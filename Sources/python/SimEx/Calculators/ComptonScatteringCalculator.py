@@ -20,11 +20,11 @@
 #                                                                        #
 ##########################################################################
 
+import functools
 import h5py
 import math
 import numpy
 import os
-from scipy.optimize import brentq as root
 from scipy.constants import physical_constants as PC
 from scipy import constants as C
 import tempfile
@@ -37,6 +37,9 @@ BOHR = PC['Bohr radius'][0]
 RY = PC['Rydberg constant times hc in eV'][0]
 ALPHA = C.alpha
 
+# Absolute tolerance of the chemical potential in units of the temperature.
+_XTOL = 2e-12
+
 class ComptonScatteringCalculator(AbstractPhotonDiffractor):
     """
     :class ComptonScatteringCalculator: Class representing a Compton scattering calculator.
@@ -156,19 +159,7 @@ class ComptonScatteringCalculator(AbstractPhotonDiffractor):
     def _comptonProfile(self):
         """ Workhorse function that calculates the Compton profile. """
 
-        # Fix variables and parameters.
-        pF = self.fermi_wavenumber
-        EF = self.fermi_energy
-        theta = self.temperature / self.fermi_energy
-        y = self.chemical_potential / self.temperature
-
-        rho_z = (self.pzs*BOHR)**2 / self.temperature*RY - y
-
-        # Calculate profile.
-        J = 0.75 * theta * numpy.log( 1. + numpy.exp( -rho_z ) )
-
-        # Return.
-        return J
+        return comptonProfile(self.pzs, self.electron_density, self.temperature, self.chemical_potential)
 
     @property
     def data(self):
@@ -227,7 +218,7 @@ def _fermiEnergy(ne):
 def _fermiWavenumber( ne ):
     """ Calculate the Fermi wavenumber kF. """
     # Convert density to inverse qubic Bohr.
-    neaB = ne * BOHR ** 3
+    neaB = numpy.asarray(ne) * BOHR ** 3
 
     # Get Fermi momentum in inverse Bohr.
     kF = ( 3. * math.pi**2 * neaB )**(1./3.)
@@ -236,24 +227,128 @@ def _fermiWavenumber( ne ):
     return kF / BOHR
 
 
+@functools.lru_cache(maxsize=1024)
 def _chemicalPotential(ne, T):
     """ Calculate the chemical potential at given electron density and temperature through inversion
-    of the Fermi integral F_1/2. """
+    of the Fermi integral F_1/2. Results are cached. """
+
+    mu = float(chemicalPotential(ne, T))
+    if math.isnan(mu):
+        raise ValueError("The chemical potential could not be bracketed for ne=%e, T=%e." % (ne, T))
+
+    return mu
+
+
+def chemicalPotential(ne, T):
+    """ Calculate the chemical potential through inversion of the Fermi integral F_1/2 for arrays of densities and temperatures.
+
+    The root is located by bisection, carried out for all elements at once. Elements where the root cannot be
+    bracketed (far in the non-degenerate limit, where the series for F_1/2 is inaccurate) are set to nan.
+
+    :param ne: The electron density (units of 1/m^3).
+    :type ne: float or numpy.array
+
+    :param T: The electron temperature (units of eV).
+    :type T: float or numpy.array
+
+    :return: The chemical potential (units of eV), broadcast to the shape of ne and T.
+    :rtype: numpy.array
+
+    """
+    ne, T = numpy.broadcast_arrays(numpy.asarray(ne, dtype=float), numpy.asarray(T, dtype=float))
 
     EF = _fermiEnergy( ne )
     theta = T/EF
     # Thermal wavelength in Bohr.
-    lambda_e_aB = 2.*math.sqrt(math.pi/T*RY)
+    lambda_e_aB = 2.*numpy.sqrt(math.pi/T*RY)
 
     # Density in Bohr**-3
     neaB = ne * BOHR**3
 
     # Locate the root in the interval [3/2 ln(ne lambda_T**3 / 2) , EF/T ]
-    search_interval_minimum = 1.5 * math.log( 0.5 * neaB * lambda_e_aB**3 )
-    search_interval_maximum = 1./theta
-    y = root(_chemicalPotentialRoot, a=search_interval_minimum, b=search_interval_maximum, args=(theta,0))
+    lower = 1.5 * numpy.log( 0.5 * neaB * lambda_e_aB**3 )
+    upper = 1./theta
+
+    # The function to root decreases monotonically with y.
+    f_lower = _chemicalPotentialRoot(lower, theta)
+    f_upper = _chemicalPotentialRoot(upper, theta)
+    bracketed = numpy.sign(f_lower) * numpy.sign(f_upper) <= 0
+
+    y = 0.5 * (lower + upper)
+    for i in range(200):
+        if numpy.all(upper - lower <= _XTOL + 4. * numpy.finfo(float).eps * numpy.abs(y)):
+            break
+        root_above = _chemicalPotentialRoot(y, theta) > 0
+        lower = numpy.where(root_above, y, lower)
+        upper = numpy.where(root_above, upper, y)
+        y = 0.5 * (lower + upper)
+
+    return numpy.where(bracketed, y * T, numpy.nan)
+
+
+def comptonProfile(pz, ne, T, mu=None):
+    """ Calculate the Compton profile of the free electron gas for arrays of momenta, densities and temperatures.
+
+    :param pz: The z component of the scattering transfer momentum (units of 1/m).
+    :type pz: float or numpy.array
+
+    :param ne: The electron density (units of 1/m^3).
+    :type ne: float or numpy.array
+
+    :param T: The electron temperature (units of eV).
+    :type T: float or numpy.array
 
-    return y * T
+    :param mu: The chemical potential (units of eV), e.g. from chemicalPotential(ne, T) (default None, i.e. calculate it).
+    :type mu: float or numpy.array
+
+    :return: The Compton profile, broadcast to the shape of pz, ne and T.
+    :rtype: numpy.array
+
+    """
+    if mu is None:
+        mu = chemicalPotential(ne, T)
+
+    theta = T / _fermiEnergy( ne )
+    y = mu / T
+
+    rho_z = (numpy.asarray(pz)*BOHR)**2 / T*RY - y
+
+    # Calculate profile, log(1 + exp(-rho_z)).
+    return 0.75 * theta * numpy.logaddexp( 0., -rho_z )
+
+
+def comptonProfiles(energy_shifts, photon_energy, scattering_angle, ne, T):
+    """ Calculate Compton profiles for a grid of densities, temperatures and scattering angles at once.
+
+    :param energy_shifts: The energy shifts (units of eV).
+    :type energy_shifts: numpy.array
+
+    :param photon_energy: The source photon energy (units of eV).
+    :type photon_energy: float
+
+    :param scattering_angle: The scattering angle(s) (units of degree).
+    :type scattering_angle: float or numpy.array
+
+    :param ne: The electron density (units of 1/m^3).
+    :type ne: float or numpy.array
+
+    :param T: The electron temperature (units of eV).
+    :type T: float or numpy.array
+
+    :return: The momenta pz and the Compton profiles, both of shape broadcast(scattering_angle, ne, T).shape + energy_shifts.shape.
+    :rtype: tuple
+
+    """
+    energy_shifts = numpy.asarray(energy_shifts, dtype=float)
+    scattering_angle, ne, T = numpy.broadcast_arrays(*[numpy.asarray(a, dtype=float) for a in (scattering_angle, ne, T)])
+
+    # The chemical potential depends only on density and temperature.
+    mu = chemicalPotential(ne, T)
+
+    expand = (Ellipsis,) + (None,)*energy_shifts.ndim
+    pzs = _pz( photon_energy, photon_energy - energy_shifts, scattering_angle[expand] )
+
+    return pzs, comptonProfile(pzs, ne[expand], T[expand], mu[expand])
 
 
 def fermihalf(x,sgn):
@@ -262,20 +357,22 @@ def fermihalf(x,sgn):
         Credits: Greg von Winckel
         http://www.scientificpython.net/pyblog/approximate-fermi-dirac-integrals"""
 
-    f = lambda k: numpy.sqrt(x**2+numpy.pi**2*(2*k-1)**2)
-
+    # Sum over all 20 terms of the series at once, x may be an array.
+    x = numpy.asarray(x, dtype=float)
+    k = numpy.arange(1, 21).reshape((20,) + (1,)*x.ndim)
+    f = numpy.sqrt(x**2+numpy.pi**2*(2*k-1)**2)
 
     if sgn>0: # F_{1/2}(x)
         a = numpy.array((1.0/770751818298,-1.0/3574503105,-13.0/184757992,
               85.0/3603084,3923.0/220484,74141.0/8289,-5990294.0/7995))
-        g = lambda k:numpy.sqrt(f(k)-x)
+        g = numpy.sqrt(f-x)
 
     else:  # F_{-1/2}(x)
         a = numpy.array((-1.0/128458636383,-1.0/714900621,-1.0/3553038,
                       27.0/381503,3923.0/110242,8220.0/919))
-        g = lambda k:-0.5*numpy.sqrt(f(k)-x)/f(k)
+        g = -0.5*numpy.sqrt(f-x)/f
 
-    F = numpy.polyval(a,x) + 2*numpy.sqrt(2*numpy.pi)*sum(map(g,list(range(1,21))))
+    F = numpy.polyval(a,x) + 2*numpy.sqrt(2*numpy.pi)*g.sum(axis=0)
 
     return  F # Prefactor to get normalized Fermi integral.
 
@@ -300,11 +397,10 @@ def _pz( wi, wf, theta ):
 
     m0 = 0.5
     c = 2./ALPHA
-    th = theta * math.pi / 180.
+    th = numpy.asarray(theta) * math.pi / 180.
 
 
-    nom = i - f - i*f/m0/c**2*(1.-math.cos(th))
-    denom = numpy.sqrt( i**2 + f**2 - 2.*i*f*math.cos(th) )
+    nom = i - f - i*f/m0/c**2*(1.-numpy.cos(th))
+    denom = numpy.sqrt( i**2 + f**2 - 2.*i*f*numpy.cos(th) )
 
     return m0 * c * nom / denom  / BOHR
-
@@ -19,9 +19,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
 #                                                                        #
 ##########################################################################
+import functools
 import h5py
+import multiprocessing.pool
 import numpy
 import os, sys
+import shutil
 import subprocess,shlex
 import tempfile
 
@@ -125,63 +128,17 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
     # Useless now, just for compatibility
     def _run_geom(self):
         """ Perform the actual calls to pattern_sim with multi-panel .geom file. """
-        # Setup directory structure as needed.
-        if not os.path.isdir( self.output_path ):
-            os.makedirs( self.output_path )
+        # Setup directory structure as needed, several MPI ranks may get here at the same time.
+        os.makedirs( self.output_path, exist_ok=True )
 
         output_file_base = os.path.join( self.output_path, "diffr_out")
 
         if self.parameters.number_of_diffraction_patterns == 1:
             output_file_base += "_0000001.h5"
 
-        geom_filename = self.parameters.detector_geometry
-
-        # Setup command, minimum set first.
-        # Distribute patterns over available processes in round-robin.
-        command_sequence = ['pattern_sim',
-                            '-p%s'                  % self.parameters.sample,
-                            '--geometry=%s'         % geom_filename,
-                            '--output=%s'           % (output_file_base),
-                            '--number=%d'           % (self.parameters.number_of_diffraction_patterns)
-                            ]
-        # Handle random rotation as requested.
-        if self.parameters.uniform_rotation is True:
-            command_sequence.append('--random-orientation')
-            command_sequence.append('--really-random')
-
-        if self.parameters.beam_parameters is not None:
-            command_sequence.append('--photon-energy=%f' % (self.parameters.beam_parameters.photon_energy.m_as(electronvolt)))
-            command_sequence.append('--beam-bandwidth=%f' % (self.parameters.beam_parameters.photon_energy_relative_bandwidth))
-            nphotons = self.parameters.beam_parameters.pulse_energy / self.parameters.beam_parameters.photon_energy
-            command_sequence.append('--nphotons=%e' % (nphotons))
-            command_sequence.append('--beam-radius=%e' % (self.parameters.beam_parameters.beam_diameter_fwhm.m_as(meter)/2.))
-            command_sequence.append('--spectrum=%s' % (self.parameters.beam_parameters.photon_energy_spectrum_type.lower()))
-            if self.parameters.beam_parameters.photon_energy_spectrum_type.lower() == "sase":
-                command_sequence.append('--sample-spectrum=512')
-
-        # Handle intensities list if present.
-        if self.parameters.intensities_file is not None:
-            command_sequence.append('--intensities=%s' % (self.parameters.intensities_file))
-
-        # Handle powder if present.
-        if self.parameters.powder is True:
-            command_sequence.append('--powder=%s' % (os.path.join(self.output_path, "powder.h5")))
-
-        # Handle size range if present.
-        if self.parameters.crystal_size_min is not None:
-            command_sequence.append('--min-size=%f' % (self.parameters.crystal_size_min.m_as(1e-9*meter) ))
-        if self.parameters.crystal_size_max is not None:
-            command_sequence.append('--max-size=%f' % (self.parameters.crystal_size_max.m_as(1e-9*meter) ))
-
-        # Handle gpu acceleration.
-        if self.parameters.gpus_per_task > 0:
-            # Check if crystfel was built with opencv support.
-            # Get pattern_sim's path.
-            pattern_sim_path = subprocess.check_output(shlex.split("which pattern_sim"))[:-1].decode('utf-8')
-            # Get list of dynamic dependencies.
-            ldd = subprocess.check_output(shlex.split("ldd "+pattern_sim_path)).decode('utf-8')
-            if "libOpenCL.so.1" in ldd:
-                command_sequence.append('--gpu')
+        command_sequence = self._commandSequence(self.parameters.detector_geometry,
+                                                 output_file_base,
+                                                 self.parameters.number_of_diffraction_patterns)
 
         if 'SIMEX_VERBOSE' in os.environ:
             print("Pattern_sim call: "+ " ".join(command_sequence))
@@ -193,17 +150,16 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
         return proc.returncode
 
     def backengine(self):
-        """ This method drives the backengine CrystFEL.pattern_sim."""
+        """ This method drives the backengine CrystFEL.pattern_sim.
 
-        # pattern_sim backengine does not support MPI.
-        return self._run()
+        With more than one shard, the shards run in a local pool of processes, or distributed over MPI ranks if a forced
+        MPI command is given in the parameters.
+        """
 
-        # collect MPI arguments
-        if self.parameters.forced_mpi_command=="":
-            np=self.computeNTasks()
-            mpicommand=ParallelUtilities.prepareMPICommandArguments(np)
-        else:
-            mpicommand=self.parameters.forced_mpi_command
+        if self.parameters.number_of_shards == 1 or not self.parameters.forced_mpi_command:
+            return self._run()
+
+        mpicommand=self.parameters.forced_mpi_command
 
         # Dump to a temporary file.
         fname = IOUtilities.getTmpFileName()
@@ -230,14 +186,8 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
     def _run(self):
         """ Perform the actual calls to pattern_sim. """
 
-        # Setup directory structure as needed.
-        if not os.path.isdir( self.output_path ):
-            os.makedirs( self.output_path )
-
-        output_file_base = os.path.join( self.output_path, "diffr_out")
-
-        if self.parameters.number_of_diffraction_patterns == 1:
-            output_file_base += "_0000001.h5"
+        # Setup directory structure as needed, several MPI ranks may get here at the same time.
+        os.makedirs( self.output_path, exist_ok=True )
 
         # Serialize geometry if necessary.
         if isinstance(self.parameters.detector_geometry, str) and os.path.isfile(self.parameters.detector_geometry):
@@ -249,13 +199,116 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
         geom_filename = geom_file.name
         self.parameters.detector_geometry.serialize(stream=geom_filename, caller=self.parameters)
 
+        if self.parameters.number_of_shards > 1:
+            return self._runShards(geom_filename)
+
+        output_file_base = os.path.join( self.output_path, "diffr_out")
+
+        if self.parameters.number_of_diffraction_patterns == 1:
+            output_file_base += "_0000001.h5"
+
+        command_sequence = self._commandSequence(geom_filename,
+                                                 output_file_base,
+                                                 self.parameters.number_of_diffraction_patterns)
+
+        if 'SIMEX_VERBOSE' in os.environ:
+            print("Pattern_sim call: "+ " ".join(command_sequence))
+
+        # Run the backengine command.
+        proc = subprocess.Popen(command_sequence)
+        proc.wait()
+
+        return proc.returncode
+
+    def _runShards(self, geom_filename):
+        """ """
+        """ Run the pattern_sim shards and merge their patterns into the output directory.
+
+        Each shard writes into its own subdirectory with an independent random seed. Without MPI, or on a single rank,
+        all shards run in a local pool. Otherwise every rank runs its share of the shards and rank 0 merges.
+
+        :param geom_filename: The serialized detector geometry.
+        :type geom_filename: str
+
+        :return: 0 if all shards succeeded.
+        """
+        shard_sizes = [len(s) for s in numpy.array_split(numpy.arange(self.parameters.number_of_diffraction_patterns),
+                                                         self.parameters.number_of_shards)]
+        shard_dirs = [os.path.join(self.output_path, "shard_%04d" % (i)) for i in range(len(shard_sizes))]
+        jobs = [(self._shardCommandSequence(geom_filename, shard_dir, shard_size), shard_dir)
+                for shard_dir, shard_size in zip(shard_dirs, shard_sizes) if shard_size > 0]
+
+        if 'SIMEX_VERBOSE' in os.environ:
+            for command_sequence, shard_dir in jobs:
+                print("Pattern_sim call: "+ " ".join(command_sequence))
+
+        comm = None
+        if self.parameters.forced_mpi_command:
+            # Local import of MPI to avoid premature call to MPI.init().
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+
+        if comm is None or comm.size == 1:
+            number_of_processes = min(len(jobs), os.cpu_count() or 1)
+            with multiprocessing.pool.ThreadPool(processes=number_of_processes) as pool:
+                returncodes = pool.map(_runShard, jobs)
+        else:
+            returncodes = [_runShard(job) for job in jobs[comm.rank::comm.size]]
+            returncodes = [r for rank_returncodes in comm.allgather(returncodes) for r in rank_returncodes]
+            if comm.rank != 0:
+                return max(returncodes)
+
+        status = max(returncodes)
+        if status == 0:
+            _mergeShards([shard_dir for command_sequence, shard_dir in jobs], self.output_path)
+
+        return status
+
+    def _shardCommandSequence(self, geom_filename, shard_dir, number_of_patterns):
+        """ """
+        """ Setup the pattern_sim command of a shard writing into its own directory. """
+        output_file_base = os.path.join(shard_dir, "diffr_out")
+        if number_of_patterns == 1:
+            output_file_base += "_0000001.h5"
+
+        command_sequence = self._commandSequence(geom_filename, output_file_base, number_of_patterns, powder_dir=shard_dir)
+
+        # Seed each shard independently, otherwise all shards would produce the same patterns. This makes sharded runs
+        # irreproducible, see the 'number_of_shards' parameter.
+        if '--really-random' not in command_sequence:
+            command_sequence.append('--really-random')
+
+        return command_sequence
+
+    def _commandSequence(self, geom_filename, output_file_base, number_of_patterns, powder_dir=None):
+        """ """
+        """ Setup the pattern_sim command.
+
+        :param geom_filename: The serialized detector geometry.
+        :type geom_filename: str
+
+        :param output_file_base: Path and prefix of the output files.
+        :type output_file_base: str
+
+        :param number_of_patterns: Number of patterns to generate.
+        :type number_of_patterns: int
+
+        :param powder_dir: Where to write the powder pattern (default None, i.e. the output directory).
+        :type powder_dir: str
+
+        :return: The command sequence.
+        :rtype: list
+        """
+
+        if powder_dir is None:
+            powder_dir = self.output_path
+
         # Setup command, minimum set first.
-        # Distribute patterns over available processes in round-robin.
         command_sequence = ['pattern_sim',
                             '-p%s'                  % self.parameters.sample,
                             '--geometry=%s'         % geom_filename,
                             '--output=%s'           % (output_file_base),
-                            '--number=%d'           % (self.parameters.number_of_diffraction_patterns)
+                            '--number=%d'           % (number_of_patterns)
                             ]
         # Handle random rotation as requested.
         if self.parameters.uniform_rotation is True:
@@ -278,7 +331,7 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
 
         # Handle powder if present.
         if self.parameters.powder is True:
-            command_sequence.append('--powder=%s' % (os.path.join(self.output_path, "powder.h5")))
+            command_sequence.append('--powder=%s' % (os.path.join(powder_dir, "powder.h5")))
 
         # Handle size range if present.
         if self.parameters.crystal_size_min is not None:
@@ -287,23 +340,14 @@ class CrystFELPhotonDiffractor(AbstractPhotonDiffractor):
             command_sequence.append('--max-size=%f' % (self.parameters.crystal_size_max.m_as(1e-9*meter) ))
 
         # Handle gpu acceleration.
-        if self.parameters.gpus_per_task > 0:
-            # Check if crystfel was built with opencv support.
-            # Get pattern_sim's path.
-            pattern_sim_path = subprocess.check_output(shlex.split("which pattern_sim"))[:-1].decode('utf-8')
-            # Get list of dynamic dependencies.
-            ldd = subprocess.check_output(shlex.split("ldd "+pattern_sim_path)).decode('utf-8')
-            if "libOpenCL.so.1" in ldd:
-                command_sequence.append('--gpu')
+        if self.parameters.gpus_per_task > 0 and _patternSimSupportsGPU():
+            command_sequence.append('--gpu')
 
-        if 'SIMEX_VERBOSE' in os.environ:
-            print("Pattern_sim call: "+ " ".join(command_sequence))
+        return command_sequence
 
-        # Run the backengine command.
-        proc = subprocess.Popen(command_sequence)
-        proc.wait()
-
-        return proc.returncode
+    def cacheOutputs(self):
+        """ Query for the outputs, i.e. the pattern directory and the linking file written by saveH5(). """
+        return [self.output_path, self.output_path + ".h5"]
 
     @property
     def data(self):
@@ -459,12 +503,86 @@ def _rename_files(path):
         if not f.split(".")[-1] == "h5":
             continue
 
+        # Skip files that are already simex conform, e.g. merged shards.
+        if "-" not in f:
+            continue
+
         new_filename = "%s_%07d.h5" % ("".join(f.split("-")[:-1]),i+1)
         print("Renaming %s to %s." % (f, new_filename))
         os.rename(f, new_filename)
 
     os.chdir( old_wd )
 
+def _runShard(job):
+    """ """
+    """ Run the pattern_sim command of one shard in a fresh shard directory. """
+    (command_sequence, shard_dir) = job
+
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+
+    return subprocess.call(command_sequence)
+
+def _mergeShards(shard_dirs, output_path):
+    """ """
+    """
+    Move the patterns of all shards into the output directory, numbered consecutively in shard order, and sum the
+    powder patterns.
+
+    :param shard_dirs: The shard directories, in order.
+    :type shard_dirs: list
+
+    :param output_path: The output directory.
+    :type output_path: str
+    """
+    index = 0
+    powder_files = []
+    for shard_dir in shard_dirs:
+        shard_files = [f for f in os.listdir(shard_dir) if f.startswith("diffr_out") and f.endswith(".h5")]
+        shard_files.sort(key=lambda f: int(f[:-len(".h5")].replace("_", "-").split("-")[-1]))
+
+        for f in shard_files:
+            index += 1
+            os.replace(os.path.join(shard_dir, f), os.path.join(output_path, "diffr_out_%07d.h5" % (index)))
+
+        if os.path.isfile(os.path.join(shard_dir, "powder.h5")):
+            powder_files.append(os.path.join(shard_dir, "powder.h5"))
+
+    if powder_files != []:
+        _sumPowderFiles(powder_files, os.path.join(output_path, "powder.h5"))
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+def _sumPowderFiles(powder_files, target):
+    """ """
+    """ Write the first powder file to target with all its datasets summed over all powder files. """
+    shutil.copy(powder_files[0], target)
+
+    with h5py.File(target, 'a') as h5_target:
+        datasets = []
+        h5_target.visititems(lambda name, obj: datasets.append(name) if isinstance(obj, h5py.Dataset) and obj.shape != () else None)
+
+        for powder_file in powder_files[1:]:
+            with h5py.File(powder_file, 'r') as h5:
+                for name in datasets:
+                    h5_target[name][...] = h5_target[name][()] + h5[name][()]
+
+@functools.lru_cache(maxsize=None)
+def _patternSimSupportsGPU():
+    """ """
+    """ Check once per session if pattern_sim was built with OpenCL support. """
+    # Get pattern_sim's path.
+    pattern_sim_path = shutil.which("pattern_sim")
+    if pattern_sim_path is None:
+        return False
+
+    # Get list of dynamic dependencies.
+    ldd = subprocess.check_output(["ldd", pattern_sim_path]).decode('utf-8')
+
+    return "libOpenCL.so.1" in ldd
+
 
 if __name__ == '__main__':
     CrystFELPhotonDiffractor.runFromCLI()
@@ -22,12 +22,14 @@
 
 import glob
 import h5py
+import multiprocessing.pool
 import numpy
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+from scipy import ndimage
 
 from SimEx.Calculators.AbstractPhotonAnalyzer import AbstractPhotonAnalyzer
 from SimEx.Parameters.DMPhasingParameters import DMPhasingParameters
@@ -150,7 +152,7 @@ class DMPhasing(AbstractPhotonAnalyzer):
 
             # Compute autocorrelation and support
             #print_to_log("Computing autocorrelation...")
-            input_intens  = _v_zero_neg(input_intens.ravel()).reshape(input_intens.shape)
+            input_intens  = _zero_neg(input_intens)
             auto        = numpy.fft.fftshift(numpy.abs(numpy.fft.fftn(numpy.fft.ifftshift(input_intens))))
             #print_to_log("Using 2-means clustering to determine significant voxels in autocorrelation...")
             (a_0, a_1)  = _cluster_two_means(auto.ravel())
@@ -159,6 +161,11 @@ class DMPhasing(AbstractPhotonAnalyzer):
             support     = _support_from_autocorr(auto, qmax, a_0, a_1, support_file)
 
             #Start phasing
+            if self.parameters.number_of_processes > 1:
+                self._run_ensemble(run_instance_dir, support, intens_len, output_file)
+                shutil.copy( output_file, os.path.join( cwd, self.output_path ) )
+                return 0
+
             #Store parameters into phase_out.h5.
             #Link executable from compiled version in srcDir to tmpDir
             cwd = os.path.abspath(os.curdir)
@@ -183,7 +190,6 @@ class DMPhasing(AbstractPhotonAnalyzer):
             #print_to_log("Done with reconstructions, now saving output from final shrink_cycle to h5 file")
             fp          = h5py.File(output_file, "w")
             g_data      = fp.create_group("data")
-            g_params    = fp.create_group("params")
             #g_supp      = fp.create_group("/history/support")
             g_err       = fp.create_group("/history/error")
             g_hist_obj  = fp.create_group("/history/object")
@@ -201,12 +207,7 @@ class DMPhasing(AbstractPhotonAnalyzer):
             g_data.create_dataset("electronDensity", data=finish_object, compression="gzip")
             os.system("cp finish_object.dat start_object.dat")
 
-            g_params.create_dataset("DM_support",           data=support, compression="gzip")
-            g_params.create_dataset("DM_numTrials",         data=number_of_trials)
-            g_params.create_dataset("DM_numIterPerTrial",   data=number_of_iterations)
-            g_params.create_dataset("DM_startAvePerIter",   data=averaging_start)
-            g_params.create_dataset("DM_leashParameter",    data=leash)
-            g_params.create_dataset("DM_shrinkwrapCycles",  data=number_of_shrink_cycles)
+            self._write_dm_parameters(fp, support)
 
             shrinkWrap = _parse_shrinkwrap_log(shrinkWrapFile)
             fp.create_dataset("/history/shrinkwrap", data=shrinkWrap, compression="gzip")
@@ -222,6 +223,165 @@ class DMPhasing(AbstractPhotonAnalyzer):
             os.chdir(cwd)
             return 1
 
+    def _run_ensemble(self, run_instance_dir, support, object_size, output_file):
+        """ """
+        """ Run independent single trial DM instances at the same time, each in its own directory.
+
+        Each trial starts from its own random object, drawn from the numpy random state, so trials differ even if they start at the same moment.
+        The final objects of all trials are aligned to the trial with the smallest final error and averaged.
+
+        :param run_instance_dir: Directory holding the support and intensity files.
+        :type run_instance_dir: str
+
+        :param support: The support.
+        :type support: numpy.array
+
+        :param object_size: Number of voxels of the object along each axis.
+        :type object_size: int
+
+        :param output_file: Where to write the results.
+        :type output_file: str
+
+        :private:
+        """
+
+        number_of_trials = self.parameters.number_of_trials
+        input_options = [1,
+                         self.parameters.number_of_iterations,
+                         self.parameters.averaging_start,
+                         self.parameters.leash,
+                         self.parameters.number_of_shrink_cycles]
+        cmd = ["object_recon"] + [str(o) for o in input_options]
+
+        # Setup one directory per trial, with its own random start object.
+        seeds = numpy.random.randint(2**31, size=number_of_trials)
+        jobs = []
+        for n in range(number_of_trials):
+            trial_dir = os.path.join(run_instance_dir, "trial_%0.4d" % (n+1))
+            os.mkdir(trial_dir)
+            for input_file in ["support.dat", "object_intensity.dat"]:
+                shutil.copy(os.path.join(run_instance_dir, input_file), trial_dir)
+            start_object = _random_start_object(support, object_size, numpy.random.RandomState(seeds[n]))
+            start_object.tofile(os.path.join(trial_dir, "start_object.dat"), sep=" ")
+            jobs.append((trial_dir, cmd))
+
+        # Run the trials, at most one per core.
+        number_of_processes = min(self.parameters.number_of_processes, number_of_trials, os.cpu_count() or 1)
+        with multiprocessing.pool.ThreadPool(processes=number_of_processes) as pool:
+            return_codes = pool.map(_run_trial, jobs)
+
+        # Collect errors and objects of the finished trials.
+        trial_dirs = []
+        for (trial_dir, cmd), return_code in zip(jobs, return_codes):
+            if return_code == 0 and os.path.isfile(os.path.join(trial_dir, "finish_object.dat")):
+                trial_dirs.append(trial_dir)
+            else:
+                print("WARNING: DM trial %s failed with return code %d, see %s." % (os.path.basename(trial_dir), return_code, os.path.join(trial_dir, "recon.out")))
+        number_of_failed_trials = number_of_trials - len(trial_dirs)
+        if trial_dirs == []:
+            raise RuntimeError("No DM trial finished.")
+
+        errors = [[_parse_error_log(log) for log in sorted(glob.glob(os.path.join(trial_dir, "object*.log")))] for trial_dir in trial_dirs]
+        trial_errors = numpy.array([_final_error(e) for e in errors])
+        objects = [_extract_object(os.path.join(trial_dir, "finish_object.dat")) for trial_dir in trial_dirs]
+
+        best = int(numpy.argmin(trial_errors))
+        average = numpy.mean([_align_object(objects[best], obj) for obj in objects], axis=0)
+
+        with h5py.File(output_file, "w") as fp:
+            g_data      = fp.create_group("data")
+            g_err       = fp.create_group("/history/error")
+            g_hist_obj  = fp.create_group("/history/object")
+
+            for n, err in enumerate(e for trial in errors for e in trial):
+                g_err.create_dataset("%0.4d"%(n+1), data=err, compression="gzip")
+
+            min_objects = [ob_fn for trial_dir in trial_dirs for ob_fn in sorted(glob.glob(os.path.join(trial_dir, "finish_min_object*.dat")))]
+            for n, ob_fn in enumerate(min_objects):
+                g_hist_obj.create_dataset("%0.4d"%(n+1), data=_extract_object(ob_fn), compression="gzip")
+
+            g_data.create_dataset("electronDensity", data=average, compression="gzip")
+            g_data.create_dataset("bestElectronDensity", data=objects[best], compression="gzip")
+
+            self._write_dm_parameters(fp, support)
+
+            fp.create_dataset("/history/trial_error", data=trial_errors)
+            fp.create_dataset("/history/failed_trials", data=number_of_failed_trials)
+            fp.create_dataset("/history/best_trial", data=int(os.path.basename(trial_dirs[best]).split("_")[-1]))
+
+            shrinkWrap = _parse_shrinkwrap_log(os.path.join(trial_dirs[best], "shrinkwrap.log"))
+            fp.create_dataset("/history/shrinkwrap", data=shrinkWrap, compression="gzip")
+            fp.create_dataset("version", data=h5py.version.hdf5_version)
+
+    def _write_dm_parameters(self, fp, support):
+        """ """
+        """ Store the support and DM parameters in the output file. """
+        g_params    = fp.create_group("params")
+
+        g_params.create_dataset("DM_support",           data=support, compression="gzip")
+        g_params.create_dataset("DM_numTrials",         data=self.parameters.number_of_trials)
+        g_params.create_dataset("DM_numIterPerTrial",   data=self.parameters.number_of_iterations)
+        g_params.create_dataset("DM_startAvePerIter",   data=self.parameters.averaging_start)
+        g_params.create_dataset("DM_leashParameter",    data=self.parameters.leash)
+        g_params.create_dataset("DM_shrinkwrapCycles",  data=self.parameters.number_of_shrink_cycles)
+
+def _run_trial(job):
+    """ """
+    """ Run a single DM trial in its directory, with output to recon.out. """
+    (trial_dir, cmd) = job
+    with open(os.path.join(trial_dir, "recon.out"), "w") as out:
+        return subprocess.call(cmd, cwd=trial_dir, stdout=out, stderr=subprocess.STDOUT)
+
+def _random_start_object(support, object_size, random_state):
+    """ """
+    """ A random object, uniform in [0, 1) on the support voxels and zero elsewhere.
+
+    :param support: Voxel indices of the support, shape (number of voxels, 3).
+    :type support: numpy.array
+
+    :param object_size: Number of voxels along each axis.
+    :type object_size: int
+
+    :param random_state: Source of random numbers.
+    :type random_state: numpy.random.RandomState
+    """
+    start_object = numpy.zeros((object_size,)*3)
+    (i, j, k) = numpy.asarray(support).T
+    start_object[i, j, k] = random_state.random_sample(len(support))
+
+    return start_object
+
+def _final_error(errors):
+    """ """
+    """ The last error of the last log of a trial, infinite if there is none. """
+    errors = [e for e in errors if len(e) > 0]
+    if errors == []:
+        return numpy.inf
+    return errors[-1][-1]
+
+def _align_object(reference, obj):
+    """ """
+    """ Shift obj, or its centrosymmetric twin, by whole voxels to its best overlap with reference.
+
+    :param reference: The object to align to.
+    :type reference: numpy.array
+
+    :param obj: The object to align.
+    :type obj: numpy.array
+
+    :return: The aligned object.
+    """
+    reference_ft = numpy.fft.fftn(reference)
+    (best_overlap, aligned) = (None, obj)
+    for candidate in (obj, obj[::-1,::-1,::-1]):
+        overlap = numpy.fft.ifftn(reference_ft * numpy.conj(numpy.fft.fftn(candidate))).real
+        shift = numpy.unravel_index(numpy.argmax(overlap), overlap.shape)
+        if best_overlap is None or overlap[shift] > best_overlap:
+            best_overlap = overlap[shift]
+            aligned = numpy.roll(candidate, shift, axis=tuple(range(candidate.ndim)))
+
+    return aligned
+
 def _load_intensities(ref_file):
     """ """
     """ Private function for loading 3D intensity maps from a file.
@@ -238,35 +398,34 @@ def _load_intensities(ref_file):
     (q_low, q_high) = (15, int(0.9*qmax))
     qRange1 = numpy.arange(-q_high, q_high + 1)
     qRange2 = numpy.arange(-qmax, qmax + 1)
-    qPos0   = numpy.array([[i,j,0] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos1   = numpy.array([[i,0,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
-    qPos2   = numpy.array([[0,i,j] for i in qRange1 for j in qRange1 if numpy.sqrt(i*i+j*j) > q_low]).astype("float")
+
+    # Grid points on the three central planes outside the low q region.
+    (i, j)  = numpy.meshgrid(qRange1, qRange1, indexing='ij')
+    outside = numpy.sqrt(i*i+j*j) > q_low
+    (i, j)  = (i[outside], j[outside])
+    zero    = numpy.zeros_like(i)
+    qPos0   = numpy.column_stack((i, j, zero)).astype("float")
+    qPos1   = numpy.column_stack((i, zero, j)).astype("float")
+    qPos2   = numpy.column_stack((zero, i, j)).astype("float")
     qPos    = numpy.concatenate((qPos0, qPos1, qPos2))
-    qPos_full = numpy.array([[i,j,k] for i in qRange2 for j in qRange2 for k in qRange2]).astype("float")
+    qPos_full = numpy.stack(numpy.meshgrid(qRange2, qRange2, qRange2, indexing='ij'), axis=-1).reshape(-1, 3).astype("float")
     return (qmax, t_intens, intens_len, qPos, qPos_full)
 
 def _zero_neg(x):
-    return 0. if x<=0. else x
-
-_v_zero_neg  = numpy.vectorize(_zero_neg)
+    return numpy.where(x <= 0., 0., x)
 
 def _find_two_means(vals, v0, v1):
-    v0_t    = 0.
-    v0_t_n  = 0.
-    v1_t    = 0.
-    v1_t_n  = 0.
-    for vv in vals:
-        if (numpy.abs(vv-v0) > abs(vv-v1)):
-            v1_t    += vv
-            v1_t_n  += 1.
-        else:
-            v0_t    += vv
-            v0_t_n  += 1.
+    vals    = numpy.asarray(vals)
+    in_v1   = numpy.abs(vals-v0) > numpy.abs(vals-v1)
+    v1_t_n  = numpy.count_nonzero(in_v1)
+    v0_t_n  = vals.size - v1_t_n
+    v1_t    = vals[in_v1].sum()
+    v0_t    = vals[~in_v1].sum()
     if v0_t_n > 0.:
         v0_t /= v0_t_n
     if v1_t_n > 0.:
         v1_t /= v1_t_n
-    return (v0_t, v1_t)
+    return (float(v0_t), float(v1_t))
 
 def _cluster_two_means(vals):
     (v0,v1)     = (0.,0.1)
@@ -279,33 +438,19 @@ def _cluster_two_means(vals):
     return (v0, v1)
 
 def _support_from_autocorr(auto, qmax, thr_0, thr_1, supp_file, kl=1, write=True):
-    pos     = numpy.argwhere(numpy.abs(auto-thr_0) > numpy.abs(auto-thr_1))
-    pos_set = set()
-    pos_list= []
-    kerl    = list(range(-kl,kl+1))
-    ker     = [[i,j,k] for i in kerl for j in kerl for k in kerl]
-
-    def trun(v):
-        return int(numpy.ceil(0.5*v))
+    # Voxels closer to the upper cluster, dilated by a cube of half width kl.
+    # Padding keeps voxels dilated beyond the edges of the volume.
+    significant = numpy.pad(numpy.abs(auto-thr_0) > numpy.abs(auto-thr_1), kl)
+    kernel      = numpy.ones((2*kl+1,)*3, dtype=bool)
+    pos_array   = numpy.argwhere(ndimage.binary_dilation(significant, structure=kernel))
 
-    v_trun = numpy.vectorize(trun)
-
-    for (pi, pj, pk) in pos:
-        for (ci, cj, ck) in ker:
-            pos_set.add((pi+ci, pj+cj, pk+ck))
-    for s in pos_set:
-        pos_list.append([s[0], s[1], s[2]])
-
-    pos_array = numpy.array(pos_list)
-    pos_array -= [a.min() for a in pos_array.transpose()]
-    pos_array = numpy.array([v_trun(a) for a in pos_array])
+    pos_array -= pos_array.min(axis=0)
+    pos_array = numpy.ceil(0.5*pos_array).astype(int)
 
     if write:
-        fp  = open(supp_file, "w")
-        fp.write("%d %d\n"%(qmax, len(pos_array)))
-        for p in pos_array:
-            fp.write("%d %d %d\n" % (p[0], p[1], p[2]))
-        fp.close()
+        with open(supp_file, "w") as fp:
+            fp.write("%d %d\n"%(qmax, len(pos_array)))
+            numpy.savetxt(fp, pos_array, fmt="%d")
 
     return pos_array
 
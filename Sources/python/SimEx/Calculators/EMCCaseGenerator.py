@@ -153,6 +153,45 @@ def support_from_autocorr(auto, qmax, thr_0, thr_1, kl=1, write=True):
 
     return pos_array
 
+def sparse_photons(pos, pattern):
+    """
+    Extract the pixels hit by one and by more than one photon from a dense pattern.
+
+    :param pos: Running index of the qualified detector pixels (-1 for unqualified pixels), flattened.
+    :type pos: numpy.ndarray
+
+    :param pattern: The dense photon pattern.
+    :type pattern: numpy.ndarray
+
+    :return: Indices of single photon pixels, indices of multiple photon pixels and their photon counts.
+    """
+    counts = numpy.asarray(pattern).ravel().astype(numpy.int64)
+    qualified = pos >= 0
+
+    ones = pos[qualified & (counts == 1)]
+    multiple = qualified & (counts > 1)
+
+    return ones, pos[multiple], counts[multiple]
+
+def _write_sparse_header(outf, number_of_patterns, meanPhoton):
+    """ """
+    """ Write the sparse photon file header (number of patterns and mean photon count). """
+    outf.write("%d %lf \n"%(number_of_patterns, meanPhoton))
+
+def _write_sparse_pattern(outf, pos, pattern):
+    """ """
+    """ Write one pattern to the sparse photon file.
+
+    The format is one line per pattern: "num_o o_1 ... o_n num_m m_1 c_1 ... m_n c_n".
+    """
+    ones, multiples, counts = sparse_photons(pos, pattern)
+
+    strNumO = str(len(ones))
+    ssO = ' '.join([str(i) for i in ones.tolist()])
+    strNumM = str(len(multiples))
+    ssM = ' '.join(["%d %d "%(p, c) for p, c in zip(multiples.tolist(), counts.tolist())])
+    outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
+
 
 ###############################################################
 # Convert photons into sparse format, split into multiple files
@@ -227,6 +266,47 @@ class EMCCaseGenerator(object):
 
         return v/vDenom - numpy.array([0,0,zL])
 
+    def _detectorQ(self):
+        """ """
+        """ Private method to compute the (qx,qy,qz) positions of all detector pixels at once, see placePixel().
+
+        :return: The pixel positions in row major order.
+        :rtype: numpy.ndarray, shape (number of pixels, 3)
+        """
+        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
+        x = x.flatten()
+        y = y.flatten()
+        zL = self.detectorDist / self.pixSize
+
+        vDenom = numpy.sqrt(1 + (x*x + y*y)/(zL*zL))
+
+        return numpy.stack((x/vDenom, y/vDenom, zL/vDenom - zL), axis=-1)
+
+    def _qualifiedPixels(self, q):
+        """ """
+        """ Private method to select the pixels that enter the EMC reconstruction (qmin < |q| < qmax, |qx| > 3).
+
+        :param q: The pixel positions as returned by _detectorQ().
+        :type q: numpy.ndarray
+
+        :return: Boolean selection of qualified pixels.
+        """
+        qAbs = numpy.sqrt(q[:,0]*q[:,0] + q[:,1]*q[:,1] + q[:,2]*q[:,2])
+
+        return (qAbs > self.qmin) & (qAbs < self.qmax) & (numpy.abs(q[:,0]) > 3)
+
+    def _sparsePixelIndex(self):
+        """ """
+        """ Private method to enumerate the qualified detector pixels with a running index.
+
+        :return: The running index (-1 for unqualified pixels) and the flat mask.
+        """
+        qualified = self._qualifiedPixels(self._detectorQ())
+        pos = numpy.full(qualified.shape, -1, dtype=int)
+        pos[qualified] = numpy.arange(numpy.count_nonzero(qualified))
+
+        return pos, qualified.astype(float)
+
     def readGeomFromPhotonData(self, fn,thisProcess):
         """
         Extract detector geometry from S2E photon files.
@@ -257,16 +337,15 @@ class EMCCaseGenerator(object):
         self.qmax = int(2 * self.numPixToEdge * numpy.sin(0.5*maxScattAng) / numpy.tan(maxScattAng))
 
         #Write detector to file
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
-        tempDetectorPix = [self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)]
-        qualifiedDetectorPix = [i for i in tempDetectorPix if (numpy.sqrt(i[0]*i[0] +i[1]*i[1] + i[2]*i[2])>self.qmin and numpy.sqrt(i[0]*i[0] +i[1]*i[1] + i[2]*i[2])<self.qmax and numpy.abs(i[0])>3)]
-        self.detector = numpy.array(qualifiedDetectorPix)
+        tempDetectorPix = self._detectorQ()
+        self.detector = tempDetectorPix[self._qualifiedPixels(tempDetectorPix)]
 
         # qmin defaults to 2 pixel beamstop
         self.qmin = 2
         fQmin = numpy.floor(self.qmin)
         [x,y,z] = numpy.mgrid[-fQmin:fQmin+1, -fQmin:fQmin+1, -fQmin:fQmin+1]
-        self.beamstop = numpy.array([[xx,yy,zz] for xx,yy,zz in zip(x.flat, y.flat, z.flat) if numpy.sqrt(xx*xx + yy*yy + zz*zz)<=self.qmin])
+        beamstop = numpy.stack((x.flatten(), y.flatten(), z.flatten()), axis=-1)
+        self.beamstop = beamstop[numpy.sqrt(x*x + y*y + z*z).flatten() <= self.qmin]
 
     def readGeomFromDetectorFile(self, fn="detector.dat"):
         """
@@ -286,7 +365,7 @@ class EMCCaseGenerator(object):
 
         return
 
-    def writeSparsePhotonFile(self, fileList, outFN, outFNH5Avg,thisProcess,numProcesses):
+    def writeSparsePhotonFile(self, fileList, outFN, outFNH5Avg, thisProcess, numProcesses):
         """
         Convert dense S2E file format to sparse EMC photons.dat format.
 
@@ -298,12 +377,17 @@ class EMCCaseGenerator(object):
 
         :param outFNH5Avg: Filename for averaged photon file.
         :type outFNH5Avg: str
+
+        :param thisProcess: Index of this process, it converts the thisProcess'th contiguous block of patterns.
+        :type thisProcess: int
+
+        :param numProcesses: Number of processes among which the patterns are split.
+        :type numProcesses: int
         """
 
         # Check if we deal with v0.2 file.
         if len(fileList) == 1 and h5py.File(fileList[0], 'r')['version'].value == 0.2:
-            if thisProcess==0:
-                self._writeSparsePhotonFileFromSingleH5(fileList[0], outFN, outFNH5Avg)
+            self._writeSparsePhotonFileFromSingleH5(fileList[0], outFN, outFNH5Avg, thisProcess, numProcesses)
             return
 
         # Log: destination output to file
@@ -311,22 +395,8 @@ class EMCCaseGenerator(object):
             msg = "Writing diffr output to %s"%os.path.dirname(outFN)
             _print_to_log(msg, log_file=self.runLog)
 
-        # Define in-plane detector x,y coordinates
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
-
-        # Compute qx,qy,qz positions of detector
-        zL = self.detectorDist / self.pixSize
-        tmpQ = numpy.array([self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)])
-
-        # Enumerate qualified detector pixels with a running index, currPos
-        pos = -1 + 0*x.flatten()
-        currPos = 0
-        flatMask = 0.*pos
-        for p,v in enumerate(tmpQ):
-            if numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])<self.qmax and numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])>self.qmin and numpy.abs(v[0])>3:
-                    pos[p] = currPos
-                    flatMask[p] = 1.
-                    currPos += 1
+        # Enumerate qualified detector pixels with a running index.
+        pos, flatMask = self._sparsePixelIndex()
 
         outf = open(outFN, "w")
         if thisProcess==0:
@@ -359,7 +429,7 @@ class EMCCaseGenerator(object):
             # Start stepping through diffraction images and writing them to sparse format
             msg = "Average intensities: %lf"%(totPhoton)
             _print_to_log(msg, log_file=self.runLog)
-            outf.write("%d %lf \n"%(len(fileList), meanPhoton))
+            _write_sparse_header(outf, len(fileList), meanPhoton)
 
 
         mask = flatMask.reshape(2*self.numPixToEdge+1, -1)
@@ -369,9 +439,10 @@ class EMCCaseGenerator(object):
             msg = "Converting individual data frames to sparse format %s"%("."*20)
             _print_to_log(msg, log_file=self.runLog)
 
-        for n,fn in enumerate(fileList):
-            if n % numProcesses != thisProcess:
-                continue
+        # Each process converts one contiguous block of files, so that joining the partial files in process order
+        # preserves the pattern order.
+        for n in numpy.array_split(numpy.arange(len(fileList)), numProcesses)[thisProcess]:
+            fn = fileList[n]
             #try:
             if True:
                 f = h5py.File(fn, 'r')
@@ -379,52 +450,15 @@ class EMCCaseGenerator(object):
                 if data_format_version < 0.2:
                     v = f["data/data"].value
                     avg += v
-                    temp = {"o":[], "m":[]}
-
-                    for p,vv in zip(pos, v.flat):
-                        # Todo: remove this
-                        vv = int(vv)
-                        if (p < 0) or (vv==0):
-                            pass
-                        else:
-                            if vv == 1:
-                                temp["o"].append(p)
-                            if vv > 1:
-                                temp["m"].append([p,vv])
-
-                    [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                    strNumO = str(num_o)
-                    ssO = ' '.join([str(i) for i in temp["o"]])
-                    strNumM = str(num_m)
-                    ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                    outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
+                    _write_sparse_pattern(outf, pos, v)
                     f.close()
 
                 else:
                     tasks = list(f["data"].keys())
                     for task in tasks:
                         v = f["data"][task]["data"].value
-#                        print "In %s/%s/data, found max. %f and avg %f photons." % (fn, task, v.max(), v.mean())
                         avg += v
-                        temp = {"o":[], "m":[]}
-
-                        for p,vv in zip(pos, v.flat):
-                            # Todo: remove this
-                            vv = int(vv)
-                            if (p < 0) or (vv==0):
-                                pass
-                            else:
-                                if vv == 1:
-                                    temp["o"].append(p)
-                                if vv > 1:
-                                    temp["m"].append([p,vv])
-
-                        [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                        strNumO = str(num_o)
-                        ssO = ' '.join([str(i) for i in temp["o"]])
-                        strNumM = str(num_m)
-                        ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                        outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
+                        _write_sparse_pattern(outf, pos, v)
                     f.close()
 
             #except:
@@ -445,7 +479,7 @@ class EMCCaseGenerator(object):
             outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
         outh5.close()
 
-    def _writeSparsePhotonFileFromSingleH5(self, dense_file, outFN, outFNH5Avg):
+    def _writeSparsePhotonFileFromSingleH5(self, dense_file, outFN, outFNH5Avg, thisProcess=0, numProcesses=1):
         """
         Convert dense S2E file format to sparse EMC photons.dat format.
 
@@ -457,37 +491,21 @@ class EMCCaseGenerator(object):
 
         :param outFNH5Avg: Filename for averaged photon file.
         :type outFNH5Avg: str
+
+        :param thisProcess: Index of this process, it converts the thisProcess'th contiguous block of patterns.
+        :type thisProcess: int
+
+        :param numProcesses: Number of processes among which the patterns are split.
+        :type numProcesses: int
         """
 
         # Log: destination output to file
-        msg = "Writing diffr output to %s"%outFN
-        _print_to_log(msg, log_file=self.runLog)
-
-        # Define in-plane detector x,y coordinates
-        [x,y] = numpy.mgrid[-self.numPixToEdge:self.numPixToEdge+1, -self.numPixToEdge:self.numPixToEdge+1]
+        if thisProcess==0:
+            msg = "Writing diffr output to %s"%outFN
+            _print_to_log(msg, log_file=self.runLog)
 
-        # Compute qx,qy,qz positions of detector
-        zL = self.detectorDist / self.pixSize
-        tmpQ = numpy.array([self.placePixel(i,j,zL) for i,j in zip(x.flat, y.flat)])
-
-        # Enumerate qualified detector pixels with a running index, currPos
-        pos = -1 + 0*x.flatten()
-        currPos = 0
-        flatMask = 0.*pos
-        for p,v in enumerate(tmpQ):
-            if numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])<self.qmax and numpy.sqrt(v[0]*v[0] +v[1]*v[1] + v[2]*v[2])>self.qmin and numpy.abs(v[0])>3:
-                    pos[p] = currPos
-                    flatMask[p] = 1.
-                    currPos += 1
-
-        # Compute mean photon count from the first 200 diffraction images
-        # (or total number of images, whichever is smaller)
-        # Open dense file.
-        h5_dense = h5py.File( dense_file, 'r')
-        number_of_patterns = len(list(h5_dense.keys())) - 3
-        numFilesToAvgForMeanCount = min([200, number_of_patterns])
-        meanPhoton = 0.
-        totPhoton = 0.
+        # Enumerate qualified detector pixels with a running index.
+        pos, flatMask = self._sparsePixelIndex()
 
         # Open dense file.
         h5_dense = h5py.File( dense_file, 'r')
@@ -495,49 +513,40 @@ class EMCCaseGenerator(object):
         all_keys = list(h5_dense.keys())
         relevant_keys = [k for k in all_keys if not k in excluded_keys]
         relevant_keys.sort()
-        for fn in relevant_keys[:numFilesToAvgForMeanCount]:
-            f = h5_dense[fn]
-            meanPhoton += numpy.mean((f["data/data"].value).flatten())
-            totPhoton += numpy.sum((f["data/data"].value).flatten())
-
-        meanPhoton /= 1.*numFilesToAvgForMeanCount
-        totPhoton /= 1.*numFilesToAvgForMeanCount
+        number_of_patterns = len(relevant_keys)
 
-        # Start stepping through diffraction images and writing them to sparse format
-        msg = "Average intensities: %lf"%(totPhoton)
-        _print_to_log(msg, log_file=self.runLog)
         outf = open(outFN, "w")
-        outf.write("%d %lf \n"%(number_of_patterns, meanPhoton))
+        if thisProcess==0:
+            # Compute mean photon count from the first 200 diffraction images
+            # (or total number of images, whichever is smaller)
+            numFilesToAvgForMeanCount = min([200, number_of_patterns])
+            meanPhoton = 0.
+            totPhoton = 0.
+            for fn in relevant_keys[:numFilesToAvgForMeanCount]:
+                f = h5_dense[fn]
+                meanPhoton += numpy.mean((f["data/data"].value).flatten())
+                totPhoton += numpy.sum((f["data/data"].value).flatten())
+
+            meanPhoton /= 1.*numFilesToAvgForMeanCount
+            totPhoton /= 1.*numFilesToAvgForMeanCount
+
+            # Start stepping through diffraction images and writing them to sparse format
+            msg = "Average intensities: %lf"%(totPhoton)
+            _print_to_log(msg, log_file=self.runLog)
+            _write_sparse_header(outf, number_of_patterns, meanPhoton)
+
+            msg = "Converting individual data frames to sparse format %s"%("."*20)
+            _print_to_log(msg, log_file=self.runLog)
+
         mask = flatMask.reshape(2*self.numPixToEdge+1, -1)
         avg = 0.*mask
 
-        msg = "Converting individual data frames to sparse format %s"%("."*20)
-        _print_to_log(msg, log_file=self.runLog)
-
-        for n,fn in enumerate(h5_dense.keys()):
+        for n in numpy.array_split(numpy.arange(number_of_patterns), numProcesses)[thisProcess]:
+            fn = relevant_keys[n]
             try:
-                f = h5_dense[fn]
-                v = f["data/data"].value
+                v = h5_dense[fn]["data/data"].value
                 avg += v
-                temp = {"o":[], "m":[]}
-
-                for p,vv in zip(pos, v.flat):
-                    # Todo: remove this
-                    vv = int(vv)
-                    if (p < 0) or (vv==0):
-                        pass
-                    else:
-                        if vv == 1:
-                            temp["o"].append(p)
-                        if vv > 1:
-                            temp["m"].append([p,vv])
-
-                [num_o, num_m] = [len(temp["o"]), len(temp["m"])]
-                strNumO = str(num_o)
-                ssO = ' '.join([str(i) for i in temp["o"]])
-                strNumM = str(num_m)
-                ssM = ' '.join(["%d %d "%(i[0], i[1]) for i in temp["m"]])
-                outf.write(' '.join([strNumO, ssO, strNumM, ssM]) + "\n")
+                _write_sparse_pattern(outf, pos, v)
             except:
                 msg = "Failed to read pattern #%d %s." % (n, fn)
                 _print_to_log(msg, log_file=self.runLog)
@@ -552,7 +561,8 @@ class EMCCaseGenerator(object):
         # Write average photon and mask patterns to file
         outh5 = h5py.File(outFNH5Avg, 'w')
         outh5.create_dataset("average", data=avg, compression="gzip", compression_opts=9)
-        outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
+        if thisProcess==0:
+            outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
         outh5.close()
 
     def showDetector(self):
@@ -21,8 +21,10 @@
 ##########################################################################
 
 import h5py
+import multiprocessing
 import numpy
 import os
+import shutil
 import subprocess,shlex
 import tempfile
 import time
@@ -34,6 +36,9 @@ from SimEx.Utilities import IOUtilities
 from SimEx.Utilities import ParallelUtilities
 from SimEx.Utilities.EntityChecks import checkAndSetInstance
 
+# Compression of the iteration history. Level 9 costs much more time than it saves space on the smooth intensities.
+_HISTORY_COMPRESSION = {"compression" : "gzip", "compression_opts" : 1, "shuffle" : True}
+
 class EMCOrientation(AbstractPhotonAnalyzer):
     """
     :class EMCOrientation: Representing photon data analysis for orientation of 2D diffraction patterns to a 3D diffraction volume.
@@ -271,15 +276,13 @@ class EMCOrientation(AbstractPhotonAnalyzer):
 
     def _join_photon_files(self,numProcesses):
 
-        outf = open(self._sparsePhotonFile, "w")
-
-        for n in range(0,numProcesses):
-            fname=self._sparsePhotonFile + "_"+str(n)
-            with open(fname) as infile:
-                    for line in infile:
-                        outf.write(line)
-            os.system("rm %s " % fname)
-        outf.close()
+        # Concatenate the partial sparse photon files in process order.
+        with open(self._sparsePhotonFile, "wb") as outf:
+            for n in range(0,numProcesses):
+                fname=self._sparsePhotonFile + "_"+str(n)
+                with open(fname, "rb") as infile:
+                    shutil.copyfileobj(infile, outf)
+                os.remove(fname)
 
         outh5 = h5py.File(self._avgPatternFile, 'w')
         for n in range(0,numProcesses):
@@ -290,7 +293,8 @@ class EMCOrientation(AbstractPhotonAnalyzer):
                 avg = f["average"].value
             else:
                 avg += f["average"].value
-            os.system("rm %s " % fname)
+            f.close()
+            os.remove(fname)
 
         outh5.create_dataset("average", data=avg, compression="gzip", compression_opts=9)
         outh5.create_dataset("mask", data=mask, compression="gzip", compression_opts=9)
@@ -300,8 +304,7 @@ class EMCOrientation(AbstractPhotonAnalyzer):
     def _prepare_photon_files(self,comm=None):
         #thisProcess = comm.rank
         thisProcess = 0
-        #numProcesses = comm.size
-        numProcesses = 1
+        numProcesses = self.parameters.number_of_processes
 
         # Prepare for reading input.
         if os.path.isdir(self.input_path):
@@ -319,9 +322,17 @@ class EMCOrientation(AbstractPhotonAnalyzer):
             os.system("touch %s" % self._lockFile)
             gen.writeDetectorToFile(filename=self._detectorFile)
 
-        gen.writeSparsePhotonFile(photonFiles, self._sparsePhotonFile+ "_"+str(thisProcess),
-                                               self._avgPatternFile + "_"+str(thisProcess),
-                                               thisProcess,numProcesses)
+        # Each process converts a contiguous block of patterns into its own partial file.
+        jobs = [(photonFiles,
+                 self._sparsePhotonFile+ "_"+str(n),
+                 self._avgPatternFile + "_"+str(n),
+                 n, numProcesses) for n in range(numProcesses)]
+
+        if numProcesses == 1:
+            gen.writeSparsePhotonFile(*jobs[0])
+        else:
+            with multiprocessing.Pool(processes=numProcesses) as pool:
+                pool.starmap(gen.writeSparsePhotonFile, jobs)
         #comm.Barrier()
 
         if thisProcess == 0:
@@ -436,6 +447,10 @@ class EMCOrientation(AbstractPhotonAnalyzer):
         intensL = 2*gen.qmax + 1
         iter_num = 1
         currQuat = initial_number_of_quaternions
+        previous_intensities = None
+
+        # Keep the output file open for all iterations.
+        f = h5py.File(outFile, "a")
 
         try:
             while(currQuat <= max_number_of_quaternions):
@@ -453,13 +468,13 @@ class EMCOrientation(AbstractPhotonAnalyzer):
                                 log_file=self._outputLog)
 
                     # Here is the actual timed EMC iteration, which calls the EMC.c code.
-                    start_time = time.clock()
+                    start_time = time.time()
 
                     #command_sequence = ['EMC.x', '1']
                     command_sequence = ['EMC', '1']
                     process_handle = subprocess.Popen(command_sequence)
                     process_handle.wait()
-                    time_taken = time.clock() - start_time
+                    time_taken = time.time() - start_time
                     _print_to_log("Took %lf s"%(time_taken),
                                 log_file=self._outputLog)
 
@@ -471,51 +486,39 @@ class EMCOrientation(AbstractPhotonAnalyzer):
                     data_info = numpy.fromfile("mutual_info.dat", sep=" ")
                     most_likely_orientations = numpy.fromfile("most_likely_orientations.dat", sep=" ")
 
-                    if(os.path.isfile("start_intensity.dat")):
-                        intens1 = numpy.fromfile("start_intensity.dat", sep=" ")
-                        diff = numpy.sqrt(numpy.mean(numpy.abs(gen.intensities.flatten()-intens1)**2))
+                    # The previous intensities are kept in memory, the start intensities are only read when resuming.
+                    if previous_intensities is None and os.path.isfile("start_intensity.dat"):
+                        previous_intensities = numpy.fromfile("start_intensity.dat", sep=" ")
+                    if previous_intensities is not None:
+                        diff = numpy.sqrt(numpy.mean(numpy.abs(gen.intensities.flatten()-previous_intensities.flatten())**2))
                     else:
                         diff = 2.*min_error
+                    previous_intensities = gen.intensities
 
-                    f = h5py.File(outFile, "a")
-                    gg = f["history/intensities"]
+                    iteration = "%04d"%(iter_num + offset_iter)
                     if detailed_output:
-                        gg.create_dataset("%04d"%(iter_num + offset_iter), data=gen.intensities, compression="gzip", compression_opts=9)
-                    try:
-                        f.create_dataset("data/data", data=gen.intensities, compression="gzip", compression_opts=9)
-                    except:
-                        temp = f["data/data"]
-                        temp[...] = gen.intensities
-
-                    gg = f["history/error"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=diff)
+                        f["history/intensities"].create_dataset(iteration, data=gen.intensities, **_HISTORY_COMPRESSION)
+                    _setDataset(f, "data/data", gen.intensities)
+
+                    f["history/error"].create_dataset(iteration, data=diff)
                     _print_to_log("rms change in intensities %e"%(diff),
                                 log_file=self._outputLog)
 
-                    gg = f["history/angle"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=most_likely_orientations, compression="gzip", compression_opts=9)
-                    try:
-                        f.create_dataset("data/angle", data=most_likely_orientations, compression="gzip", compression_opts=9)
-                    except:
-                        temp = f["data/angle"]
-                        temp[...] = most_likely_orientations
-
-                    gg = f["history/mutual_info"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=data_info)
+                    f["history/angle"].create_dataset(iteration, data=most_likely_orientations, **_HISTORY_COMPRESSION)
+                    _setDataset(f, "data/angle", most_likely_orientations)
 
-                    gg = f["history/quaternion"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=currQuat)
+                    f["history/mutual_info"].create_dataset(iteration, data=data_info)
+                    f["history/quaternion"].create_dataset(iteration, data=currQuat)
+                    f["history/time"].create_dataset(iteration, data=time_taken)
 
-                    gg = f["history/time"]
-                    gg.create_dataset("%04d"%(iter_num + offset_iter), data=time_taken)
+                    # Leave a consistent file behind should the run be interrupted.
+                    f.flush()
 
-                    f.close()
+                    with open(self._outputLog, "a") as log:
+                        log.write("%e\t %lf\n"%(diff, time_taken))
 
-                    f = open(self._outputLog, "a")
-                    f.write("%e\t %lf\n"%(diff, time_taken))
-                    f.close()
-
-                    os.system("cp finish_intensity.dat start_intensity.dat")
+                    # Hand over to the next iteration by renaming instead of copying.
+                    os.replace("finish_intensity.dat", "start_intensity.dat")
 
                     _print_to_log("Iteration number %d completed"%(iter_num),
                                 log_file=self._outputLog)
@@ -523,17 +526,31 @@ class EMCOrientation(AbstractPhotonAnalyzer):
 
                 currQuat += 1
 
+            # Restore the final intensities under their original name.
+            if os.path.isfile("start_intensity.dat") and not os.path.isfile("finish_intensity.dat"):
+                shutil.copyfile("start_intensity.dat", "finish_intensity.dat")
+
             _print_to_log("All EMC iterations completed", log_file=self._outputLog)
 
-            os.chdir(cwd)
             #MPI.Finalize()
             return 0
 
         except:
-            os.chdir(cwd)
             #MPI.Finalize()
             return 1
 
+        finally:
+            f.close()
+            os.chdir(cwd)
+
+def _setDataset(h5, name, data):
+    """ """
+    """ Private (hidden) utility to create a dataset or overwrite it if it exists. """
+    if name in h5:
+        h5[name][...] = data
+    else:
+        h5.create_dataset(name, data=data, **_HISTORY_COMPRESSION)
+
 def _checkPaths(run_files_path, tmp_files_path):
     """ """
     """ Private (hidden) utility to check validity of paths given to constructor. """
@@ -21,13 +21,18 @@
 ##########################################################################
 
 import h5py
+import hashlib
+import multiprocessing
 import os
 import re
 import numpy
+import shutil
 import subprocess
 
 from SimEx.Calculators.AbstractPhotonDiffractor import AbstractPhotonDiffractor
 from SimEx.Parameters.AbstractCalculatorParameters import AbstractCalculatorParameters
+from SimEx.Utilities.EntityChecks import checkAndSetInstance
+from SimEx.Utilities.ResultCache import ResultCache
 
 class PlasmaXRTSCalculator(AbstractPhotonDiffractor):
     """
@@ -131,41 +136,8 @@ class PlasmaXRTSCalculator(AbstractPhotonDiffractor):
         if self.parameters.source_spectrum == 'PROP':
             self._serializeSourceSpectrum()
 
-        #pwd = os.getcwd()
-
-        # Setup command sequence and issue the system call.
-        # Make sure to cd to correct directory where input deck is located.
-        command_sequence = ['xrs']
-
-        process = subprocess.Popen( command_sequence, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.parameters._tmp_dir )
-
-        # Catch stdout and stderr, wait until process terminates.
-        out, err = process.communicate(input=None)
-
-        # Error handling.
-        if not err == b'':
-            print (err)
-            raise RuntimeError
-        # Check if data was produced.
-        path_to_data = os.path.join( self.parameters._tmp_dir, 'xrts_out.txt' )
-        if not os.path.isfile( path_to_data ):
-            raise IOError
-
-        # Store output internally.
-        self.__run_log = out.decode('utf-8')
-
-        # Write to tmp_dir.
-        with open( os.path.join( self.parameters._tmp_dir ,'xrts.log'), 'w') as log_file_handle:
-                log_file_handle.write(out.decode('utf-8'))
-
-        # Store data internally.
-        self.__run_data = numpy.loadtxt( path_to_data )
-
-        # Static data.
-        self.__static_data = _parseStaticData( self.__run_log )
-
-        # Cd back to where we came from.
-        #os.chdir( pwd )
+        # Run xrs in the directory of the input deck.
+        self.__run_log, self.__run_data, self.__static_data = _runXRS( self.parameters._tmp_dir )
 
     @property
     def data(self):
@@ -293,14 +265,150 @@ class PlasmaXRTSCalculator(AbstractPhotonDiffractor):
     def _serializeSourceSpectrum(self):
         """ Write the source spectrum to a file on disk. """
 
-        source_spectrum_data = self._input_data['source_spectrum']
-        source_spectrum_path = os.path.join( self.parameters._tmp_dir, 'source_spectrum.txt')
+        _writeSourceSpectrum( self.parameters._tmp_dir, self._input_data['source_spectrum'] )
+
+def _writeSourceSpectrum(tmp_dir, source_spectrum_data):
+    """ """
+    source_spectrum_path = os.path.join( tmp_dir, 'source_spectrum.txt')
+
+    try:
+        numpy.savetxt( source_spectrum_path, source_spectrum_data, delimiter='\t' )
+    except:
+        print("Source spectrum could not be saved. Please check temporary directory %s exists. Backtrace follows." % (tmp_dir))
+        raise
+
+def runBatch(parameters, number_of_processes=1, cache=None, source_spectrum=None):
+    """ Evaluate the xrts backengine for many parameter sets, e.g. a scan over temperatures and densities.
+
+    The input decks are written to separate temporary directories and the xrs runs are distributed over a process
+    pool. Identical input decks are computed only once. With a cache, the output of each input deck is kept across
+    calls. Temporary directories are removed after their output has been read.
+
+    :param parameters: The parameter sets to evaluate.
+    :type parameters: list of PlasmaXRTSCalculatorParameters
+
+    :param number_of_processes: Number of concurrent xrs processes (default 1).
+    :type number_of_processes: int
+
+    :param cache: Cache of xrs outputs, keyed by the input deck (default None, i.e. no caching).
+    :type cache: ResultCache
+
+    :param source_spectrum: The source spectrum (columns: energy shift, spectral density) for parameter sets with source_spectrum='PROP'.
+    :type source_spectrum: numpy.array
+
+    :return: The dynamic data (shape (number of parameter sets, number of energies, number of columns), the same columns as PlasmaXRTSCalculator.data) and the static data (dict of arrays with one entry per parameter set).
+    :rtype: tuple
+
+    """
+    parameters = [checkAndSetParameters(p) for p in parameters]
+    number_of_processes = checkAndSetInstance(int, number_of_processes, 1)
+    cache = checkAndSetInstance(ResultCache, cache, None)
+
+    if number_of_processes < 1:
+        raise ValueError("The parameter 'number_of_processes' must be a positive integer.")
+
+    # Write all input decks.
+    tmp_dirs = []
+    for p in parameters:
+        p._serialize()
+        if p.source_spectrum == 'PROP':
+            if source_spectrum is None:
+                raise ValueError("A source spectrum is required for parameters with source_spectrum='PROP'.")
+            _writeSourceSpectrum(p._tmp_dir, source_spectrum)
+        tmp_dirs.append(p._tmp_dir)
+
+    # Run each distinct input deck once.
+    keys = [_inputDeckKey(tmp_dir) for tmp_dir in tmp_dirs]
+    unique_dirs = {}
+    for key, tmp_dir in zip(keys, tmp_dirs):
+        unique_dirs.setdefault(key, tmp_dir)
+
+    try:
+        jobs = [key for key, tmp_dir in unique_dirs.items()
+                if cache is None or not cache.fetch(key, tmp_dir)]
+
+        if number_of_processes == 1 or len(jobs) < 2:
+            outputs = [_runXRS(unique_dirs[key]) for key in jobs]
+        else:
+            with multiprocessing.Pool(processes=min(number_of_processes, len(jobs))) as pool:
+                outputs = pool.map(_runXRS, [unique_dirs[key] for key in jobs])
+
+        if cache is not None:
+            for key in jobs:
+                cache.store(key, unique_dirs[key])
+
+        results = dict(zip(jobs, outputs))
+        for key, tmp_dir in unique_dirs.items():
+            if key not in results:
+                results[key] = _readXRSOutput(tmp_dir)
+
+    finally:
+        for tmp_dir in tmp_dirs:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    run_data = [results[key][1] for key in keys]
+    if len(set(d.shape for d in run_data)) > 1:
+        raise ValueError("All parameter sets must have the same energy range to stack their results.")
+
+    static_data = dict((name, numpy.array([results[key][2][name] for key in keys]))
+                       for name in results[keys[0]][2].keys()) if keys else {}
+
+    return numpy.array(run_data), static_data
+
+def _inputDeckKey(tmp_dir):
+    """ """
+    """ Hash the input deck and source spectrum in the given directory. """
+    hasher = hashlib.sha256()
+    hasher.update(b'PlasmaXRTSCalculator')
+    for name in ['input.dat', 'source_spectrum.txt']:
+        path = os.path.join(tmp_dir, name)
+        if os.path.isfile(path):
+            hasher.update(name.encode('utf-8'))
+            with open(path, 'rb') as file_handle:
+                hasher.update(file_handle.read())
+
+    return hasher.hexdigest()
+
+def _runXRS(tmp_dir):
+    """ """
+    """ Run xrs on the input deck in the given directory.
+
+    :return: The run log, the dynamic data, and the static data.
+    :rtype: tuple
+
+    """
+    # Setup command sequence and issue the system call.
+    # Make sure to cd to correct directory where input deck is located.
+    command_sequence = ['xrs']
+
+    process = subprocess.Popen( command_sequence, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tmp_dir )
+
+    # Catch stdout and stderr, wait until process terminates.
+    out, err = process.communicate(input=None)
+
+    # Error handling.
+    if not err == b'':
+        print (err)
+        raise RuntimeError
+    # Check if data was produced.
+    if not os.path.isfile( os.path.join( tmp_dir, 'xrts_out.txt' ) ):
+        raise IOError
+
+    # Write to tmp_dir.
+    with open( os.path.join( tmp_dir ,'xrts.log'), 'w') as log_file_handle:
+            log_file_handle.write(out.decode('utf-8'))
+
+    return _readXRSOutput(tmp_dir)
+
+def _readXRSOutput(tmp_dir):
+    """ """
+    """ Read the run log, the dynamic data, and the static data of an xrs run. """
+    with open( os.path.join( tmp_dir, 'xrts.log' ), 'r') as log_file_handle:
+        run_log = log_file_handle.read()
+
+    run_data = numpy.loadtxt( os.path.join( tmp_dir, 'xrts_out.txt' ) )
 
-        try:
-            numpy.savetxt( source_spectrum_path, source_spectrum_data, delimiter='\t' )
-        except:
-            print("Source spectrum could not be saved. Please check temporary directory %s exists. Backtrace follows.")
-            raise
+    return run_log, run_data, _parseStaticData( run_log )
 
 def _parseStaticData(data_string):
         """ """
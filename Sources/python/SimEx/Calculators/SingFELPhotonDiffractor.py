@@ -27,12 +27,15 @@ from pysingfel.diffraction import calculate_molecularFormFactorSq
 from pysingfel.particle import Particle
 from pysingfel.radiationDamage import generateRotations, rotateParticle
 from pysingfel.toolbox import convert_to_poisson
+from scipy.interpolate import CubicSpline
 import copy
 import h5py
+import numpy
 import os
 import subprocess
 import shlex
 import sys
+import traceback
 
 from SimEx.Utilities.Units import electronvolt, meter, joule
 from SimEx.Calculators.AbstractPhotonDiffractor import AbstractPhotonDiffractor
@@ -121,6 +124,9 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
             '/params/info',
         ]
 
+        # Pattern files written by the last call to backengine().
+        self.__produced_files = None
+
     def expectedData(self):
         """ Query for the data expected by the Diffractor. """
         return self.__expected_data
@@ -144,6 +150,20 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
     def backengine(self):
         """ This method drives the backengine singFEL."""
 
+        if not os.path.isdir(self.output_path):
+            os.makedirs(self.output_path)
+
+        # Keep track of the pattern files written by this run.
+        file_stamps = _fileStamps(self.output_path)
+        status = self._backengine()
+        self.__produced_files = _changedFiles(self.output_path, file_stamps)
+
+        return status
+
+    def _backengine(self):
+        """ """
+        """ Run singFEL or, for pdb samples, pysingfel. """
+
         uniform_rotation = self.parameters.uniform_rotation
         calculate_Compton = int(self.parameters.calculate_Compton)
         slice_interval = self.parameters.slice_interval
@@ -335,6 +355,9 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
                 pattern_indices[mpi_size * number_of_patterns_per_core
                                 + mpi_rank])
 
+        if self.parameters.consolidate_output:
+            return self._runConsolidated(mpi_comm, initial_particle, quaternions, detector, beam, rank_indices)
+
         # Setup the output file.
         outputName = self.__output_dir + '/diffr_out_' + '{0:07}'.format(
             mpi_comm.Get_rank() + 1) + '.h5'
@@ -343,36 +366,20 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
             os.remove(outputName)
 
         output_is_ready = False
+        patterns = _diffractionPatterns(initial_particle,
+                                        quaternions[rank_indices],
+                                        detector,
+                                        beam,
+                                        self.parameters.orientation_batch_size)
         # Loop over assigned tasks
-        for pattern_index in rank_indices:
+        for pattern_index, (detector_counts, detector_intensity) in zip(rank_indices, patterns):
 
             # Setup the output hdf5 file if not already done.
             if not output_is_ready:
                 prepH5(outputName)
                 output_is_ready = True
 
-            # Make local copy of the sample.
-            particle = copy.deepcopy(initial_particle)
-
-            # Rotate particle.
             quaternion = quaternions[pattern_index, :]
-            rotateParticle(quaternion, particle)
-
-            # Calculate the diffraction intensity.
-            detector_intensity = calculate_molecularFormFactorSq(
-                particle, detector)
-
-            # Correct for solid angle
-            detector_intensity *= detector.solidAngle
-
-            # Correct for polarization
-            detector_intensity *= detector.PolarCorr
-
-            # Multiply by photon fluence.
-            detector_intensity *= beam.get_photonsPerPulsePerArea()
-
-            # Poissonize.
-            detector_counts = convert_to_poisson(detector_intensity)
 
             # Save to h5 file.
             saveAsDiffrOutFile(
@@ -386,12 +393,107 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
                 beam,
             )
 
-            del particle
+        mpi_comm.Barrier()
+
+        return 0
+
+    def _runConsolidated(self, mpi_comm, initial_particle, quaternions, detector, beam, rank_indices):
+        """ """
+        """ Calculate the patterns assigned to this rank and send them to rank 0, which writes all patterns into one file.
+
+        Ranks send each batch of patterns while calculating the next one, so at most two batches per rank are held in memory. Rank 0 writes the batches received so far in between calculating its own. If any rank fails, all ranks are aborted.
+        """
+        # Local import of MPI to avoid premature call to MPI.init().
+        from mpi4py import MPI
+
+        mpi_rank = mpi_comm.Get_rank()
+        batch_size = self.parameters.orientation_batch_size
+        rank_batches = [rank_indices[i:i+batch_size] for i in range(0, len(rank_indices), batch_size)]
+
+        def calculate(batch):
+            patterns = _diffractionPatterns(initial_particle, quaternions[batch], detector, beam, batch_size)
+            return [(pattern_index, detector_counts, detector_intensity, quaternions[pattern_index, :])
+                    for pattern_index, (detector_counts, detector_intensity) in zip(batch, patterns)]
+
+        if mpi_rank != 0:
+            request = None
+            for batch in rank_batches:
+                try:
+                    results = calculate(batch)
+                except:
+                    # Tell rank 0 to stop waiting for the patterns of this rank.
+                    mpi_comm.send(_CONSOLIDATE_FAILED, dest=0, tag=_CONSOLIDATE_TAG)
+                    raise
+                # Wait for the previous batch, at most one batch is in flight.
+                if request is not None:
+                    request.wait()
+                request = mpi_comm.isend(results, dest=0, tag=_CONSOLIDATE_TAG)
+            if request is not None:
+                request.wait()
+            mpi_comm.Barrier()
+            return 0
+
+        outputName = self.output_path + '.h5'
+        if os.path.exists(outputName):
+            os.remove(outputName)
+
+        h5 = None
+        def write(results):
+            nonlocal h5
+            for pattern_index, detector_counts, detector_intensity, quaternion in results:
+                if h5 is None:
+                    prepH5(outputName)
+                    h5 = h5py.File(outputName, 'a')
+                    _saveConsolidatedParameters(h5, detector, beam)
+                    _createConsolidatedDatasets(h5,
+                                                self.parameters.number_of_diffraction_patterns,
+                                                detector_counts,
+                                                detector_intensity,
+                                                self.parameters.compression)
+
+                # Patterns are stored in the order of their index.
+                _writeConsolidatedPattern(h5, pattern_index, pattern_index + 1, detector_counts, detector_intensity, quaternion)
+
+        def receive():
+            status = MPI.Status()
+            results = mpi_comm.recv(source=MPI.ANY_SOURCE, tag=_CONSOLIDATE_TAG, status=status)
+            if results is _CONSOLIDATE_FAILED:
+                raise RuntimeError("Rank %d failed to calculate its diffraction patterns." % status.Get_source())
+            return results
+
+        number_to_receive = self.parameters.number_of_diffraction_patterns - len(rank_indices)
+        try:
+            try:
+                for batch in rank_batches:
+                    write(calculate(batch))
+
+                    # Write what the other ranks sent meanwhile.
+                    while number_to_receive > 0 and mpi_comm.Iprobe(source=MPI.ANY_SOURCE, tag=_CONSOLIDATE_TAG):
+                        results = receive()
+                        number_to_receive -= len(results)
+                        write(results)
+
+                while number_to_receive > 0:
+                    results = receive()
+                    number_to_receive -= len(results)
+                    write(results)
+            finally:
+                if h5 is not None:
+                    h5.close()
+        except:
+            # The other ranks would wait forever in send() or Barrier().
+            traceback.print_exc()
+            sys.stderr.flush()
+            mpi_comm.Abort(1)
 
         mpi_comm.Barrier()
 
         return 0
 
+    def cacheOutputs(self):
+        """ Query for the outputs, i.e. the pattern directory and the linking file written by saveH5(). """
+        return [self.output_path, self.output_path + ".h5"]
+
     @property
     def data(self):
         """ Query for the field data. """
@@ -409,7 +511,7 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
     def saveH5(self):
         """ """
         """
-        Private method to save the object to a file. Creates links to h5 files that all contain only one pattern.
+        Private method to save the object to a file. Creates links to h5 files that all contain only one pattern, or, if parameters.consolidate_output is set, copies all patterns into one file.
 
         :param output_path: The file where to save the object's data.
         :type output_path: string, default b
@@ -418,15 +520,25 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
         # Path where individual h5 files are located.
         path_to_files = self.output_path
 
+        if self.parameters.consolidate_output:
+            individual_files = self.__produced_files
+            # Without a backengine run on this object, take all pattern files.
+            if individual_files is None:
+                individual_files = _patternFiles(path_to_files)
+
+            # The pdb backengine already wrote the consolidated file.
+            if individual_files:
+                _consolidateFiles(individual_files, self.output_path + ".h5", self.parameters.compression)
+                for ind_file in individual_files:
+                    os.remove(ind_file)
+                self.__produced_files = []
+            return
+
         # Setup new file.
         with h5py.File(self.output_path + ".h5", "w") as h5_outfile:
 
             # Files to read from.
-            individual_files = [
-                os.path.join(path_to_files, f)
-                for f in os.listdir(path_to_files)
-            ]
-            individual_files.sort()
+            individual_files = _patternFiles(path_to_files)
 
             # Keep track of global parameters being linked.
             global_parameters = False
@@ -461,5 +573,244 @@ class SingFELPhotonDiffractor(AbstractPhotonDiffractor):
                             relative_link_target, ds_path)
 
 
+# MPI tag of the patterns sent to rank 0 in consolidated runs.
+_CONSOLIDATE_TAG = 17
+# Message sent to rank 0 in place of patterns by a rank that failed.
+_CONSOLIDATE_FAILED = None
+
+def _fileStamps(path):
+    """ """
+    """ Get modification time and size of the files in a directory. """
+    if not os.path.isdir(path):
+        return {}
+
+    stamps = {}
+    for f in os.listdir(path):
+        stat = os.stat(os.path.join(path, f))
+        stamps[f] = (stat.st_mtime_ns, stat.st_size)
+
+    return stamps
+
+def _changedFiles(path, file_stamps):
+    """ """
+    """ Get the h5 files in a directory that were created or modified since the given file stamps were taken. """
+    return [os.path.join(path, f)
+            for f, stamp in sorted(_fileStamps(path).items())
+            if f.split('.')[-1] == 'h5' and file_stamps.get(f) != stamp]
+
+def _patternFiles(path):
+    """ """
+    """ Get all h5 files in a directory, an empty list if the directory does not exist. """
+    if not os.path.isdir(path):
+        return []
+
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.split('.')[-1] == 'h5')
+
+def _diffractionPatterns(initial_particle, quaternions, detector, beam, batch_size=1):
+    """ """
+    """ Calculate the diffraction patterns of the particle in the given orientations.
+
+    :param initial_particle: The particle in its reference orientation, it is not modified.
+    :type initial_particle: pysingfel.particle.Particle
+
+    :param quaternions: The orientations, shape (number of patterns, 4).
+    :type quaternions: numpy.array
+
+    :param batch_size: Number of orientations to evaluate at once (default 1, i.e. one pattern at a time with pysingfel).
+    :type batch_size: int
+
+    :return: Iterator over the poissonized and the expected photon counts of each pattern.
+    """
+    for start in range(0, len(quaternions), batch_size):
+        batch = quaternions[start:start+batch_size]
+
+        if batch_size == 1:
+            # Rotation replaces the atom positions, a shallow copy leaves the initial particle intact.
+            particle = copy.copy(initial_particle)
+            rotateParticle(batch[0], particle)
+            intensities = [calculate_molecularFormFactorSq(particle, detector)]
+        else:
+            intensities = _molecularFormFactorSqBatch(initial_particle, batch, detector)
+
+        for detector_intensity in intensities:
+            # Correct for solid angle
+            detector_intensity *= detector.solidAngle
+
+            # Correct for polarization
+            detector_intensity *= detector.PolarCorr
+
+            # Multiply by photon fluence.
+            detector_intensity *= beam.get_photonsPerPulsePerArea()
+
+            # Poissonize.
+            detector_counts = convert_to_poisson(detector_intensity)
+
+            yield detector_counts, detector_intensity
+
+def _molecularFormFactorSqBatch(particle, quaternions, detector, max_elements=1<<22):
+    """ """
+    """ Calculate the molecular form factor squared on the detector for a batch of orientations.
+
+    Instead of rotating the particle, the reciprocal space coordinates of the detector pixels are rotated backwards, so all orientations share one set of atom positions and atomic form factors.
+
+    :param particle: The particle in its reference orientation.
+    :type particle: pysingfel.particle.Particle
+
+    :param quaternions: The orientations, shape (batch size, 4).
+    :type quaternions: numpy.array
+
+    :param detector: The initialized detector.
+    :type detector: pysingfel.detector.Detector
+
+    :param max_elements: Maximum number of phase factors held in memory at once (default 2**22).
+    :type max_elements: int
+
+    :return: The form factor squared, shape (batch size, py, px).
+    """
+    q_xyz = detector.q_xyz.reshape(-1, 3)
+    number_of_pixels = q_xyz.shape[0]
+    number_of_orientations = len(quaternions)
+
+    # rotateParticle maps r -> R r, so q.(R r) = (R^T q).r, i.e. the row vectors q are mapped to q R.
+    rotations = _rotationMatrices(particle, quaternions)
+    q_rotated = numpy.einsum('pi,bij->bpj', q_xyz, rotations).reshape(-1, 3)
+
+    # Atomic form factors depend on |q| only, sin(theta)/lambda in 1/Angstrom.
+    stol = detector.q_mod.ravel() * 1e-10 / 2.
+    form_factor_table = numpy.atleast_2d(particle.ffTable)
+
+    atom_positions = particle.atomPos
+    split_index = particle.SplitIdx
+    atoms_per_chunk = max(1, max_elements // (number_of_orientations*number_of_pixels))
+
+    form_factor = numpy.zeros(number_of_orientations*number_of_pixels, dtype=numpy.complex128)
+    for atom_type in range(particle.numAtomTypes):
+        f_hkl = CubicSpline(particle.qSample, form_factor_table[atom_type])(stol)
+
+        # Sum of phase factors of all atoms of this type, in chunks of atoms.
+        structure_factor = numpy.zeros(number_of_orientations*number_of_pixels, dtype=numpy.complex128)
+        for start in range(split_index[atom_type], split_index[atom_type+1], atoms_per_chunk):
+            stop = min(start+atoms_per_chunk, split_index[atom_type+1])
+            phase = numpy.dot(q_rotated, atom_positions[start:stop].T)
+            phase *= 2*numpy.pi
+            structure_factor += numpy.exp(1j*phase).sum(axis=1)
+
+        form_factor += numpy.tile(f_hkl, number_of_orientations) * structure_factor
+
+    intensity = numpy.abs(form_factor)**2
+
+    return intensity.reshape((number_of_orientations,) + detector.q_mod.shape)
+
+def _rotationMatrices(particle, quaternions):
+    """ """
+    """ Get the rotation matrices of the quaternions in the convention of rotateParticle by rotating the unit vectors. """
+    probe = copy.copy(particle)
+    rotations = numpy.empty((len(quaternions), 3, 3))
+    for i, quaternion in enumerate(quaternions):
+        probe.atomPos = numpy.eye(3)
+        rotateParticle(quaternion, probe)
+        # Rows of the rotated unit vectors are the columns of the rotation matrix.
+        rotations[i] = probe.atomPos.T
+
+    return rotations
+
+def _saveConsolidatedParameters(h5, detector, beam):
+    """ """
+    """ Write detector and beam parameters as saveAsDiffrOutFile does. """
+    h5.create_dataset('params/geom/detectorDist', data=detector.get_detector_dist())
+    h5.create_dataset('params/geom/pixelWidth', data=detector.get_pix_width())
+    h5.create_dataset('params/geom/pixelHeight', data=detector.get_pix_height())
+    h5.create_dataset('params/geom/mask', data=numpy.ones((detector.py, detector.px)))
+    h5.create_dataset('params/beam/focusArea', data=beam.get_focus_area())
+    h5.create_dataset('params/beam/photonEnergy', data=beam.get_photon_energy())
+    h5.create_dataset('params/beam/photons', data=beam.get_photonsPerPulse())
+
+def _createConsolidatedDatasets(h5, number_of_patterns, detector_counts, detector_intensity, compression=None):
+    """ """
+    """ Create the datasets holding all patterns, chunked by pattern.
+
+    :param h5: The open output file.
+    :type h5: h5py.File
+
+    :param number_of_patterns: Number of patterns to store.
+    :type number_of_patterns: int
+
+    :param detector_counts: A poissonized pattern, sets shape and type of '/data/data'.
+    :type detector_counts: numpy.array
+
+    :param detector_intensity: An expected pattern, sets shape and type of '/data/diffr'.
+    :type detector_intensity: numpy.array
+
+    :param compression: HDF5 compression filter (default None).
+    :type compression: str
+    """
+    shape = detector_counts.shape
+    for name, pattern in [('data', detector_counts), ('diffr', detector_intensity)]:
+        h5.create_dataset('data/%s' % (name),
+                          shape=(number_of_patterns,) + shape,
+                          dtype=pattern.dtype,
+                          chunks=(1,) + shape,
+                          compression=compression,
+                          )
+    h5.create_dataset('data/angle', shape=(number_of_patterns, 4), dtype=numpy.float64)
+    # Pattern id (the 7 digit group name in the linked layout) of each row.
+    h5.create_dataset('data/pattern_id', shape=(number_of_patterns,), dtype=numpy.int64)
+
+def _writeConsolidatedPattern(h5, row, pattern_id, detector_counts, detector_intensity, quaternion):
+    """ """
+    h5['data/data'][row] = detector_counts
+    h5['data/diffr'][row] = detector_intensity
+    h5['data/angle'][row] = numpy.ravel(quaternion)
+    h5['data/pattern_id'][row] = pattern_id
+
+def _consolidateFiles(individual_files, output_file, compression=None):
+    """ """
+    """ Copy the patterns of all individual output files into one consolidated file.
+
+    :param individual_files: The files written by the backengine.
+    :type individual_files: list
+
+    :param output_file: The consolidated file.
+    :type output_file: str
+
+    :param compression: HDF5 compression filter (default None).
+    :type compression: str
+    """
+    # Find all patterns.
+    sources = []
+    for ind_file in individual_files:
+        with h5py.File(ind_file, 'r') as h5_infile:
+            sources += [(ind_file, key) for key in h5_infile['data'].keys()]
+    # Rows are ordered by pattern id.
+    sources.sort(key=lambda source: int(source[1]))
+
+    with h5py.File(output_file, 'w') as h5_outfile:
+        h5_infile = None
+        open_file = None
+        try:
+            for row, (ind_file, key) in enumerate(sources):
+                # Consecutive patterns from the same file share the file handle.
+                if ind_file != open_file:
+                    if h5_infile is not None:
+                        h5_infile.close()
+                    h5_infile = h5py.File(ind_file, 'r')
+                    open_file = ind_file
+
+                group = h5_infile['data/%s' % (key)]
+                detector_counts = group['data'][()]
+                detector_intensity = group['diffr'][()]
+
+                # Global parameters are taken from the first file.
+                if row == 0:
+                    for name in ['params', 'info', 'misc', 'version']:
+                        if name in h5_infile:
+                            h5_infile.copy(name, h5_outfile)
+                    _createConsolidatedDatasets(h5_outfile, len(sources), detector_counts, detector_intensity, compression)
+
+                _writeConsolidatedPattern(h5_outfile, row, int(key), detector_counts, detector_intensity, group['angle'][()])
+        finally:
+            if h5_infile is not None:
+                h5_infile.close()
+
 if __name__ == '__main__':
     SingFELPhotonDiffractor.runFromCLI()
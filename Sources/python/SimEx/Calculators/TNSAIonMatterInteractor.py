@@ -42,6 +42,8 @@ class TNSAIonMatterInteractor(AbstractIonInteractor):
                                                       output_path)
         self.counts = []
         self.binedges = []
+        self.__velocities = np.zeros(0)
+        self.__cumulative_numbers = np.zeros(0, dtype=np.int64)
 
     def read_xsec(self):
         """Read in cross section from filename """
@@ -60,6 +62,22 @@ class TNSAIonMatterInteractor(AbstractIonInteractor):
         return E, xs
 
     def saveH5(self):
+        """ Write the neutron macroparticles to the openPMD output file.
+
+        If the parameter chunk_size is set, the output was already written by backengine().
+        """
+        if self.parameters.chunk_size is not None:
+            return  # No action required since output is written in backengine.
+
+        series, neutrons = self._openSeries()
+        if self.Nn > 0:
+            self._storeParticles(neutrons, 0, self.data)
+        series.flush()
+
+        del series
+
+    def _openSeries(self):
+        """ Create the openPMD output file and the neutron records for Nn particles. """
         SCALAR = api.Mesh_Record_Component.SCALAR
         Unit_Dimension = api.Unit_Dimension
 
@@ -92,15 +110,10 @@ class TNSAIonMatterInteractor(AbstractIonInteractor):
         neutrons.set_attribute("speciesType", "neutron")
         neutrons.set_attribute("numParticles", self.Nn)
 
-        d = api.Dataset(self.data[6].dtype, self.data[6].shape)
+        d = api.Dataset(np.dtype(np.float64), [self.Nn])
         neutrons["id"][SCALAR].reset_dataset(d)
-        neutrons["id"][SCALAR].store_chunk(self.data[6])
-
-        d = api.Dataset(self.data[7].dtype, self.data[7].shape)
         neutrons["weight"][SCALAR].reset_dataset(d)
-        neutrons["weight"][SCALAR].store_chunk(self.data[7])
 
-        d = api.Dataset(self.data[0].dtype, self.data[0].shape)
         neutrons["position"]["x"].reset_dataset(d)
         neutrons["position"]["y"].reset_dataset(d)
         neutrons["position"]["z"].reset_dataset(d)
@@ -108,11 +121,7 @@ class TNSAIonMatterInteractor(AbstractIonInteractor):
         neutrons["position"]["y"].set_unit_SI(1.e-6)
         neutrons["position"]["z"].set_unit_SI(1.e-6)
         neutrons["position"].set_unit_dimension({Unit_Dimension.L: 1})
-        neutrons["position"]["x"].store_chunk(self.data[0])
-        neutrons["position"]["y"].store_chunk(self.data[1])
-        neutrons["position"]["z"].store_chunk(self.data[2])
 
-        d = api.Dataset(self.data[0].dtype, self.data[0].shape)
         neutrons["velocity"]["x"].reset_dataset(d)
         neutrons["velocity"]["y"].reset_dataset(d)
         neutrons["velocity"]["z"].reset_dataset(d)
@@ -123,66 +132,106 @@ class TNSAIonMatterInteractor(AbstractIonInteractor):
             Unit_Dimension.L: 1,
             Unit_Dimension.T: -1
         })
-        neutrons["velocity"]["x"].store_chunk(self.data[3])
-        neutrons["velocity"]["y"].store_chunk(self.data[4])
-        neutrons["velocity"]["z"].store_chunk(self.data[5])
 
-        series.flush()
-        del series
+        return series, neutrons
+
+    def _storeParticles(self, neutrons, start, data):
+        """ Store a block of particles at the given offset, the caller flushes the series. """
+        SCALAR = api.Mesh_Record_Component.SCALAR
+
+        offset = [start]
+        extent = [data.shape[1]]
+        neutrons["id"][SCALAR].store_chunk(data[6], offset, extent)
+        neutrons["weight"][SCALAR].store_chunk(data[7], offset, extent)
+        neutrons["position"]["x"].store_chunk(data[0], offset, extent)
+        neutrons["position"]["y"].store_chunk(data[1], offset, extent)
+        neutrons["position"]["z"].store_chunk(data[2], offset, extent)
+        neutrons["velocity"]["x"].store_chunk(data[3], offset, extent)
+        neutrons["velocity"]["y"].store_chunk(data[4], offset, extent)
+        neutrons["velocity"]["z"].store_chunk(data[5], offset, extent)
 
     def backengine(self):
-        if not self.counts:
+        """ Compute the neutron spectrum from the ion spectrum and sample the neutron macroparticles.
+
+        If the parameter chunk_size is set, the particles are not kept in memory (data stays empty) but written to the
+        output file block by block, each block is flushed before the next one is generated.
+        """
+        if len(self.counts) == 0:
             [mom, weight] = self.readSDF()
             energy = np.square(mom) / (2 * mp * e)
             de = self.parameters.energy_bin
             nb = math.floor(np.max(energy) / de)
-            self.counts = [0 for i in range(nb + 1)]
-            self.binedges = [(i + 1) * de for i in range(nb + 1)]
+            self.counts = np.bincount(np.floor(energy / de).astype(np.int64),
+                                      weights=weight,
+                                      minlength=nb + 1)
+            self.binedges = de * np.arange(1, nb + 2)
             print("Number of energy bins: %s" % len(self.binedges))
-            for en in energy:
-                index = math.floor(en / de)
-                self.counts[index] += weight[index]
 
         [E, xs] = self.read_xsec()
         xs = np.interp(self.binedges, E * 1.e6, xs * 1.e-28)
 
-        vx = [0]
-        self.Nn = 0
-        for i in range(len(self.binedges)):
-            px = np.sqrt(2 * mp * self.binedges[i] * e)
-            Nd = self.counts[
-                i] * self.parameters.ibeam_radius**2 / self.parameters.neutron_weight
-            inc = int(
-                round(Nd * self.parameters.target_density
-                      * self.parameters.target_length * xs[i]))
-            if inc > 0:
-                vx = np.append(vx, np.ones(inc) * px / mp)
-                self.Nn += inc
+        # Number of neutron macroparticles per energy bin.
+        px = np.sqrt(2 * mp * np.asarray(self.binedges) * e)
+        Nd = np.asarray(self.counts) * self.parameters.ibeam_radius**2 / self.parameters.neutron_weight
+        numbers = np.rint(Nd * self.parameters.target_density
+                          * self.parameters.target_length * xs).astype(np.int64)
+        numbers[numbers < 0] = 0
+
+        self.__velocities = px / mp
+        self.__cumulative_numbers = np.cumsum(numbers)
+        self.Nn = int(self.__cumulative_numbers[-1]) if len(numbers) > 0 else 0
 
         print("Number of neutron macroparticles:", self.Nn)
-        vx = vx[1:]
 
-        self.data = np.zeros(shape=(self.__dims, self.Nn))
+        chunk_size = self.parameters.chunk_size
+        if chunk_size is None:
+            self.data = self._generateParticles(0, self.Nn)
+            return 0
+
+        self.data = []
+        series, neutrons = self._openSeries()
+        for start in range(0, self.Nn, chunk_size):
+            data = self._generateParticles(start, min(start + chunk_size, self.Nn))
+            self._storeParticles(neutrons, start, data)
+            series.flush()
+        # Also writes the records if there are no particles.
+        series.flush()
+
+        del series
+
+        return 0
+
+    def _generateParticles(self, start, stop):
+        """ Sample the neutron macroparticles with indices start to stop-1.
+
+        Particles are ordered by energy bin, the bin of each particle is found by inverting the cumulative number of
+        particles per bin.
+        """
+        n = stop - start
+        bins = np.searchsorted(self.__cumulative_numbers, np.arange(start, stop), side='right')
+        vx = self.__velocities[bins]
+
+        data = np.empty(shape=(self.__dims, n))
         vn = math.sqrt(2 * 2.45e6 * e / mp)
-        self.data[0] = 1.e6 * self.parameters.target_length * random(self.Nn)
+        data[0] = 1.e6 * self.parameters.target_length * random(n)
         r = 1.e6 * self.parameters.ibeam_radius * np.sqrt(random(
-            self.Nn))  # positions will be saved in units of micron
-        a = 2 * math.pi * random(self.Nn)
+            n))  # positions will be saved in units of micron
+        a = 2 * math.pi * random(n)
 
-        self.data[1] = np.multiply(r, np.cos(a))
-        self.data[2] = np.multiply(r, np.sin(a))
+        np.multiply(r, np.cos(a), out=data[1])
+        np.multiply(r, np.sin(a), out=data[2])
 
-        aa = math.pi * random(self.Nn)
-        b = 2 * math.pi * random(self.Nn)
+        aa = math.pi * random(n)
+        b = 2 * math.pi * random(n)
 
-        self.data[3] = np.add(vn * np.cos(aa), vx)
+        np.add(vn * np.cos(aa), vx, out=data[3])
         velr = vn * np.sin(aa)
-        self.data[4] = np.multiply(velr, np.cos(b))
-        self.data[5] = np.multiply(velr, np.sin(b))
-        self.data[6] = np.arange(1, self.Nn + 1)  # id
-        self.data[7] = self.parameters.neutron_weight * np.ones(self.Nn)
+        np.multiply(velr, np.cos(b), out=data[4])
+        np.multiply(velr, np.sin(b), out=data[5])
+        data[6] = np.arange(start + 1, stop + 1)  # id
+        data[7] = self.parameters.neutron_weight
 
-        return 0
+        return data
 
     def readSDF(self):
         if not os.path.exists(self.input_path):
@@ -20,9 +20,11 @@
 #                                                                        #
 ##########################################################################
 
+import multiprocessing
 import os
 import subprocess
 import shlex
+import time
 
 from SimEx.Calculators.AbstractPhotonPropagator import AbstractPhotonPropagator
 from SimEx.Parameters.WavePropagatorParameters import WavePropagatorParameters
@@ -145,15 +147,24 @@ class WavePropagator(AbstractPhotonPropagator):
         if not os.path.isdir(self.output_path):
             os.mkdir(self.output_path)
 
+        # One run per source file.
+        jobs = [(i, input_file,
+                 os.path.join(self.output_path, 'prop_out_%07d.h5' % (i)),
+                 self.parameters.beamline.get_beamline)
+                for i, input_file in enumerate(input_files)]
+
+        if self.parameters.scheduling == "dynamic":
+            timings = _scheduleDynamic(jobs, comm, _numberOfLocalProcesses(self.parameters.cpus_per_task))
+            if thisProcess == 0:
+                _printTimings(timings, jobs)
+            return 0
+
         # Loop over all input files and generate one run per source file.
-        for i, input_file in enumerate(input_files):
+        for i, job in enumerate(jobs):
             # TODO: Transmit number of cpus.
             # process file on a corresponding process (round-robin)
             if i % numProcesses == thisProcess:
-                output_file = os.path.join(self.output_path,
-                                           'prop_out_%07d.h5' % (i))
-                propagate_s2e.propagate(input_file, output_file,
-                                        self.parameters.beamline.get_beamline)
+                _propagateFile(job)
 
                 # Rewrite in openpmd conformant way.
                 # wpg_to_opmd.convertToOPMD( output_file )
@@ -179,5 +190,112 @@ class WavePropagator(AbstractPhotonPropagator):
         pass  # No action required since output is written in backengine.
 
 
+def _propagateFile(job):
+    """ """
+    """ Private (hidden) utility to propagate one input file.
+
+    :param job: Index, input file, output file and beamline function.
+    :type job: tuple
+
+    :return: Index of the job and the wall time of the propagation in seconds.
+    """
+    index, input_file, output_file, get_beamline = job
+
+    start_time = time.time()
+    propagate_s2e.propagate(input_file, output_file, get_beamline)
+
+    return index, time.time() - start_time
+
+
+def _numberOfLocalProcesses(cpus_per_task):
+    """ """
+    """ Private (hidden) utility to get the number of propagations this rank can run at once on its cores.
+
+    :param cpus_per_task: Cores per propagation, "MAX" counts each core as one propagation.
+    :type cpus_per_task: int || str
+    """
+    try:
+        number_of_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        number_of_cores = multiprocessing.cpu_count()
+
+    if cpus_per_task == "MAX":
+        return number_of_cores
+
+    return max(1, number_of_cores // int(cpus_per_task))
+
+
+def _scheduleDynamic(jobs, comm, number_of_processes=1):
+    """ """
+    """ Private (hidden) utility to run jobs on whichever process is free.
+
+    With more than one MPI rank, rank 0 hands out jobs and all other ranks propagate.
+    Without MPI parallelism, the jobs run in a local process pool of the given size.
+
+    :return: The (index, wall time) of all finished jobs on rank 0, an empty list on all other ranks.
+    """
+    if comm.size > 1:
+        if comm.rank == 0:
+            return _scheduleMaster(jobs, comm)
+        _scheduleWorker(jobs, comm)
+        return []
+
+    if number_of_processes > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(processes=min(number_of_processes, len(jobs))) as pool:
+            return list(pool.imap_unordered(_propagateFile, jobs))
+
+    return [_propagateFile(job) for job in jobs]
+
+
+def _scheduleMaster(jobs, comm):
+    """ """
+    """ Private (hidden) utility to hand out job indices to the worker ranks on request.
+
+    Rank 0 only dispatches, so a worker asking for its next job never waits for a propagation on rank 0.
+    """
+    from mpi4py import MPI
+
+    timings = []
+    next_job = 0
+    active_workers = comm.size - 1
+
+    while active_workers > 0:
+        # Workers report their rank and last result (None at start) and ask for the next job.
+        source, result = comm.recv(source=MPI.ANY_SOURCE)
+        if result is not None:
+            timings.append(result)
+
+        if next_job < len(jobs):
+            comm.send(next_job, dest=source)
+            next_job += 1
+        else:
+            comm.send(None, dest=source)
+            active_workers -= 1
+
+    return timings
+
+
+def _scheduleWorker(jobs, comm):
+    """ """
+    """ Private (hidden) utility to run jobs handed out by the master rank until it sends None. """
+    result = None
+    while True:
+        comm.send((comm.rank, result), dest=0)
+        index = comm.recv(source=0)
+        if index is None:
+            return
+        result = _propagateFile(jobs[index])
+
+
+def _printTimings(timings, jobs):
+    """ """
+    """ Private (hidden) utility to report the propagation wall time per file. """
+    print("WavePropagator timings:")
+    for index, seconds in sorted(timings):
+        print("%s: %.2f s" % (os.path.basename(jobs[index][1]), seconds))
+    if timings:
+        print("Total: %.2f s, longest: %.2f s" % (sum(t for i, t in timings), max(t for i, t in timings)))
+
+
 if __name__ == '__main__':
     WavePropagator.runFromCLI()
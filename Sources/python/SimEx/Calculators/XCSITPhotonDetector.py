@@ -31,6 +31,7 @@ except:
 
 
 import h5py
+import multiprocessing
 import os
 import numpy
 import sys
@@ -266,6 +267,7 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
 
     def __createXCSITChargeMatrix(self):
         self.__charge_data = [lpdi.ChargeMatrix() for i in self.parameters.patterns]
+        self.__charge_arrays = [None for i in self.parameters.patterns]
 
     # Subengine to calulate the particle simulation: The interaction of the
     # photons with the detector of choice
@@ -283,12 +285,7 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
         for i,pd in enumerate(self.__photon_data):
             # Run the simulation, catch everything that might happen and report
             try:
-                param = self.parameters
-                ps = lpdi.ParticleSim()
-                ps.setInput(pd)
-                ps.setOutput(self.__ia_data[i])
-                ps.initialization(param.detector_type)
-                ps.runSimulation()
+                _runParticleSimulation(pd, self.__ia_data[i], self.parameters)
 
             except:
                 err = sys.exc_info()
@@ -316,16 +313,7 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
         # Run the simulation
         for i, ia in enumerate(self.__ia_data):
             try:
-                para = self.parameters
-                cs = lpdi.ChargeSim()
-                cs.setInput(ia)
-                cs.setOutput(self.__charge_data[i])
-                cs.setComponents(para.plasma_search_flag,
-                                para.point_simulation_method,
-                                para.plasma_simulation_flag,
-                                para.detector_type
-                                )
-                cs.runSimulation()
+                _runChargeSimulation(ia, self.__charge_data[i], self.parameters)
 
                 # Necessary due to the definition of XChargeData.hh
             except:
@@ -337,13 +325,11 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
                 is_successful = False
                 return is_successful
 
+            # Convert once, the array is reused in saveH5.
+            self.__charge_arrays[i] = _chargeArray(self.__charge_data[i])
+
             # Count how many pixels have charge
-            counter=0
-            for x in list(range(self.__charge_data[i].width())):
-                for y in list(range(self.__charge_data[i].height())):
-                    entry=self.__charge_data[i].getEntry(x,y)
-                    if(entry.getCharge() != 0):
-                        counter+=1
+            counter = numpy.count_nonzero(self.__charge_arrays[i])
             print(("\nSUMMARY:\nFound " + str(counter) + " signals in the detector of size " +
                 str(self.__charge_data[i].height()) + "x" + str(self.__charge_data[i].width()) +
                 " for " + str(self.__ia_data[i].size()) + " interactions and " +
@@ -356,6 +342,10 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
         """
         Executes the simulation of the particle and charge simulation.
         """
+        # Simulate whole patterns in worker processes.
+        if self.parameters.number_of_processes > 1:
+            return self.__backenginePool()
+
         print("\nSimulating photon-detector interaction.")
         # Create interaction container
         self.__createXCSITInteractions()
@@ -378,6 +368,48 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
             print("Charge propagation simulation in the detector is finished.")
         return 0
 
+    def __backenginePool(self):
+        """
+        Run particle and charge simulation of each pattern in a pool of
+        worker processes and write the charge matrices to the output file as
+        they are finished.
+        """
+        print("\nSimulating photon-detector interaction and charge propagation of {0:d} patterns in {1:d} processes.".format(len(self.__pattern_ids), self.parameters.number_of_processes))
+
+        jobs = [(self.__input_path[0], pid, self.__geometry, self.parameters) for pid in self.__pattern_ids]
+
+        # Only the charge matrices of finished patterns are kept in memory.
+        self.__photon_data = None
+        self.__ia_data = None
+        self.__charge_data = None
+        self.__charge_arrays = None
+
+        with h5py.File(self.output_path, "w") as h5_outfile:
+            data_gr = h5_outfile.create_group("data")
+
+            with multiprocessing.Pool(processes=min(self.parameters.number_of_processes, len(jobs))) as pool:
+                try:
+                    for pid, (charges, number_of_photons, number_of_interactions) in zip(self.__pattern_ids, pool.imap(_simulatePattern, jobs)):
+                        data_gr.create_dataset("{0:s}/data".format(pid), data=charges)
+
+                        print(("\nSUMMARY:\nFound " + str(numpy.count_nonzero(charges)) + " signals in the detector of size " +
+                            str(charges.shape[1]) + "x" + str(charges.shape[0]) +
+                            " for " + str(number_of_interactions) + " interactions and " +
+                            str(number_of_photons) + " photons in pattern " + str(pid)))
+                except:
+                    err = sys.exc_info()
+                    print("Detector simulation error:")
+                    print(("Error type: " + str(err[0])))
+                    print(("Error value: " + str(err[1])))
+                    print(("Error traceback: " + str(err[2])))
+                    raise RuntimeError("Detector simulation caused errors, " +
+                        "interrupting execution.")
+
+        self.__output_is_streamed = True
+        print("Detector simulation is finished.")
+
+        return 0
+
     def _readH5(self):
         """
         Reads the hdf5 file and create the storage container for the photons
@@ -418,19 +450,8 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
                 pattern_ids = [keys[i] for i in pattern_ids]
 
             self.__pattern_ids = pattern_ids
-            photons = numpy.empty(shape=(number_of_patterns,
-                                         matrix.shape[0],
-                                         matrix.shape[1]
-                                         )
-                                 )
-            for i,pid in enumerate(pattern_ids):
-                #photons[i,:,:] = h5_infile["/data/{0:s}/diffr".format(pid)].value
-                photons[i,:,:] = h5_infile["/data/{0:s}/data".format(pid)].value
 
-            #photons = numpy.floor(photons)
-            photons = photons.astype(int)
-
-            x_num, y_num = photons.shape[1:]
+            x_num, y_num = matrix.shape
             print(("Size of input matrix: " + str(x_num) + "x" + str(y_num)))
 
             # Parameters of the matrix
@@ -443,68 +464,33 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
             detector_dist = h5_infile["/params/geom/detectorDist"].value
             print("Detector distance = {0:e} m.".format(detector_dist))
 
+            self.__geometry = (x_pixel, y_pixel, center_energy, detector_dist)
+            self.__output_is_streamed = False
+
+            # Worker processes read their patterns themselves.
+            if self.parameters.number_of_processes > 1:
+                print("XCSITPhotonDetector will read {0:d} patterns from the input.".format(len(pattern_ids)))
+                return
+
+            photons = numpy.empty(shape=(number_of_patterns,
+                                         matrix.shape[0],
+                                         matrix.shape[1]
+                                         )
+                                 )
+            for i,pid in enumerate(pattern_ids):
+                #photons[i,:,:] = h5_infile["/data/{0:s}/diffr".format(pid)].value
+                photons[i,:,:] = h5_infile["/data/{0:s}/data".format(pid)].value
+
+            #photons = numpy.floor(photons)
+            photons = photons.astype(int)
+
             # Create the photon instance
             self.__photon_data = [lpdi.PhotonData() for i in range(photons.shape[0])]
 
-            # Assumptions
-            # - All the photon originate from the center
-            # - photon energy is everywhere the same in the beam
             print("Creating the photons")
 
             for ipd, pd in enumerate(self.__photon_data):
-                for i in range(x_num):
-                    for j in range(y_num):
-
-                        number_of_photons_in_pixel = photons[ipd,i,j]
-                        if number_of_photons_in_pixel < 1:
-                            continue
-
-
-                        # Transfer from python to cartesian
-                        direct = numpy.zeros((3,),dtype=numpy.float_)
-                        direct[0] = i
-                        direct[1] = y_num - 1 - j
-                        direct[2] = 0
-
-                        # Center center and correct for center of element
-                        direct[0] = direct[0] - 0.5* x_num + 0.5
-                        direct[1] = direct[1] - 0.5* y_num + 0.5
-                        direct[2] = direct[2]
-
-                        # calculate the length
-                        direct[0] = direct[0]*x_pixel
-                        direct[1] = direct[1]*y_pixel
-                        direct[2] = detector_dist
-
-
-                        # Calculate the photon flight vector with respect to the matrix
-                        # center and the origin of diffraction
-                        #direct[0] = x_pixel*(i + 0.5 - 0.5 *x_num) # x-coordinate
-                        #direct[1] = y_num*y_pixel - y_pixel*(j + 0.5 -0.5 *y_num)
-                        # python goes from left 2 right top 2 bottom
-                        # in conrast to our coordinate space
-                        #direct[2] = detector_dist
-
-                        # calculate the normalized direction vector
-                        le=numpy.sqrt(numpy.sum((direct**2)))
-                        normal_direction = numpy.zeros((3,),dtype=numpy.float_)
-                        if le != 0:
-                            normal_direction = direct/le
-
-                        # For each photon detected at (i,j) create an instance
-                        # shift into the koordinate system where the detector is in
-                        # the origin  direct - (0,0,detector_dist)
-                        entries = [ pd.addEntry() for i in range(number_of_photons_in_pixel)]
-                        for entry in entries:
-                            entry.setPositionX(direct[0])
-                            entry.setPositionY(direct[1])
-                            entry.setPositionZ(0)
-                            entry.setDirectionX(numpy.asscalar(normal_direction[0]))
-                            entry.setDirectionY(numpy.asscalar(normal_direction[1]))
-                            entry.setDirectionZ(numpy.asscalar(normal_direction[2]))
-
-                            #Photon energies have be set in units of keV.
-                            entry.setEnergy(center_energy*1e-3)
+                _fillPhotonData(pd, photons[ipd], self.__geometry)
 
             # Close the input file
             h5_infile.close()
@@ -528,14 +514,12 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
 
         # Convert the ChargeMatrix to a numpy array to be able to store its
         # content
-        x_size = self.__charge_data[0].width()
-        y_size = self.__charge_data[0].height()
-        charge_array = [numpy.zeros((x_size,y_size),dtype=numpy.float_) for p in self.__pattern_ids]  # float64
+        # The charge matrices were already written by the worker pool.
+        if self.__output_is_streamed:
+            charge_array = []
+        else:
+            charge_array = [ca if ca is not None else _chargeArray(cm) for ca, cm in zip(self.__charge_arrays, self.__charge_data)]
         for i,ca in enumerate(charge_array):
-            for x in range(x_size):
-                for y in range(y_size):
-                    entry = self.__charge_data[i].getEntry(x,y)
-                    ca[x][y] = entry.getCharge()
 
             # TODO settle this issue:
             # For unknown reasons the interaction entries and the chargematrix is
@@ -565,18 +549,22 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
         # Create the new datasets
         # ------------------------------------------------------------
         # Open required files
-        with h5py.File(self.output_path, "w") as h5_outfile:
+        if self.__output_is_streamed:
+            mode = "a"
+        else:
+            mode = "w"
+        with h5py.File(self.output_path, mode) as h5_outfile:
             # Create the necessary output groups
-            data_gr = h5_outfile.create_group("data")
+            data_gr = h5_outfile.require_group("data")
             info_gr = h5_outfile.create_group("info")
             param_geom_gr= h5_outfile.create_group("params/geom")
             param_beam_gr= h5_outfile.create_group("params/beam")
 
-            for i, pid in enumerate(self.__pattern_ids):
+            for pid, ca in zip(self.__pattern_ids, charge_array):
                 # Create the direct data values independent of the input file
-                data_gr.create_dataset("{0:s}/data".format(pid), data=charge_array[i])
+                data_gr.create_dataset("{0:s}/data".format(pid), data=ca)
                 #data_gr.create_dataset("{0:s}/interactions".format(pid), data=num_ia[i])
-            info_gr.create_dataset("package_version".format(pid),data="1.0")
+            info_gr.create_dataset("package_version",data="1.0")
 
             with h5py.File(self.__input_path[0],"r" ) as  h5_infile:
 
@@ -602,3 +590,157 @@ class XCSITPhotonDetector(AbstractPhotonDetector):
 
             # Close file
             h5_outfile.close()
+
+
+def _simulatePattern(job):
+    """ """
+    """ Run particle and charge simulation of one pattern.
+
+    :param job: Input file, pattern id, geometry (pixel width, pixel height, photon energy, detector distance) and calculator parameters.
+    :type job: tuple
+
+    :return: The charge array, the number of photons and the number of interactions.
+    """
+    input_file, pattern_id, geometry, parameters = job
+
+    with h5py.File(input_file, "r") as h5_infile:
+        photons = h5_infile["/data/{0:s}/data".format(pattern_id)][()].astype(int)
+
+    photon_data = lpdi.PhotonData()
+    _fillPhotonData(photon_data, photons, geometry)
+
+    interaction_data = lpdi.InteractionData()
+    _runParticleSimulation(photon_data, interaction_data, parameters)
+    number_of_photons = photon_data.size()
+    del photon_data
+
+    charge_matrix = lpdi.ChargeMatrix()
+    _runChargeSimulation(interaction_data, charge_matrix, parameters)
+
+    return _chargeArray(charge_matrix), number_of_photons, interaction_data.size()
+
+def _runParticleSimulation(photon_data, interaction_data, parameters):
+    """ """
+    """ Simulate the photon-detector interaction of the photons in photon_data into interaction_data. """
+    ps = lpdi.ParticleSim()
+    ps.setInput(photon_data)
+    ps.setOutput(interaction_data)
+    ps.initialization(parameters.detector_type)
+    ps.runSimulation()
+
+def _runChargeSimulation(interaction_data, charge_matrix, parameters):
+    """ """
+    """ Simulate the charge propagation of the interactions in interaction_data into charge_matrix. """
+    cs = lpdi.ChargeSim()
+    cs.setInput(interaction_data)
+    cs.setOutput(charge_matrix)
+    cs.setComponents(parameters.plasma_search_flag,
+                     parameters.point_simulation_method,
+                     parameters.plasma_simulation_flag,
+                     parameters.detector_type
+                     )
+    cs.runSimulation()
+
+def _fillPhotonData(photon_data, photons, geometry):
+    """ """
+    """ Add the photons of one pattern to the XCSIT photon container.
+
+    Assumptions:
+    - All the photon originate from the center
+    - photon energy is everywhere the same in the beam
+
+    :param photons: Number of photons per pixel.
+    :type photons: numpy.array
+
+    :param geometry: Pixel width, pixel height, photon energy and detector distance.
+    :type geometry: tuple
+    """
+    x_pixel, y_pixel, center_energy, detector_dist = geometry
+    counts, positions, directions = _photonPixels(photons, x_pixel, y_pixel, detector_dist)
+
+    #Photon energies have be set in units of keV.
+    _addPhotons(photon_data, counts, positions, directions, float(center_energy)*1e-3)
+
+def _photonPixels(photons, x_pixel, y_pixel, detector_dist):
+    """ """
+    """ Get number of photons, position and flight direction of each pixel hit by at least one photon.
+
+    :param photons: Number of photons per pixel, shape (x_num, y_num).
+    :type photons: numpy.array
+
+    :param x_pixel: Pixel width in m.
+    :type x_pixel: float
+
+    :param y_pixel: Pixel height in m.
+    :type y_pixel: float
+
+    :param detector_dist: Distance of the detector from the origin of diffraction in m.
+    :type detector_dist: float
+
+    :return: Photon counts (n,), positions on the detector (n, 3) and normalized directions (n, 3) of the n hit pixels in the order of the pixels.
+    """
+    x_num, y_num = photons.shape
+    i, j = numpy.nonzero(photons >= 1)
+
+    # Transfer from python to cartesian coordinates with the origin in the
+    # matrix center and correct for the center of the pixel.
+    direct = numpy.empty((len(i), 3), dtype=numpy.float64)
+    direct[:,0] = (i - 0.5*x_num + 0.5)*x_pixel
+    direct[:,1] = (y_num - 1 - j - 0.5*y_num + 0.5)*y_pixel
+    direct[:,2] = detector_dist
+
+    # Calculate the normalized direction vector with respect to the origin of diffraction.
+    length = numpy.sqrt(numpy.sum(direct**2, axis=1))
+    directions = numpy.zeros_like(direct)
+    nonzero_length = length != 0
+    directions[nonzero_length] = direct[nonzero_length]/length[nonzero_length,numpy.newaxis]
+
+    # Shift into the coordinate system where the detector is in the origin.
+    positions = direct
+    positions[:,2] = 0
+
+    return photons[i,j], positions, directions
+
+def _addPhotons(photon_data, counts, positions, directions, energy):
+    """ """
+    """ Add the photons of all hit pixels to the XCSIT photon container.
+
+    :param photon_data: The photon container.
+    :type photon_data: lpdi.PhotonData
+
+    :param counts: Number of photons per pixel.
+    :type counts: numpy.array
+
+    :param positions: Position of each pixel.
+    :type positions: numpy.array
+
+    :param directions: Direction of flight of the photons of each pixel.
+    :type directions: numpy.array
+
+    :param energy: Photon energy in keV.
+    :type energy: float
+    """
+    # Python floats avoid the conversion of numpy scalars in every setter call.
+    for count, position, direction in zip(counts.tolist(), positions.tolist(), directions.tolist()):
+        for n in range(count):
+            entry = photon_data.addEntry()
+            entry.setPositionX(position[0])
+            entry.setPositionY(position[1])
+            entry.setPositionZ(position[2])
+            entry.setDirectionX(direction[0])
+            entry.setDirectionY(direction[1])
+            entry.setDirectionZ(direction[2])
+            entry.setEnergy(energy)
+
+def _chargeArray(charge_matrix):
+    """ """
+    """ Copy the charges of the XCSIT charge matrix into a numpy array of shape (width, height). """
+    x_size = charge_matrix.width()
+    y_size = charge_matrix.height()
+    get_entry = charge_matrix.getEntry
+
+    charges = numpy.fromiter((get_entry(x,y).getCharge() for x in range(x_size) for y in range(y_size)),
+                             dtype=numpy.float64,
+                             count=x_size*y_size)
+
+    return charges.reshape((x_size, y_size))
@@ -20,7 +20,9 @@
 #                                                                        #
 ##########################################################################
 
+import copy
 import h5py
+import multiprocessing
 import numpy
 import os
 import random
@@ -126,6 +128,9 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         if "random_rotation" not in list(self.parameters.keys()):
             self.parameters["random_rotation"] = False
 
+        if "number_of_processes" not in list(self.parameters.keys()):
+            self.parameters["number_of_processes"] = 1
+
     def expectedData(self):
         """ Query for the data expected by the Interactor. """
         return self.__expected_data
@@ -154,65 +159,30 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         elif os.path.isfile( self.output_path ):
             raise IOError( "Output file %s already exists, cowardly refusing to overwrite." % (self.output_path) )
 
-        # Generate formatted output files (i.e. attach history to output file).
-        for i,input_file in enumerate(input_files):
-            tail = input_file.split( 'prop' )[-1]
-            output_file = os.path.join( self.output_path , 'pmi_out_%07d.h5' % (i+1) )
-            f_h5_out2in( input_file, output_file)
-
-            # Get the backengine calculator.
-            pmi_demo = PMIDemo()
-
-            # Transfer some parameters.
-            pmi_demo.g_s2e['prj'] = ''
-            pmi_demo.g_s2e['id'] = tail.split('_')[-1].split('.')[0]
-            pmi_demo.g_s2e['prop_out'] = input_file
-            pmi_demo.g_s2e['setup'] = dict()
-            pmi_demo.g_s2e['sys'] = dict()
-            pmi_demo.g_s2e['setup']['num_digits'] = 7
-
-            if 'number_of_steps' in list(self.parameters.keys()):
-                pmi_demo.g_s2e['steps'] = self.parameters['number_of_steps']
-            else:
-                pmi_demo.g_s2e['steps'] = 100
-
-            pmi_demo.g_s2e['maxZ'] = 100
-            pmi_demo.g_s2e['random_rotation'] = self.parameters['random_rotation']
-            pmi_demo.g_s2e['setup']['pmi_out'] = output_file
-            # Setup the database.
-            pmi_demo.f_dbase_setup()
-
-            # Go through the pmi workflow.
-            pmi_demo.f_init_random()
-            pmi_demo.f_save_info()
-            pmi_demo.f_load_pulse( pmi_demo.g_s2e['prop_out'] )
-
-            # Get file extension.
-            extension = self.__sample_path.split(".")[-1]
-            if extension.lower() == "h5":
-                h5 = h5py.File(self.__sample_path, 'r')
-                h5.close()
-                pmi_demo.f_load_sample(self.__sample_path)
-            elif extension.lower() == "pdb":
-                atoms_dict = IOUtilities.loadPDB(self.__sample_path)
-                pmi_demo.g_s2e['sample'] = atoms_dict
-
-            elif extension.lower() == "xyz":
-                atoms_dict = IOUtilities.loadXYZ(self.__sample_path)
-                pmi_demo.g_s2e['sample'] = atoms_dict
+        # Setup one job per pulse.
+        output_files = [ os.path.join( self.output_path , 'pmi_out_%07d.h5' % (i+1) ) for i in range(len(input_files)) ]
+        jobs = [ (input_file, output_file, self.parameters) for input_file, output_file in zip(input_files, output_files) ]
 
-            else:
-                raise IOError("Sample file is in an unsupported format (supported are h5, pdb, xyz).")
+        # Distribute the pulses over worker processes. Each worker loads the form factor database and the sample only once.
+        number_of_processes = min( self.parameters['number_of_processes'], len(jobs) )
+        if number_of_processes > 1:
+            with multiprocessing.Pool( processes=number_of_processes,
+                                       initializer=_initPulseWorker,
+                                       initargs=(self.__sample_path,) ) as pool:
+                pool.starmap( _runPulse, jobs )
 
-            pmi_demo.f_rotate_sample()
-            pmi_demo.f_system_setup()
-
-            # Perform the trajectories for this pulse and orientation.
-            for traj in range( self.parameters['number_of_trajectories'] ):
-                pmi_demo.f_time_evolution()
+        else:
+            # Serial runs use the caller's random state.
+            _loadPulseWorkerData( self.__sample_path )
+            for job in jobs:
+                _runPulse( *job )
 
         return status
 
+    def cacheInputs(self):
+        """ Query for the inputs besides parameters and input_path, i.e. the sample file. """
+        return [self.__sample_path]
+
     @property
     def data(self):
         """ Query for the field data. """
@@ -233,6 +203,98 @@ class XMDYNDemoPhotonMatterInteractor(AbstractPhotonInteractor):
         """
         pass # No action required since output is written in backengine.
 
+# Data shared by all pulses computed in one process.
+_pulse_worker_data = dict()
+
+def _initPulseWorker( sample_path ):
+    """ Initialize a pool worker process.
+
+    :param sample_path: Path to the sample file (h5, pdb, or xyz).
+    :type sample_path: str
+    """
+    # Forked workers inherit the parent's random state, draw a fresh one.
+    numpy.random.seed()
+
+    _loadPulseWorkerData( sample_path )
+
+def _loadPulseWorkerData( sample_path ):
+    """ Load the form factor database and the sample for all pulses run in this process.
+
+    :param sample_path: Path to the sample file (h5, pdb, or xyz).
+    :type sample_path: str
+    """
+    pmi_demo = PMIDemo()
+    pmi_demo.f_dbase_setup()
+    _pulse_worker_data['dbase'] = pmi_demo.g_dbase
+
+    # Get file extension.
+    extension = sample_path.split(".")[-1]
+    if extension.lower() == "h5":
+        pmi_demo.f_load_sample(sample_path)
+        atoms_dict = pmi_demo.g_s2e['sample']
+    elif extension.lower() == "pdb":
+        atoms_dict = IOUtilities.loadPDB(sample_path)
+
+    elif extension.lower() == "xyz":
+        atoms_dict = IOUtilities.loadXYZ(sample_path)
+
+    else:
+        raise IOError("Sample file is in an unsupported format (supported are h5, pdb, xyz).")
+
+    _pulse_worker_data['sample'] = atoms_dict
+
+def _runPulse( input_file, output_file, parameters ):
+    """ Run the demo photon-matter interaction for one pulse.
+
+    :param input_file: The propagated pulse.
+    :type input_file: str
+
+    :param output_file: The pmi output file to write.
+    :type output_file: str
+
+    :param parameters: The interactor parameters.
+    :type parameters: dict
+    """
+    tail = input_file.split( 'prop' )[-1]
+    f_h5_out2in( input_file, output_file)
+
+    # Get the backengine calculator.
+    pmi_demo = PMIDemo()
+
+    # Transfer some parameters.
+    pmi_demo.g_s2e['prj'] = ''
+    pmi_demo.g_s2e['id'] = tail.split('_')[-1].split('.')[0]
+    pmi_demo.g_s2e['prop_out'] = input_file
+    pmi_demo.g_s2e['setup'] = dict()
+    pmi_demo.g_s2e['sys'] = dict()
+    pmi_demo.g_s2e['setup']['num_digits'] = 7
+
+    if 'number_of_steps' in list(parameters.keys()):
+        pmi_demo.g_s2e['steps'] = parameters['number_of_steps']
+    else:
+        pmi_demo.g_s2e['steps'] = 100
+
+    pmi_demo.g_s2e['maxZ'] = 100
+    pmi_demo.g_s2e['random_rotation'] = parameters['random_rotation']
+    pmi_demo.g_s2e['setup']['pmi_out'] = output_file
+    # Reuse the database of this process.
+    pmi_demo.g_dbase = _pulse_worker_data['dbase']
+
+    # Go through the pmi workflow.
+    pmi_demo.f_init_random()
+    pmi_demo.f_save_info()
+    pmi_demo.f_load_pulse( pmi_demo.g_s2e['prop_out'] )
+
+    # The rotation acts in place, so work on a copy of the shared sample.
+    pmi_demo.g_s2e['sample'] = copy.deepcopy( _pulse_worker_data['sample'] )
+
+    pmi_demo.f_rotate_sample()
+    pmi_demo.f_system_setup()
+
+    # Perform the trajectories for this pulse and orientation.
+    for traj in range( parameters['number_of_trajectories'] ):
+        pmi_demo.f_time_evolution()
+
 class PMIDemo(object):
 
     def __init__(self):
@@ -292,12 +354,10 @@ class PMIDemo(object):
 
         maxZ = self.g_s2e['maxZ']  #99
         numQ = len( g_dbase['halfQ'] )
-        g_dbase['ff'] = numpy.zeros( ( self.f_dbase_Zq2id( maxZ , maxZ ) + 1 , numQ ) )
-        ii = 0
-        for ZZ in range( 1 , maxZ+1 ) :
-            for qq in range( ZZ+1 ) :
-                g_dbase['ff'][ ii , : ] = xdbase[:,ZZ] * ( ZZ - qq ) / ( ZZ * 1.0 ) ;
-                ii = ii + 1
+        # One row per (Z,q) pair in the order of f_dbase_Zq2id, form factor of the neutral atom scaled by the number of remaining electrons.
+        all_Z = numpy.repeat( numpy.arange( 1 , maxZ+1 ) , numpy.arange( 2 , maxZ+2 ) )
+        all_q = numpy.concatenate( [ numpy.arange( ZZ+1 ) for ZZ in range( 1 , maxZ+1 ) ] )
+        g_dbase['ff'] = xdbase[:,all_Z].T * ( all_Z - all_q )[:,numpy.newaxis] / ( all_Z * 1.0 )[:,numpy.newaxis]
 
         g_dbase['Sq_halfQ'] = g_dbase['halfQ'] ;
         g_dbase['Sq_bound'] = numpy.zeros( (numQ,) ) ;
@@ -415,38 +475,28 @@ class PMIDemo(object):
         self.g_s2e['sys']['Nph'] = 1e99
         #print '   NOTE: Nph is uniform.'
 
-    def f_save_snp( self,  a_snp ) :
-        self.g_s2e['sys']['xyz'] = self.f_dbase_Zq2id( self.g_s2e['sys']['Z'] , self.g_s2e['sys']['q'] )
-        self.g_s2e['sys']['T'] = numpy.sort( numpy.unique( self.g_s2e['sys']['xyz'] ) )
-        ff = numpy.zeros( ( len( self.g_s2e['sys']['T'] ) , len( self.g_dbase['halfQ'] ) ) )
-        for ii in range( len( self.g_s2e['sys']['T'] ) ) :
-            ff[ii,:] =  self.g_dbase['ff'][self.g_s2e['sys']['T'][ii].astype(int),:].copy()
-    ###        print self.g_s2e['sys']['T'][ii].astype(int) , ff[ii,:]
-
-        pmi_file = self.g_s2e['setup']['pmi_out']
-        grp = '/data/snp_' + str( a_snp ).zfill( self.g_s2e['setup']['num_digits'] )
-    ###    print pmi_file , grp
-        xfp  = h5py.File( pmi_file , "a" )
-        try:
-            grp_hist_parent = xfp.create_group( '/data' )
-        except:
-            1
-        grp_hist_parent = xfp.create_group( grp )
-        xfp[ grp + '/Z' ]   = self.g_s2e['sys']['Z']
-        xfp[ grp + '/T' ]   = self.g_s2e['sys']['T'] .astype(numpy.int32)
-        xfp[ grp + '/xyz' ] = self.g_s2e['sys']['xyz'] .astype(numpy.int32)
-        xfp[ grp + '/r' ] = self.g_s2e['sys']['r'] .astype(numpy.float32)
-        xfp[ grp + '/Nph' ] = numpy.array( [self.g_s2e['pulse']['sel_int'][a_snp-1]] )
-        xfp[ grp + '/halfQ' ] = self.g_dbase['halfQ'] .astype(numpy.float32)
-        xfp[ grp + '/ff' ] = ff .astype(numpy.float32)
-        xfp[ grp + '/Sq_halfQ' ] = self.g_dbase['Sq_halfQ'] .astype(numpy.float32)
-        xfp[ grp + '/Sq_bound' ] = self.g_dbase['Sq_bound'] .astype(numpy.float32)
-        xfp[ grp + '/Sq_free' ] = self.g_dbase['Sq_free'] .astype(numpy.float32)
-
-        xfp.close()
-
-
+    def f_save_snp( self,  a_snp , a_fp=None ) :
+        # Open the output file unless an open handle is passed.
+        if a_fp is None :
+            with h5py.File( self.g_s2e['setup']['pmi_out'] , "a" ) as xfp :
+                self.f_save_snp( a_snp , xfp )
+            return
 
+        self.g_s2e['sys']['xyz'] = self.f_dbase_Zq2id( self.g_s2e['sys']['Z'] , self.g_s2e['sys']['q'] )
+        self.g_s2e['sys']['T'] = numpy.unique( self.g_s2e['sys']['xyz'] )
+        ff = self.g_dbase['ff'][self.g_s2e['sys']['T'].astype(int),:]
+
+        grp = a_fp.require_group( '/data' ).create_group( 'snp_' + str( a_snp ).zfill( self.g_s2e['setup']['num_digits'] ) )
+        grp[ 'Z' ]   = self.g_s2e['sys']['Z']
+        grp[ 'T' ]   = self.g_s2e['sys']['T'] .astype(numpy.int32)
+        grp[ 'xyz' ] = self.g_s2e['sys']['xyz'] .astype(numpy.int32)
+        grp[ 'r' ] = self.g_s2e['sys']['r'] .astype(numpy.float32)
+        grp[ 'Nph' ] = numpy.array( [self.g_s2e['pulse']['sel_int'][a_snp-1]] )
+        grp[ 'halfQ' ] = self.g_dbase['halfQ'] .astype(numpy.float32)
+        grp[ 'ff' ] = ff .astype(numpy.float32)
+        grp[ 'Sq_halfQ' ] = self.g_dbase['Sq_halfQ'] .astype(numpy.float32)
+        grp[ 'Sq_bound' ] = self.g_dbase['Sq_bound'] .astype(numpy.float32)
+        grp[ 'Sq_free' ] = self.g_dbase['Sq_free'] .astype(numpy.float32)
 
     ##############################################################################
 
@@ -565,8 +615,10 @@ class PMIDemo(object):
 
     def f_time_evolution(self) :
 
-        for step in range( 1 , self.g_s2e['steps'] + 1 ) :
-            self.f_save_snp( step )
+        # Keep the output file open for all snapshots.
+        with h5py.File( self.g_s2e['setup']['pmi_out'] , "a" ) as xfp :
+            for step in range( 1 , self.g_s2e['steps'] + 1 ) :
+                self.f_save_snp( step , xfp )
 
 
 
@@ -644,15 +696,8 @@ def s2e_gen_randrot_quat( quat , rotmat ) :
 
 def s2e_rand_orient( r ,mat ) :
 
-    N = r.shape[0]
-###    print N
-    vv = numpy.zeros((3,0))
-    for ii in range(N) :
-        vv = r[ii,:]
-###        print vv , vv.shape , mat.shape
-        r[ii,0] = mat[0] * vv[0] + mat[1] * vv[1] + mat[2] * vv[2]
-        r[ii,1] = mat[3] * vv[0] + mat[4] * vv[1] + mat[5] * vv[2]
-        r[ii,2] = mat[6] * vv[0] + mat[7] * vv[1] + mat[8] * vv[2]
+    # Rotate all atoms in place, mat is the row-major flattened 3x3 rotation matrix.
+    r[:] = numpy.dot( r , numpy.reshape( mat , (3,3) ).T )
 
 
 ##############################################################################
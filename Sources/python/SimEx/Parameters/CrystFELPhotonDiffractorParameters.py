@@ -44,6 +44,7 @@ class CrystFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
                 poissonize=None,
                 number_of_background_photons=None,
                 suppress_fringes=None,
+                number_of_shards=None,
                 beam_parameters=None,
                 detector_geometry=None,
                 **kwargs
@@ -79,6 +80,9 @@ class CrystFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
         :param suppress_fringes: Whether to suppress subsidiary maxima beyond first minimum of the shape transform (default False).
         :type suppress_fringes: bool
 
+        :param number_of_shards: Split the patterns into this many independent pattern_sim runs, executed concurrently (default 1). Each shard is seeded randomly (pattern_sim --really-random), also without uniform_rotation, so that shards differ. Sharded runs are therefore not reproducible.
+        :type number_of_shards: int
+
         :param beam_parameters: Path of the beam parameter file.
         :type beam_parameters: str
 
@@ -96,6 +100,7 @@ class CrystFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
         self.poissonize = poissonize
         self.number_of_background_photons = number_of_background_photons
         self.suppress_fringes = suppress_fringes
+        self.number_of_shards = number_of_shards
 
         # Handle single size case:
         if self.crystal_size_min is None or self.crystal_size_max is None:
@@ -179,3 +184,15 @@ class CrystFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
     def suppress_fringes(self, val):
         """ Set the 'suppress_fringes' parameter to val."""
         self.__suppress_fringes = checkAndSetInstance( bool, val, False)
+
+    @property
+    def number_of_shards(self):
+        """ Query the 'number_of_shards' parameter. """
+        return self.__number_of_shards
+    @number_of_shards.setter
+    def number_of_shards(self, val):
+        """ Set the 'number_of_shards' parameter to val."""
+        number_of_shards = checkAndSetInstance( int, val, 1)
+        if number_of_shards < 1:
+            raise ValueError("The parameter 'number_of_shards' must be a positive integer.")
+        self.__number_of_shards = number_of_shards
@@ -34,6 +34,7 @@ class DMPhasingParameters(AbstractCalculatorParameters):
                  averaging_start         = None,
                  leash                   = None,
                  number_of_shrink_cycles = None,
+                 number_of_processes     = None,
                  parameters_dictionary = None,
                  **kwargs
                 ):
@@ -52,6 +53,9 @@ class DMPhasingParameters(AbstractCalculatorParameters):
 
         :param number_of_shrink_cycles: DM shrink cycles.
         :type number_of_shrink_cycles: int>0, default 10
+
+        :param number_of_processes: How many trials to run at the same time. With more than one process, each trial runs as an independent DM instance in its own directory, and the average of the aligned trials and the best trial are saved.
+        :type number_of_processes: int>0, default 1 (all trials in one DM instance)
         """
 
         # Legacy support for dictionaries.
@@ -61,6 +65,7 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.averaging_start = parameters_dictionary['averaging_start']
             self.leash = parameters_dictionary['leash']
             self.number_of_shrink_cycles = parameters_dictionary['number_of_shrink_cycles']
+            self.number_of_processes = parameters_dictionary.get('number_of_processes', None)
 
         else:
             # Check all parameters.
@@ -69,6 +74,7 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.averaging_start = averaging_start
             self.leash = leash
             self.number_of_shrink_cycles = number_of_shrink_cycles
+            self.number_of_processes = number_of_processes
 
     def _setDefaults(self):
         """ """
@@ -159,3 +165,19 @@ class DMPhasingParameters(AbstractCalculatorParameters):
             self.__number_of_shrink_cycles = number_of_shrink_cycles
         else:
             raise ValueError( "The parameter 'number_of_shrink_cycles' must be a positive integer.")
+
+    @property
+    def number_of_processes(self):
+        """ Query for the 'number_of_processes' parameter. """
+        return self.__number_of_processes
+    @number_of_processes.setter
+    def number_of_processes(self, value):
+        """ Set the 'number_of_processes' parameter to a given value.
+        :param value : The value to set 'number_of_processes' to.
+        :type value: int
+        """
+        number_of_processes = checkAndSetInstance( int, value, 1 )
+        if number_of_processes > 0:
+            self.__number_of_processes = number_of_processes
+        else:
+            raise ValueError( "The parameter 'number_of_processes' must be a positive integer.")
@@ -35,6 +35,7 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
                 min_error=None,
                 beamstop=None,
                 detailed_output=None,
+                number_of_processes=None,
                 parameters_dictionary=None,
                 **kwargs
                 ):
@@ -57,6 +58,9 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         :param detailed_output: Whether to write detailed info to log.
         :type detailed_output: bool, default True
 
+        :param number_of_processes: Number of processes that convert the input patterns to the sparse photons file.
+        :type number_of_processes: int (>0), default 1
+
         """
         # Legacy support for dictionaries.
         if parameters_dictionary is not None:
@@ -66,6 +70,7 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
             self.max_number_of_iterations = parameters_dictionary['max_number_of_iterations']
             self.beamstop = parameters_dictionary['beamstop']
             self.detailed_output = parameters_dictionary['detailed_output']
+            self.number_of_processes = parameters_dictionary.get('number_of_processes', None)
 
         else:
             # Check all parameters.
@@ -75,6 +80,7 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
             self.max_number_of_iterations = max_number_of_iterations
             self.beamstop = beamstop
             self.detailed_output = detailed_output
+            self.number_of_processes = number_of_processes
 
         super(EMCOrientationParameters, self).__init__(**kwargs)
 
@@ -169,3 +175,19 @@ class EMCOrientationParameters(AbstractCalculatorParameters):
         :param value: The value to set 'detailed_output' to.
         """
         self.__detailed_output = checkAndSetInstance( bool, value, True )
+
+    @property
+    def number_of_processes(self):
+        """ Query for the 'number_of_processes' parameter. """
+        return self.__number_of_processes
+    @number_of_processes.setter
+    def number_of_processes(self, value):
+        """ Set the 'number_of_processes' parameter to a given value.
+        :param value: The value to set 'number_of_processes' to.
+        """
+        number_of_processes = checkAndSetInstance( int, value, 1 )
+
+        if number_of_processes > 0:
+            self.__number_of_processes = number_of_processes
+        else:
+            raise ValueError( "The parameter 'number_of_processes' must be a positive integer.")
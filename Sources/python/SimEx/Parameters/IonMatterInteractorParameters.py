@@ -15,6 +15,7 @@ class IonMatterInteractorParameters(AbstractCalculatorParameters):
                 target_density=None,
                 ion_name=None,
                 xsec_file=None,
+                chunk_size=None,
                 **kwargs
                 ):
         self.energy_bin = energy_bin
@@ -24,6 +25,7 @@ class IonMatterInteractorParameters(AbstractCalculatorParameters):
         self.target_density = target_density
         self.ion_name = ion_name
         self.xsec_file = xsec_file
+        self.chunk_size = chunk_size
 
         super(IonMatterInteractorParameters, self).__init__(**kwargs)
 
@@ -87,4 +89,15 @@ class IonMatterInteractorParameters(AbstractCalculatorParameters):
 
     @ion_name.setter
     def ion_name(self, val):
-        self.__ion_name = checkAndSetInstance(str, val, 'deuteron')
\ No newline at end of file
+        self.__ion_name = checkAndSetInstance(str, val, 'deuteron')
+
+    @property
+    def chunk_size(self):
+        return self.__chunk_size
+
+    @chunk_size.setter
+    def chunk_size(self, val):
+        chunk_size = checkAndSetInstance(int, val, None)
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError("The parameter 'chunk_size' must be a positive integer.")
+        self.__chunk_size = chunk_size
@@ -44,6 +44,9 @@ class SingFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
                 beam_parameters=None,
                 detector_geometry=None,
                 number_of_MPI_processes=None,
+                consolidate_output=None,
+                compression=None,
+                orientation_batch_size=None,
                 **kwargs
                 ):
         """
@@ -62,6 +65,15 @@ class SingFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
         :param pmi_stop_ID: Identifier for the last pmi trajectory to read in.
         :type pmi_stop_ID: int, default 1
 
+        :param consolidate_output: Whether to write all patterns into one chunked dataset in a single output file instead of one file per process linked into a master file.
+        :type consolidate_output: bool, default False
+
+        :param compression: HDF5 compression filter for the consolidated pattern datasets ("gzip" or "lzf").
+        :type compression: str, default None (no compression)
+
+        :param orientation_batch_size: Number of orientations for which the structure factor of a pdb sample is evaluated at once. With 1, each pattern is calculated by pysingfel.
+        :type orientation_batch_size: int, default 1
+
         """
         super(SingFELPhotonDiffractorParameters, self).__init__(sample=sample,
                                                                 uniform_rotation=uniform_rotation,
@@ -77,6 +89,9 @@ class SingFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
         self.number_of_slices               = number_of_slices
         self.pmi_start_ID                   = pmi_start_ID
         self.pmi_stop_ID                    = pmi_stop_ID
+        self.consolidate_output             = consolidate_output
+        self.compression                    = compression
+        self.orientation_batch_size         = orientation_batch_size
 
 
     def _setDefaults(self):
@@ -157,3 +172,44 @@ class SingFELPhotonDiffractorParameters(AbstractPhotonDiffractorParameters):
         else:
             raise ValueError("The parameters 'pmi_stop_ID' must be a positive integer.")
 
+
+    @property
+    def consolidate_output(self):
+        """ Query for the 'consolidate_output' parameter. """
+        return self.__consolidate_output
+    @consolidate_output.setter
+    def consolidate_output(self, value):
+        """ Set the 'consolidate_output' parameter to a given value.
+        :param value: The value to set 'consolidate_output' to.
+        """
+        self.__consolidate_output = checkAndSetInstance( bool, value, False )
+
+    @property
+    def compression(self):
+        """ Query for the 'compression' parameter. """
+        return self.__compression
+    @compression.setter
+    def compression(self, value):
+        """ Set the 'compression' parameter to a given value.
+        :param value: The value to set 'compression' to.
+        """
+        compression = checkAndSetInstance( str, value, None )
+        if compression not in [None, "gzip", "lzf"]:
+            raise ValueError("The parameter 'compression' must be None, 'gzip', or 'lzf'.")
+
+        self.__compression = compression
+
+    @property
+    def orientation_batch_size(self):
+        """ Query for the 'orientation_batch_size' parameter. """
+        return self.__orientation_batch_size
+    @orientation_batch_size.setter
+    def orientation_batch_size(self, value):
+        """ Set the 'orientation_batch_size' parameter to a given value.
+        :param value: The value to set 'orientation_batch_size' to.
+        """
+        orientation_batch_size = checkAndSetInstance( int, value, 1 )
+        if orientation_batch_size > 0:
+            self.__orientation_batch_size = orientation_batch_size
+        else:
+            raise ValueError("The parameter 'orientation_batch_size' must be a positive integer.")
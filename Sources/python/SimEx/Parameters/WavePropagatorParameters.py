@@ -33,6 +33,7 @@ class WavePropagatorParameters(AbstractCalculatorParameters):
     def __init__(self,
                  use_opmd = None,
                  beamline = None,
+                 scheduling = None,
                  **kwargs
                 ):
         """
@@ -42,11 +43,15 @@ class WavePropagatorParameters(AbstractCalculatorParameters):
         :param beamline: The WPG beamline to use in the propagation.
         :type beamline: class or module that defines a function
         `get_beamline`, which in turn returns a WPG.Beamline instance.
+
+        :param scheduling: How input files are distributed over processes ("static" | "dynamic"). "static" assigns files round-robin, "dynamic" hands out the next file to whichever process is free and reports per-file timings. With MPI, rank 0 only hands out files in dynamic mode.
+        :type scheduling: str, default "static"
         """
 
         # Check all parameters.
         self.use_opmd = use_opmd
         self.beamline = beamline
+        self.scheduling = scheduling
 
         # Initialize base class.
         super(WavePropagatorParameters, self).__init__(**kwargs)
@@ -83,3 +88,18 @@ class WavePropagatorParameters(AbstractCalculatorParameters):
 
         # Ok, store on object.
         self.__beamline = value
+
+    @property
+    def scheduling(self):
+        """ Query for the 'scheduling' parameter. """
+        return self.__scheduling
+    @scheduling.setter
+    def scheduling(self, value):
+        """ Set the 'scheduling' parameter to a given value.
+        @param value : The value to set 'scheduling' to ("static" | "dynamic").
+        """
+        scheduling = checkAndSetInstance( str, value, "static" )
+        if scheduling not in ["static", "dynamic"]:
+            raise ValueError('The parameter "scheduling" must be "static" or "dynamic".')
+
+        self.__scheduling = scheduling
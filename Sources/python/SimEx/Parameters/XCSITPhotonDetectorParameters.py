@@ -42,6 +42,7 @@ class XCSITPhotonDetectorParameters(AbstractCalculatorParameters):
                  plasma_simulation_flag=None,
                  point_simulation_method=None,
                  patterns=None,
+                 number_of_processes=None,
                 ):
         """
         :param detector_type: The detector type to simulate ("pnCCD" | "LPD" | "AGIPD | "AGIPDSPB").
@@ -61,6 +62,9 @@ class XCSITPhotonDetectorParameters(AbstractCalculatorParameters):
         :example patterns: patterns=0 # use the first pattern.
         :example patterns: patterns=range(10) # use the first 10 patterns
         :example patterns: patterns=['0000001','0001001'] # user patterns with Ids  '0000001' and '0001001'.
+
+        :param number_of_processes: Number of worker processes that each simulate whole patterns (default 1). With more than one process, finished patterns are written to the output file immediately.
+        :type number_of_processes: int
         """
 
         # Prohibit calling the detector with nothing
@@ -88,6 +92,7 @@ class XCSITPhotonDetectorParameters(AbstractCalculatorParameters):
         self.plasma_simulation_flag = plasma_simulation_flag
         self.patterns = patterns
         self.point_simulation_method = point_simulation_method
+        self.number_of_processes = number_of_processes
 
 
     def _setDefaults(self):
@@ -147,6 +152,22 @@ class XCSITPhotonDetectorParameters(AbstractCalculatorParameters):
             self.__patterns = [val]
         ### TODO: more sanity checks (all items of same type, only int or str allowed).
 
+    @property
+    def number_of_processes(self):
+        """
+        :return: The number of worker processes.
+        """
+        return self.__number_of_processes
+    @number_of_processes.setter
+    def number_of_processes(self, value):
+        """
+        :param value, a positive int, the number of worker processes
+        """
+        number_of_processes = checkAndSetInstance(int, value, 1)
+        if number_of_processes < 1:
+            raise ValueError("The parameter 'number_of_processes' must be a positive integer.")
+        self.__number_of_processes = number_of_processes
+
     @property
     def plasma_search_flag(self):
         """
@@ -20,7 +20,12 @@
 #                                                                        #
 ##########################################################################
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import h5py
 import os
+import queue
+import shutil
 
 from SimEx.Calculators.AbstractPhotonAnalyzer import checkAndSetPhotonAnalyzer
 from SimEx.Calculators.AbstractPhotonDetector import checkAndSetPhotonDetector
@@ -140,46 +145,66 @@ class PhotonExperimentSimulation(object):
     def photon_analyzer(self, value):
         self.__photon_analyzer = checkAndSetPhotonAnalyzer(value)
 
-    def run(self):
-        """ Method to start the photon experiment simulation workflow. """
+    def run(self, pipelined=False, cache=None):
+        """ Method to start the photon experiment simulation workflow.
+
+        :param pipelined: Whether to overlap the photon-matter interaction and diffraction stages pulse by pulse (default False).
+        :type pipelined: bool
+
+        :param cache: Cache of calculator outputs. Stages whose class, parameters and input are unchanged since a previous run reuse the cached output instead of running again (default None, i.e. no caching).
+        :type cache: ResultCache
+
+        In pipelined mode, each propagated pulse is handed to a copy of the interactor and, as soon as that pulse is done, to a copy of the diffractor while the interactor moves on to the next pulse.
+        Each copy runs its complete _readH5(), backengine(), saveH5() sequence.
+        If the diffractor has a 'number_of_diffraction_patterns' parameter, the patterns are split over the pulses, so the run produces as many patterns as a serial run.
+        Per-pulse results are collected and renumbered into the interactor's and diffractor's output directories.
+        The pipelined stages are not cached.
+        Pipelined runs cannot collect consolidated diffractor output, i.e. a diffractor with 'consolidate_output' set.
+        """
 
         if not self._checkInterfaceConsistency():
             raise RuntimeError(
                 " Interfaces are not consistent, i.e. at least one module's expectations with respect to incoming data sets are not satisfied."
             )
 
+        # Per-pulse consolidated files would be collected as if they held one pattern each.
+        if pipelined and getattr(self.__photon_diffractor.parameters, 'consolidate_output', False):
+            raise RuntimeError(
+                " Pipelined runs do not support consolidated diffractor output, set consolidate_output=False or run without pipelining."
+            )
+
         print('\n'.join(["#" * 80, "# Starting SIMEX run.", "#" * 80]))
         print('\n'.join(
             ["#" * 80, "# Starting SIMEX photon source.", "#" * 80]))
-        self.__photon_source._readH5()
-        self.__photon_source.backengine()
-        self.__photon_source.saveH5()
+        self.__photon_source.runCached(cache)
 
         print('\n'.join(
             ["#" * 80, "# Starting SIMEX photon propagation.", "#" * 80]))
-        self.__photon_propagator._readH5()
-        self.__photon_propagator.backengine()
-        self.__photon_propagator.saveH5()
+        self.__photon_propagator.runCached(cache)
 
-        print('\n'.join([
-            "#" * 80, "# Starting SIMEX photon-matter interaction.", "#" * 80
-        ]))
-        self.__photon_interactor._readH5()
-        self.__photon_interactor.backengine()
-        self.__photon_interactor.saveH5()
+        pulse_files = _pulseFiles(self.__photon_propagator.output_path)
+        if pipelined and len(pulse_files) > 1:
+            print('\n'.join([
+                "#" * 80,
+                "# Starting SIMEX pipelined photon-matter interaction and diffraction.",
+                "#" * 80
+            ]))
+            self._runPipelined(pulse_files)
 
-        print('\n'.join(
-            ["#" * 80, "# Starting SIMEX photon diffraction.", "#" * 80]))
-        self.__photon_diffractor._readH5()
-        self.__photon_diffractor.backengine()
-        self.__photon_diffractor.saveH5()
+        else:
+            print('\n'.join([
+                "#" * 80, "# Starting SIMEX photon-matter interaction.", "#" * 80
+            ]))
+            self.__photon_interactor.runCached(cache)
+
+            print('\n'.join(
+                ["#" * 80, "# Starting SIMEX photon diffraction.", "#" * 80]))
+            self.__photon_diffractor.runCached(cache)
 
         if self.__photon_detector is not None:
             print('\n'.join(
                 ["#" * 80, "# Starting SIMEX photon detection.", "#" * 80]))
-            self.__photon_detector._readH5()
-            self.__photon_detector.backengine()
-            self.__photon_detector.saveH5()
+            self.__photon_detector.runCached(cache)
 
         # If no detector is present, link diffr out to analysis in. If already exists, do nothing.
         else:
@@ -190,12 +215,75 @@ class PhotonExperimentSimulation(object):
 
         print('\n'.join(
             ["#" * 80, "# Starting SIMEX photon signal analysis.", "#" * 80]))
-        self.__photon_analyzer._readH5()
-        self.__photon_analyzer.backengine()
-        self.__photon_analyzer.saveH5()
+        self.__photon_analyzer.runCached(cache)
 
         print('\n'.join(["#" * 80, "# SIMEX  done.", "#" * 80]))
 
+    def _runPipelined(self, pulse_files):
+        """
+        Run the interactor and diffractor as a two stage pipeline over the given pulse files.
+
+        :param pulse_files: The propagated pulse files, one per pulse.
+        :type pulse_files: list
+        """
+        interactor = self.__photon_interactor
+        diffractor = self.__photon_diffractor
+
+        for calculator in (interactor, diffractor):
+            if os.path.isfile(calculator.output_path):
+                raise IOError(
+                    "Output path %s is a file, pipelined runs need an output directory."
+                    % (calculator.output_path))
+            os.makedirs(calculator.output_path, exist_ok=True)
+
+        # Number of patterns each pulse contributes, such that the total matches a serial run.
+        pattern_shares = _patternShares(diffractor, len(pulse_files))
+
+        # Interactor copies of finished pulses, in order. None signals the end.
+        handover = queue.Queue()
+
+        def interact():
+            try:
+                for i, pulse_file in enumerate(pulse_files):
+                    pmi = _runForPulse(interactor, pulse_file,
+                                       _pulseOutputPath(interactor.output_path, i))
+                    handover.put((i, pmi))
+            finally:
+                handover.put(None)
+
+        def diffract():
+            pmi_pulses = []
+            diffr_pulses = []
+            while True:
+                item = handover.get()
+                if item is None:
+                    break
+                i, pmi = item
+                pmi_pulses.append(pmi)
+
+                if pattern_shares is None:
+                    number_of_patterns = None
+                elif pattern_shares[i] > 0:
+                    number_of_patterns = pattern_shares[i]
+                else:
+                    continue
+
+                diffr_pulses.append(
+                    _runForPulse(diffractor, pmi.output_path,
+                                 _pulseOutputPath(diffractor.output_path, i),
+                                 number_of_patterns))
+            return pmi_pulses, diffr_pulses
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            interactor_future = executor.submit(interact)
+            diffractor_future = executor.submit(diffract)
+            # Re-raise exceptions from either stage.
+            interactor_future.result()
+            pmi_pulses, diffr_pulses = diffractor_future.result()
+
+        _collectPulseOutput(pmi_pulses, interactor.output_path)
+        _collectPulseOutput(diffr_pulses, diffractor.output_path)
+
     def _checkInterfaceConsistency(self):
         """
         Check that all calculators provide the data expected by the next downstream
@@ -212,3 +300,182 @@ class PhotonExperimentSimulation(object):
                        str(provided_data_set).replace(',', '\n'),
                        str(expected_data_set).replace(',', '\n')))
         return status
+
+
+def _pulseFiles(path):
+    """ Utility to list the per-pulse hdf5 files found under the given path.
+
+    :param path: Path to a single file or to a directory of files.
+    :type path: str
+
+    :return: The sorted list of files.
+    """
+    if os.path.isdir(path):
+        files = [
+            os.path.join(path, f) for f in os.listdir(path)
+            if f.split('.')[-1] == 'h5' and f.split('.')[-2] != 'opmd'
+        ]
+        files.sort()
+        return files
+
+    return [path]
+
+
+def _pulseOutputPath(output_path, index):
+    """ Utility to get the output path of a calculator copy running a single pulse.
+
+    Each pulse gets its own work directory inside the stage's output directory, so that everything the copy writes, including files written next to its output path, stays together.
+
+    :param output_path: The stage's output directory.
+    :type output_path: str
+
+    :param index: Index of the pulse, starting at 0.
+    :type index: int
+
+    :return: The output path for this pulse.
+    """
+    pulse_dir = os.path.join(output_path, '.pulse_%07d' % (index + 1))
+    os.makedirs(pulse_dir, exist_ok=True)
+
+    return os.path.join(pulse_dir, os.path.basename(os.path.normpath(output_path)))
+
+
+def _patternShares(calculator, number_of_pulses):
+    """ Utility to split the calculator's number of diffraction patterns over the pulses.
+
+    :param calculator: The diffractor.
+    :type calculator: AbstractPhotonDiffractor
+
+    :param number_of_pulses: The number of pulses.
+    :type number_of_pulses: int
+
+    :return: The number of patterns per pulse, or None if the calculator has no 'number_of_diffraction_patterns' parameter.
+    """
+    parameters = calculator.parameters
+    if not hasattr(parameters, 'number_of_diffraction_patterns'):
+        return None
+
+    share, remainder = divmod(parameters.number_of_diffraction_patterns, number_of_pulses)
+
+    return [share + (1 if i < remainder else 0) for i in range(number_of_pulses)]
+
+
+def _runForPulse(calculator, input_path, output_path, number_of_patterns=None):
+    """ Utility to run a copy of the calculator on a single pulse.
+
+    The copy runs _readH5(), backengine() and saveH5(), so its output is complete before it is handed to the next stage.
+
+    :param calculator: The calculator to copy.
+    :type calculator: AbstractBaseCalculator
+
+    :param input_path: Input path for this pulse.
+    :type input_path: str
+
+    :param output_path: Output path for this pulse.
+    :type output_path: str
+
+    :param number_of_patterns: Number of diffraction patterns to calculate for this pulse (default None, i.e. as set in the calculator's parameters).
+    :type number_of_patterns: int
+
+    :return: The copy of the calculator.
+    """
+    pulse_calculator = copy.deepcopy(calculator)
+    pulse_calculator.input_path = input_path
+    pulse_calculator.output_path = output_path
+
+    if number_of_patterns is not None:
+        parameters = pulse_calculator.parameters
+        parameters.number_of_diffraction_patterns = number_of_patterns
+        # The input of a single pulse holds one pmi file only.
+        if hasattr(parameters, 'pmi_start_ID'):
+            parameters.pmi_start_ID = 1
+            parameters.pmi_stop_ID = 1
+
+    pulse_calculator._readH5()
+    pulse_calculator.backengine()
+    pulse_calculator.saveH5()
+
+    return pulse_calculator
+
+
+def _collectPulseOutput(pulse_calculators, output_path):
+    """ Utility to move the output of the per-pulse calculator copies into the stage's output directory.
+
+    If a copy wrote a directory of files, these files are collected, renumbered consecutively per file name prefix in the order of the pulses, e.g. the single 'pmi_out_0000001.h5' of the second pulse becomes 'pmi_out_0000002.h5'.
+    The calculator's saveH5() is then called on the collected files to write the stage's index file, if any.
+    If a copy wrote a single file, that file is collected as '<output directory name>_<pulse>.h5'.
+    Numbered groups under '/data' (e.g. diffraction pattern ids) are shifted so that they are unique across pulses.
+
+    :param pulse_calculators: The calculator copies that ran the pulses, in pulse order.
+    :type pulse_calculators: list
+
+    :param output_path: The directory to collect the files in.
+    :type output_path: str
+    """
+    counters = {}
+    key_offset = 0
+    index_calculator = None
+    for calculator in pulse_calculators:
+        pulse_output = calculator.output_path
+        if os.path.isdir(pulse_output) and os.listdir(pulse_output):
+            files = [os.path.join(pulse_output, f) for f in sorted(os.listdir(pulse_output))]
+            index_calculator = calculator
+        else:
+            files = [f for f in (pulse_output, pulse_output + '.h5') if os.path.isfile(f)]
+
+        number_of_keys = 0
+        for f in files:
+            stem, extension = os.path.splitext(os.path.basename(f))
+            prefix, _, index = stem.rpartition('_')
+            if not (prefix and index.isdigit()):
+                prefix = stem
+            counters[prefix] = counters.get(prefix, 0) + 1
+            target = os.path.join(output_path,
+                                  '%s_%07d%s' % (prefix, counters[prefix], extension or '.h5'))
+            shutil.move(f, target)
+            number_of_keys = max(number_of_keys, _shiftDataKeys(target, key_offset))
+        key_offset += number_of_keys
+
+        shutil.rmtree(os.path.dirname(pulse_output))
+
+    # Write the index over all collected files, e.g. the linking file of SingFELPhotonDiffractor.
+    if index_calculator is not None:
+        index_calculator = copy.deepcopy(index_calculator)
+        index_calculator.output_path = output_path
+        index_calculator.saveH5()
+
+
+def _shiftDataKeys(path, offset):
+    """ Utility to shift the numbered groups under '/data' of an hdf5 file by the given offset.
+
+    :param path: The file to modify.
+    :type path: str
+
+    :param offset: The offset to add to each group number.
+    :type offset: int
+
+    :return: The largest group number before shifting, 0 if there are none.
+    """
+    if not h5py.is_hdf5(path):
+        return 0
+
+    with h5py.File(path, 'a') as h5:
+        if 'data' not in h5 or not isinstance(h5['data'], h5py.Group):
+            return 0
+        data = h5['data']
+
+        # Consolidated output stores the ids in a dataset.
+        if 'pattern_id' in data:
+            pattern_ids = data['pattern_id']
+            largest = int(pattern_ids[()].max()) if pattern_ids.size else 0
+            if offset:
+                pattern_ids[...] = pattern_ids[()] + offset
+            return largest
+
+        keys = sorted((key for key in data.keys() if key.isdigit()), key=int, reverse=True)
+        if offset:
+            # Move the highest number first, so that no new name clashes with an old one.
+            for key in keys:
+                data.move(key, '%0*d' % (len(key), int(key) + offset))
+
+        return int(keys[0]) if keys else 0
@@ -0,0 +1,308 @@
+""":module ResultCache: Hosts a content-addressed cache for calculator outputs."""
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015-2020 Carsten Fortmann-Grote                         #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+#                                                                        #
+##########################################################################
+
+import hashlib
+import numpy
+import os
+import re
+import shutil
+
+from SimEx.AbstractBaseClass import AbstractBaseClass
+from SimEx.Utilities.EntityChecks import checkAndSetInstance
+
+# Default object representations, e.g. "<foo.Bar object at 0x7f...>".
+_ADDRESS_PATTERN = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+class ResultCache(object):
+    """
+    :class ResultCache: Content-addressed store of calculator outputs with least-recently-used eviction.
+    """
+
+    def __init__(self, cache_path=None, max_size=None):
+        """
+
+        :param cache_path: Directory where cached outputs are stored (default 'simex_cache').
+        :type cache_path: str
+
+        :param max_size: Maximum total size of the cache in bytes. Least recently used entries are removed when exceeded (default None, i.e. no limit).
+        :type max_size: int
+        """
+
+        self.__cache_path = os.path.abspath(
+            checkAndSetInstance(str, cache_path, 'simex_cache'))
+        self.__max_size = checkAndSetInstance(int, max_size, None)
+
+        os.makedirs(self.__cache_path, exist_ok=True)
+
+    @property
+    def cache_path(self):
+        """ Query for the cache directory. """
+        return self.__cache_path
+
+    @property
+    def max_size(self):
+        """ Query for the maximum cache size in bytes. """
+        return self.__max_size
+
+    def fetch(self, key, output_path):
+        """ Copy the output stored under the given key to the output path.
+
+        :param key: The cache key.
+        :type key: str
+
+        :param output_path: Where to place the cached output. A list of paths restores all outputs stored together.
+        :type output_path: str || list
+
+        :return: True if the key was found, False otherwise.
+        """
+        entry = os.path.join(self.__cache_path, key)
+        if not os.path.exists(_cachedOutput(entry, 0)):
+            return False
+
+        for i, path in enumerate(_outputPaths(output_path)):
+            _removePath(path)
+            # Outputs that did not exist when storing are left absent.
+            if os.path.exists(_cachedOutput(entry, i)):
+                _copyPath(_cachedOutput(entry, i), path)
+
+        # Mark as recently used.
+        os.utime(entry)
+
+        return True
+
+    def store(self, key, output_path):
+        """ Store a copy of the output under the given key and evict old entries if needed.
+
+        :param key: The cache key.
+        :type key: str
+
+        :param output_path: The output to store. A list of paths stores all outputs together, the first one must exist.
+        :type output_path: str || list
+        """
+        output_paths = _outputPaths(output_path)
+        if not os.path.exists(output_paths[0]):
+            return
+
+        entry = os.path.join(self.__cache_path, key)
+        _removePath(entry)
+
+        # Copy into a temporary entry first so a crash never leaves a partial entry behind.
+        tmp_entry = entry + '.tmp'
+        _removePath(tmp_entry)
+        os.makedirs(tmp_entry)
+        for i, path in enumerate(output_paths):
+            if os.path.exists(path):
+                _copyPath(path, _cachedOutput(tmp_entry, i))
+        os.rename(tmp_entry, entry)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is within its size limit. """
+        if self.__max_size is None:
+            return
+
+        entries = [
+            os.path.join(self.__cache_path, e)
+            for e in os.listdir(self.__cache_path)
+            if not e.endswith('.tmp')
+        ]
+        entries.sort(key=os.path.getmtime)
+        sizes = [_pathSize(e) for e in entries]
+        total = sum(sizes)
+
+        for entry, size in zip(entries, sizes):
+            if total <= self.__max_size:
+                break
+            _removePath(entry)
+            total -= size
+
+
+def hashObject(obj, hasher=None):
+    """ Compute a hash of a (possibly nested) python object, e.g. calculator parameters.
+
+    :param obj: The object to hash.
+
+    :param hasher: Hash object to update (default None, i.e. a new sha256).
+
+    :return: The hex digest.
+    :rtype: str
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+
+    _updateHash(hasher, obj)
+
+    return hasher.hexdigest()
+
+
+def hashContent(path, hasher=None):
+    """ Compute a hash of the content of a file or of all files in a directory.
+
+    Non-existing paths are hashed by name.
+
+    :param path: The file or directory to hash.
+    :type path: str
+
+    :param hasher: Hash object to update (default None, i.e. a new sha256).
+
+    :return: The hex digest.
+    :rtype: str
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+
+    if isinstance(path, (list, tuple)):
+        for p in path:
+            hashContent(p, hasher)
+        return hasher.hexdigest()
+
+    if os.path.isfile(path):
+        _updateHashFromFile(hasher, path)
+
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                file_path = os.path.join(root, f)
+                hasher.update(
+                    os.path.relpath(file_path, path).encode('utf-8'))
+                _updateHashFromFile(hasher, file_path)
+
+    else:
+        hasher.update(str(path).encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+def referencedFiles(obj):
+    """ Find the existing files referenced by path in a (possibly nested) python object, e.g. a geometry file named in calculator parameters.
+
+    :param obj: The object to search.
+
+    :return: The sorted list of file paths.
+    :rtype: list
+    """
+    paths = set()
+    _collectFiles(obj, paths)
+
+    return sorted(paths)
+
+
+def _updateHash(hasher, obj):
+    """ """
+    hasher.update(type(obj).__name__.encode('utf-8'))
+
+    if isinstance(obj, dict):
+        for key in sorted(obj.keys(), key=str):
+            _updateHash(hasher, key)
+            _updateHash(hasher, obj[key])
+
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _updateHash(hasher, item)
+
+    elif isinstance(obj, numpy.ndarray):
+        hasher.update(str((obj.dtype, obj.shape)).encode('utf-8'))
+        hasher.update(numpy.ascontiguousarray(obj).tobytes())
+
+    elif isinstance(obj, AbstractBaseClass) or _hasDefaultRepr(obj):
+        _updateHash(hasher, vars(obj))
+
+    else:
+        representation = repr(obj)
+        # Memory addresses differ from run to run and would never give a cache hit.
+        if _ADDRESS_PATTERN.search(representation):
+            raise TypeError("Cannot compute a stable hash of %s, its representation contains a memory address." % (representation))
+        hasher.update(representation.encode('utf-8'))
+
+
+def _hasDefaultRepr(obj):
+    """ """
+    return type(obj).__repr__ is object.__repr__ and hasattr(obj, '__dict__')
+
+
+def _collectFiles(obj, paths):
+    """ """
+    if isinstance(obj, str):
+        if os.path.isfile(obj):
+            paths.add(obj)
+
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _collectFiles(value, paths)
+
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _collectFiles(item, paths)
+
+    elif isinstance(obj, AbstractBaseClass) or _hasDefaultRepr(obj):
+        _collectFiles(vars(obj), paths)
+
+
+def _outputPaths(output_path):
+    """ """
+    if isinstance(output_path, str):
+        return [output_path]
+
+    return list(output_path)
+
+
+def _cachedOutput(entry, index):
+    """ """
+    return os.path.join(entry, 'output_%d' % (index))
+
+
+def _updateHashFromFile(hasher, path, block_size=1 << 20):
+    """ """
+    with open(path, 'rb') as file_handle:
+        for block in iter(lambda: file_handle.read(block_size), b''):
+            hasher.update(block)
+
+
+def _copyPath(source, target):
+    """ """
+    if os.path.isdir(source):
+        shutil.copytree(source, target, symlinks=True)
+    else:
+        shutil.copy2(source, target)
+
+
+def _removePath(path):
+    """ """
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def _pathSize(path):
+    """ """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+    return size
@@ -83,12 +83,9 @@ def convertToOPMD(beam, number_of_x_bins=None, number_of_y_bins=None, number_of_
         print(" Setup file structure.")
         opmd.setup_root_attr( opmd_h5 )
 
-        # Get 3D intensity histogram.
-        xyz_array = numpy.empty((number_of_rays, 3))
-        print((xyz_array.shape))
-        xyz_array[:,0] = beam["X"]
-        xyz_array[:,1] = -beam["Z"]
-        xyz_array[:,2] = -c*beam["Y"]
+        # Get the histogram bin of each ray in x-y-t space once, then accumulate all fields from it.
+        bins = [number_of_x_bins, number_of_y_bins, number_of_t_bins]
+        ray_bins, xyt_edges = _binIndices([beam["X"], -beam["Z"], -c*beam["Y"]], bins)
 
         # Get E fields in cartesian components.
         E_s = numpy.sqrt(beam["I_s"]) * numpy.exp(1j*beam["phi_s"])
@@ -99,57 +96,25 @@ def convertToOPMD(beam, number_of_x_bins=None, number_of_y_bins=None, number_of_
         N_p = beam["I_p"] / beam["photon_energy"] / e
 
         # Get fields, number of photons and phases via histograms.
-        E_horz_real, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=numpy.real(E_s),
-                                        )
-        E_horz_imag, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=numpy.imag(E_s),
-                                        )
-        E_vert_real, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=numpy.real(E_p),
-                                        )
-        E_vert_imag, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=numpy.imag(E_p),
-                                        )
-
-        Nph_horz, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=N_s,
-                                        )
-
-        Nph_vert, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=N_p
-                                        )
-        phi_horz, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=beam["phi_s"],
-                                        )
-
-        phi_vert, xyt_edges = numpy.histogramdd(sample=xyz_array,
-                                        bins=[number_of_x_bins, number_of_y_bins, number_of_t_bins],
-                                        normed=False,
-                                        weights=beam["phi_p"]
-                                        )
-
-
-        index_vs_t = numpy.empty((number_of_rays, 2))
-        index_vs_t[:,0] = -c*beam["Y"]
-        index_vs_t[:,1] = beam["ray_index"]
-        rays_histogram, t_edges, index_edges = numpy.histogram2d(x=-c*beam["Y"],
-                                                    y=beam["ray_index"],
-                                                    bins=[number_of_t_bins, number_of_rays+1],)
+        E_horz_real = _histogram(ray_bins, bins, numpy.real(E_s))
+        E_horz_imag = _histogram(ray_bins, bins, numpy.imag(E_s))
+        E_vert_real = _histogram(ray_bins, bins, numpy.real(E_p))
+        E_vert_imag = _histogram(ray_bins, bins, numpy.imag(E_p))
+
+        Nph_horz = _histogram(ray_bins, bins, N_s)
+        Nph_vert = _histogram(ray_bins, bins, N_p)
+
+        phi_horz = _histogram(ray_bins, bins, beam["phi_s"])
+        phi_vert = _histogram(ray_bins, bins, beam["phi_p"])
+
+        del E_s, E_p, N_s, N_p
+
+        # Segment the rays by time bin, keeping their original order within each bin.
+        t_bins = ray_bins % number_of_t_bins
+        del ray_bins
+        rays_by_t = numpy.argsort(t_bins, kind='stable')
+        t_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(t_bins, minlength=number_of_t_bins))))
+        del t_bins
 
         # Get bin centers and bin lengths
         x_los = xyt_edges[0][:-1]
@@ -191,11 +156,9 @@ def convertToOPMD(beam, number_of_x_bins=None, number_of_y_bins=None, number_of_
 
             ### PARTICLES (PHOTONS)
             # Get all photons in this time slice.
-            it_rays= numpy.where( -c*beam["Y"] >= t_los[it] )
-            tmp = beam["Y"][it_rays]
-            it_rays = numpy.where( -c*tmp <= t_his[it] )[0].tolist()
+            it_rays = rays_by_t[t_offsets[it]:t_offsets[it+1]]
             number_of_it_rays = len(it_rays)
-            print(("Rays in this slice (it=%d) : %s (length %d)" % (it, str(it_rays), number_of_it_rays)))
+            print(("Rays in this slice (it=%d) : %d" % (it, number_of_it_rays)))
 
             # Path to the photons
             print(" Setup photons.")
@@ -382,6 +345,38 @@ def convertToOPMD(beam, number_of_x_bins=None, number_of_y_bins=None, number_of_
         print(" Closing hdf5 file.")
     print("... Conversion done.")
 
+def _binIndices(coordinates, bins):
+    """ """
+    """ Get the flat (C ordered) histogram bin index of each point, with bins as in numpy.histogramdd.
+
+    :param coordinates: The coordinate arrays, one per dimension.
+    :type coordinates: list
+
+    :param bins: The number of bins in each dimension.
+    :type bins: list
+
+    :return: The bin index of each point and the bin edges in each dimension.
+    :rtype: tuple
+    """
+    flat_indices = 0
+    edges = []
+    for coordinate, number_of_bins in zip(coordinates, bins):
+        coordinate_edges = numpy.histogram_bin_edges(coordinate, bins=number_of_bins)
+        indices = numpy.searchsorted(coordinate_edges, coordinate, side='right') - 1
+
+        # The last bin includes its upper edge.
+        indices[coordinate == coordinate_edges[-1]] -= 1
+
+        flat_indices = flat_indices * number_of_bins + indices
+        edges.append(coordinate_edges)
+
+    return flat_indices, edges
+
+def _histogram(flat_indices, bins, weights):
+    """ """
+    """ Sum the weights of all points in each bin. """
+    return numpy.bincount(flat_indices, weights=weights, minlength=numpy.prod(bins)).reshape(bins)
+
 
 ###################333
 print("Getting data from beam object.")
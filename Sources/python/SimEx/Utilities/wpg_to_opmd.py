@@ -19,7 +19,12 @@
 #                                                                        #
 ##########################################################################
 
+import functools
+import glob
+import json
 import math
+import multiprocessing
+import os
 from argparse import ArgumentParser
 
 import h5py
@@ -33,6 +38,9 @@ c = constants.speed_of_light
 eps0 = constants.epsilon_0
 e = constants.e
 
+# Memory budget for the time slices read at once per field.
+_SLAB_BYTES = 256 * 1024**2
+
 OPMD_DATATYPES={
                 0 :opmd.Datatype.CHAR,
                 1 :opmd.Datatype.UCHAR,
@@ -67,11 +75,17 @@ OPMD_DATATYPES={
                 }
 
 
-def convertToOPMD(input_file):
+def convertToOPMD(input_file, slab_size=None, dataset_options=None):
     """ Take native wpg output and rewrite in openPMD conformant way.
     :param input_file: The hdf5 file to be converted.
     :type  input_file: string
 
+    :param slab_size: Number of time slices to read at once (default None, i.e. as many as fit into 256 MB).
+    :type slab_size: int
+
+    :param dataset_options: openPMD dataset configuration (JSON) for the field records (default None, i.e. one chunk per time slice).
+    :type dataset_options: str
+
     :example: convertToOPMD(input_file="prop_out.h5")
     """
     # Check input file.
@@ -157,108 +171,114 @@ def convertToOPMD(input_file):
         series.set_attribute("photon energy unit dimension", [2,1,-2,0,0,0,0])
         series.set_attribute("photon energy UnitSI", e)
 
-        for time_step in range(number_of_time_steps):
-
-            E_hor_real = series.iterations[time_step+1].meshes["E_real"]["x"]
-            E_hor_imag = series.iterations[time_step+1].meshes["E_imag"]["x"]
-            E_ver_real = series.iterations[time_step+1].meshes["E_real"]["y"]
-            E_ver_imag = series.iterations[time_step+1].meshes["E_imag"]["y"]
-
-            ehor_re = h5['data/arrEhor'][:, :, time_step, 0].astype(numpy.float64)
-            ehor_im = h5['data/arrEhor'][:, :, time_step, 1].astype(numpy.float64)
-            ever_re = h5['data/arrEver'][:, :, time_step, 0].astype(numpy.float64)
-            ever_im = h5['data/arrEver'][:, :, time_step, 1].astype(numpy.float64)
-
-            ehor_re_dataset = opmd.Dataset(ehor_re.dtype, [number_of_x_meshpoints, number_of_y_meshpoints])
-            ehor_im_dataset = opmd.Dataset(ehor_im.dtype, [number_of_x_meshpoints, number_of_y_meshpoints])
-            ever_re_dataset = opmd.Dataset(ever_re.dtype, [number_of_x_meshpoints, number_of_y_meshpoints])
-            ever_im_dataset = opmd.Dataset(ever_im.dtype, [number_of_x_meshpoints, number_of_y_meshpoints])
-
-            E_hor_real.reset_dataset(ehor_re_dataset)
-            E_hor_imag.reset_dataset(ehor_im_dataset)
-            E_ver_real.reset_dataset(ever_re_dataset)
-            E_ver_imag.reset_dataset(ever_im_dataset)
-
-            E_hor_real[()] = ehor_re
-            E_hor_imag[()] = ehor_im
-            E_ver_real[()] = ehor_re
-            E_ver_imag[()] = ehor_im
-
-            # Write the common metadata for the group
-            E_real = series.iterations[time_step+1].meshes["E_real"]
-            E_imag = series.iterations[time_step+1].meshes["E_imag"]
-
-            # Get grid geometry.
-            E_real.set_geometry(opmd.Geometry.cartesian)
-            E_imag.set_geometry(opmd.Geometry.cartesian)
-
-            # Get grid properties.
-            nx = h5['params/Mesh/nx'][()]
-            xMax = h5['params/Mesh/xMax'][()]
-            xMin = h5['params/Mesh/xMin'][()]
-            dx = (xMax - xMin) / nx
-
-            ny = h5['params/Mesh/ny'][()]
-            yMax = h5['params/Mesh/yMax'][()]
-            yMin = h5['params/Mesh/yMin'][()]
-            dy = (yMax - yMin) / ny
-
-            tMax = h5['params/Mesh/sliceMax'][()]
-            tMin = h5['params/Mesh/sliceMin'][()]
-            dt = (tMax - tMin) / number_of_time_steps
-
-            E_real.set_grid_spacing(numpy.array([dx, dy], dtype=numpy.float64))
-            E_imag.set_grid_spacing(numpy.array([dx, dy], dtype=numpy.float64))
-
-            E_real.set_grid_global_offset(numpy.array([h5['params/xCentre'][()],
-                                                       h5['params/yCentre'][()]],
-                                                      dtype=numpy.float64
-                                                      )
-                                          )
-            E_imag.set_grid_global_offset(numpy.array([h5['params/xCentre'][()],
-                                                       h5['params/yCentre'][()]],
-                                                      dtype=numpy.float64
-                                                      )
-                                          )
-
-            E_real.set_grid_unit_SI(numpy.float64(1.0))
-            E_imag.set_grid_unit_SI(numpy.float64(1.0))
-
-            E_real.set_data_order(opmd.Data_Order.C)
-            E_imag.set_data_order(opmd.Data_Order.C)
-
-            E_real.set_axis_labels([b"x", b"y"])
-            E_imag.set_axis_labels([b"x", b"y"])
-
-            unit_dimension = {opmd.Unit_Dimension.L:  1.0,
-                              opmd.Unit_Dimension.M:  1.0,
-                              opmd.Unit_Dimension.T: -3.0,
-                              opmd.Unit_Dimension.I: -1.0,
-                              opmd.Unit_Dimension.theta: 0.0,
-                              opmd.Unit_Dimension.N: 0.0,
-                              opmd.Unit_Dimension.J: 0.0
-                              }
-            E_real.set_unit_dimension(unit_dimension)
-            E_imag.set_unit_dimension(unit_dimension)
-
-            # Write attribute that is specific to each dataset:
-            # - Staggered position within a cell
-
-            # - Conversion factor to SI units
-            # WPG writes E fields in units of sqrt(W/mm^2), i.e. it writes E*sqrt(c * eps0 / 2).
-            # Unit analysis:
-            # [E] = V/m
-            # [eps0] = As/Vm
-            # [c] = m/s
-            # ==> [E^2 * eps0 * c] = V**2/m**2 * As/Vm * m/s = V*A/m**2 = W/m**2 = [Intensity]
-            # Converting to SI units by dividing by sqrt(c*eps0/2)*1e3, 1e3 for conversion from mm to m.
-            c    = 2.998e8   # m/s
-            eps0 = 8.854e-12 # As/Vm
-            E_real.set_grid_unit_SI(numpy.float64(1.0/math.sqrt(0.5*c*eps0)/1.0e3))
-            E_imag.set_grid_unit_SI(numpy.float64(1.0/math.sqrt(0.5*c*eps0)/1.0e3))
-
-            # Add particles.
+        # Get grid properties, the same for all time slices.
+        nx = h5['params/Mesh/nx'][()]
+        xMax = h5['params/Mesh/xMax'][()]
+        xMin = h5['params/Mesh/xMin'][()]
+        dx = (xMax - xMin) / nx
+
+        ny = h5['params/Mesh/ny'][()]
+        yMax = h5['params/Mesh/yMax'][()]
+        yMin = h5['params/Mesh/yMin'][()]
+        dy = (yMax - yMin) / ny
+
+        grid_spacing = numpy.array([dx, dy], dtype=numpy.float64)
+        grid_global_offset = numpy.array([h5['params/xCentre'][()],
+                                          h5['params/yCentre'][()]],
+                                         dtype=numpy.float64
+                                         )
+
+        unit_dimension = {opmd.Unit_Dimension.L:  1.0,
+                          opmd.Unit_Dimension.M:  1.0,
+                          opmd.Unit_Dimension.T: -3.0,
+                          opmd.Unit_Dimension.I: -1.0,
+                          opmd.Unit_Dimension.theta: 0.0,
+                          opmd.Unit_Dimension.N: 0.0,
+                          opmd.Unit_Dimension.J: 0.0
+                          }
+
+        # - Conversion factor to SI units
+        # WPG writes E fields in units of sqrt(W/mm^2), i.e. it writes E*sqrt(c * eps0 / 2).
+        # Unit analysis:
+        # [E] = V/m
+        # [eps0] = As/Vm
+        # [c] = m/s
+        # ==> [E^2 * eps0 * c] = V**2/m**2 * As/Vm * m/s = V*A/m**2 = W/m**2 = [Intensity]
+        # Converting to SI units by dividing by sqrt(c*eps0/2)*1e3, 1e3 for conversion from mm to m.
+        c    = 2.998e8   # m/s
+        eps0 = 8.854e-12 # As/Vm
+        grid_unit_SI = numpy.float64(1.0/math.sqrt(0.5*c*eps0)/1.0e3)
+
+        # One chunk per time slice matches reading back one slice at a time.
+        if dataset_options is None:
+            dataset_options = json.dumps({"hdf5": {"dataset": {"chunks": [int(number_of_x_meshpoints), int(number_of_y_meshpoints)]}}})
+        field_dataset = opmd.Dataset(numpy.dtype(numpy.float64),
+                                     [number_of_x_meshpoints, number_of_y_meshpoints],
+                                     dataset_options)
+
+        # Read slabs of consecutive time slices, each one contiguous read per field instead of one strided read per slice and component.
+        ehor = h5['data/arrEhor']
+        ever = h5['data/arrEver']
+        if slab_size is None:
+            slab_size = max(1, _SLAB_BYTES // (2 * 8 * ehor.shape[0] * ehor.shape[1]))
+        slab_size = min(slab_size, number_of_time_steps)
+
+        # Buffers reused for all slabs, shape (time slice, real/imag, x, y).
+        ehor_buffer = numpy.empty((slab_size, 2) + ehor.shape[:2], dtype=numpy.float64)
+        ever_buffer = numpy.empty((slab_size, 2) + ever.shape[:2], dtype=numpy.float64)
+
+        for slab_start in range(0, number_of_time_steps, slab_size):
+            slab_stop = min(slab_start + slab_size, number_of_time_steps)
+            _readSlab(ehor, slab_start, slab_stop, ehor_buffer)
+            _readSlab(ever, slab_start, slab_stop, ever_buffer)
+
+            for time_step in range(slab_start, slab_stop):
+                slab_index = time_step - slab_start
+
+                E_hor_real = series.iterations[time_step+1].meshes["E_real"]["x"]
+                E_hor_imag = series.iterations[time_step+1].meshes["E_imag"]["x"]
+                E_ver_real = series.iterations[time_step+1].meshes["E_real"]["y"]
+                E_ver_imag = series.iterations[time_step+1].meshes["E_imag"]["y"]
+
+                E_hor_real.reset_dataset(field_dataset)
+                E_hor_imag.reset_dataset(field_dataset)
+                E_ver_real.reset_dataset(field_dataset)
+                E_ver_imag.reset_dataset(field_dataset)
+
+                E_hor_real[()] = ehor_buffer[slab_index, 0]
+                E_hor_imag[()] = ehor_buffer[slab_index, 1]
+                E_ver_real[()] = ever_buffer[slab_index, 0]
+                E_ver_imag[()] = ever_buffer[slab_index, 1]
+
+                # Write the common metadata for the group
+                E_real = series.iterations[time_step+1].meshes["E_real"]
+                E_imag = series.iterations[time_step+1].meshes["E_imag"]
+
+                # Get grid geometry.
+                E_real.set_geometry(opmd.Geometry.cartesian)
+                E_imag.set_geometry(opmd.Geometry.cartesian)
+
+                E_real.set_grid_spacing(grid_spacing)
+                E_imag.set_grid_spacing(grid_spacing)
+
+                E_real.set_grid_global_offset(grid_global_offset)
+                E_imag.set_grid_global_offset(grid_global_offset)
+
+                E_real.set_data_order(opmd.Data_Order.C)
+                E_imag.set_data_order(opmd.Data_Order.C)
+
+                E_real.set_axis_labels([b"x", b"y"])
+                E_imag.set_axis_labels([b"x", b"y"])
+
+                E_real.set_unit_dimension(unit_dimension)
+                E_imag.set_unit_dimension(unit_dimension)
+
+                E_real.set_grid_unit_SI(grid_unit_SI)
+                E_imag.set_grid_unit_SI(grid_unit_SI)
 
+                # Add particles.
+
+            # The buffers are reused for the next slab, so the stored chunks must be written out now.
             series.flush()
 
 
@@ -449,6 +469,43 @@ def convertToOPMD(input_file):
 
     print("Found %e and %e photons for horizontal and vertical polarization, respectively." % (sum_x, sum_y))
 
+def _readSlab(dataset, slab_start, slab_stop, buffer):
+    """ Read the time slices [slab_start, slab_stop) of a wpg field into the buffer.
+
+    :param dataset: The wpg field dataset of shape (x, y, time slice, real/imag).
+    :type dataset: h5py.Dataset
+
+    :param buffer: Buffer of shape (time slices, real/imag, x, y) to fill from the start.
+    :type buffer: numpy.ndarray
+    """
+    slab = dataset[:, :, slab_start:slab_stop, :]
+    numpy.copyto(buffer[:slab_stop-slab_start], slab.transpose(2, 3, 0, 1))
+
+def convertDirectory(input_path, number_of_processes=1, **kwargs):
+    """ Convert all wpg output files (prop_out_*.h5) in a directory to openPMD.
+
+    :param input_path: The directory holding the files to be converted.
+    :type input_path: str
+
+    :param number_of_processes: Number of files to convert in parallel (default 1).
+    :type number_of_processes: int
+
+    :param kwargs: Further arguments passed on to convertToOPMD.
+
+    :return: The list of converted files.
+    """
+    input_files = sorted(glob.glob(os.path.join(input_path, "prop_out_*.h5")))
+    input_files = [f for f in input_files if not f.endswith(".opmd.h5")]
+
+    if number_of_processes > 1 and len(input_files) > 1:
+        with multiprocessing.Pool(processes=min(number_of_processes, len(input_files))) as pool:
+            pool.map(functools.partial(convertToOPMD, **kwargs), input_files)
+    else:
+        for input_file in input_files:
+            convertToOPMD(input_file, **kwargs)
+
+    return input_files
+
 def convertToOPMDLegacy(input_file):
     """ Take native wpg output and rewrite in openPMD conformant way.
     @param input_file: The hdf5 file to be converted.
@@ -831,8 +888,13 @@ if __name__ == "__main__":
     # Parse arguments.
     parser = ArgumentParser(description="Convert wpg output to openPMD conform hdf5.")
     parser.add_argument("input_file", metavar="input_file",
-                      help="name of the file to convert.")
+                      help="name of the file to convert, or of a directory holding prop_out_*.h5 files.")
+    parser.add_argument("-n", "--processes", type=int, default=1,
+                      help="number of files to convert in parallel if input_file is a directory.")
     args = parser.parse_args()
 
     # Call the converter routine.
-    convertToOPMD(args.input_file)
+    if os.path.isdir(args.input_file):
+        convertDirectory(args.input_file, number_of_processes=args.processes)
+    else:
+        convertToOPMD(args.input_file)
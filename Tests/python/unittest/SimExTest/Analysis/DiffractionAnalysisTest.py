@@ -30,6 +30,7 @@ RENDER_PLOT=False # Set to True or use environment variable to show plots.
     @modification 20200914
 
 """
+import h5py
 import numpy
 import os, shutil
 import unittest
@@ -38,6 +39,8 @@ import unittest
 from SimEx.Analysis.AbstractAnalysis import AbstractAnalysis, plt
 from SimEx.Analysis.DiffractionAnalysis import DiffractionAnalysis
 from SimEx.Analysis.DiffractionAnalysis import diffractionParameters, plotImage
+from SimEx.Analysis.DiffractionAnalysis import streamingReduction, clearGeometryCache
+from SimEx.Analysis.DiffractionAnalysis import _geometry_cache, _GEOMETRY_CACHE_SIZE
 
 from TestUtilities import TestUtilities
 
@@ -277,6 +280,47 @@ class DiffractionAnalysisTest(unittest.TestCase):
         pattern_one = analyzer.numpyPattern()
         self.assertEqual(pattern_one.shape,(81,81))
 
+    def testPatternBlockGenerator(self):
+        """ Check that reading patterns in blocks yields the same patterns as the pattern generator. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[1,2,3,5,8], poissonize=True)
+
+        blocks = [block.copy() for block in analyzer.patternBlockGenerator(block_size=2)]
+
+        self.assertEqual([len(block) for block in blocks], [2,2,1])
+        patterns = numpy.array([p for p in analyzer.patternGenerator()])
+        self.assertTrue(numpy.array_equal(numpy.concatenate(blocks), patterns))
+
+    def testPatternBlockGeneratorMissingPattern(self):
+        """ Check that a pattern missing from a v0.2 file raises instead of being skipped. """
+        truncated_path = 'diffr_truncated.h5'
+        self.__files_to_remove.append(truncated_path)
+
+        shutil.copy(self.__test_data, truncated_path)
+        with h5py.File(truncated_path, 'a') as h5:
+            del h5['data/0000003']
+
+        analyzer = DiffractionAnalysis(input_path=truncated_path, pattern_indices=[1,2,3], poissonize=True)
+
+        self.assertRaises(KeyError, lambda: [block for block in analyzer.patternBlockGenerator()])
+
+    def testStreamingReduction(self):
+        """ Check that block-wise reductions agree with reductions of the full stack. """
+        stack = numpy.random.random((11,8,8))
+        blocks = [stack[i:i+4] for i in range(0, 11, 4)]
+
+        for operation in [numpy.sum, numpy.mean, numpy.std, numpy.var, numpy.min, numpy.max]:
+            self.assertTrue(numpy.allclose(streamingReduction(blocks, operation), operation(stack, axis=0)))
+
+        self.assertRaises(ValueError, streamingReduction, blocks, numpy.median)
+
+    def testStreamingNumpyPattern(self):
+        """ Check that numpyPattern with an operation gives the result of the operation on all patterns. """
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=list(range(1,21)), poissonize=True)
+
+        stack = analyzer.numpyPattern()
+        self.assertTrue(numpy.allclose(analyzer.numpyPattern("numpy.std"), numpy.std(stack, axis=0)))
+        self.assertTrue(numpy.allclose(analyzer.numpyPattern("numpy.sum"), numpy.sum(stack, axis=0)))
+
     def testSolidAngles(self):
         """ Check getting solid angles mapping """
         analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices="all", poissonize=True)
@@ -289,6 +333,81 @@ class DiffractionAnalysisTest(unittest.TestCase):
 
         sa = analyzer.solidAngles
 
+    def testGeometryCache(self):
+        """ Check that q map and solid angles are computed once per geometry and can be kept on disk. """
+        self.__dirs_to_remove.append('geometry_cache')
+        clearGeometryCache()
+
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[1], geometry_cache_path='geometry_cache')
+        q_map = analyzer.q_map
+        solid_angles = analyzer.solid_angles
+
+        # Same geometry, same arrays.
+        other = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[2])
+        self.assertIs(other.q_map, q_map)
+        self.assertIs(other.solid_angles, solid_angles)
+        self.assertFalse(q_map.flags.writeable)
+
+        # Arrays are read back from disk in a new session.
+        self.assertEqual(len(os.listdir('geometry_cache')), 2)
+        clearGeometryCache()
+        self.assertTrue(numpy.array_equal(analyzer.q_map, q_map))
+
+    def testGeometryCacheSize(self):
+        """ Check that the geometry cache keeps only the most recently used entries. """
+        clearGeometryCache()
+
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[1], poissonize=False)
+        for npt in range(10, 10 + _GEOMETRY_CACHE_SIZE + 2):
+            analyzer.radialProfiles(npt=npt)
+
+        self.assertEqual(len(_geometry_cache), _GEOMETRY_CACHE_SIZE)
+        # The integrator is used for every profile and stays cached.
+        self.assertIn('integrator', [key[0] for key in _geometry_cache])
+
+        clearGeometryCache()
+        self.assertEqual(len(_geometry_cache), 0)
+
+    def testRadialProfiles(self):
+        """ Check the radial profiles of all patterns are computed in blocks and written to file. """
+        output_path = 'radial_profiles.h5'
+        self.__files_to_remove.append(output_path)
+
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=list(range(1,11)), poissonize=False)
+        positions, profiles = analyzer.radialProfiles(npt=100, block_size=3, output_path=output_path)
+
+        self.assertEqual(positions.shape, (100,))
+        self.assertEqual(profiles.shape, (10, 100))
+
+        # Same profiles as one pattern at a time.
+        positions_one, profiles_one = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[4], poissonize=False).radialProfiles(npt=100)
+        self.assertTrue(numpy.allclose(profiles_one[0], profiles[3]))
+
+        with h5py.File(output_path, 'r') as h5:
+            self.assertTrue(numpy.allclose(h5['radial_profiles/intensities'][()], profiles))
+            self.assertTrue(numpy.allclose(h5['radial_profiles/positions'][()], positions))
+
+    def testConsolidatedFile(self):
+        """ Check that patterns stored in one dataset are read as from one group per pattern. """
+        consolidated_path = 'diffr_consolidated.h5'
+        self.__files_to_remove.append(consolidated_path)
+
+        # Copy three patterns in reversed order into one dataset.
+        with h5py.File(self.__test_data, 'r') as h5_in, h5py.File(consolidated_path, 'w') as h5_out:
+            h5_in.copy('params', h5_out)
+            pattern_ids = [3, 2, 1]
+            h5_out['data/data'] = numpy.array([h5_in['data/%07d/data' % i][()] for i in pattern_ids])
+            h5_out['data/diffr'] = numpy.array([h5_in['data/%07d/diffr' % i][()] for i in pattern_ids])
+            h5_out['data/pattern_id'] = pattern_ids
+
+        analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices=[1,3], poissonize=False)
+        consolidated = DiffractionAnalysis(input_path=consolidated_path, pattern_indices=[1,3], poissonize=False)
+
+        self.assertEqual(consolidated.total_npattern, 3)
+        self.assertTrue(numpy.array_equal(consolidated.numpyPattern(), analyzer.numpyPattern()))
+        for pattern, expected in zip(consolidated.patternGenerator(), analyzer.patternGenerator()):
+            self.assertTrue(numpy.array_equal(pattern, expected))
+
     def testGetQMap(self):
         """ Check the 2D reciprocal space mapping """
         analyzer = DiffractionAnalysis(input_path=self.__test_data, pattern_indices="all", poissonize=True)
@@ -156,5 +156,42 @@ class XFELPhotonAnalysisTest(unittest.TestCase):
 
         energy, totalPower = xfel_photon_analyzer.numpyTotalPower(spectrum=True)
 
+    def testLazyAnalysis(self):
+        """ Test that the lazy analysis streams the same time domain results as the full analysis. """
+        input_path = TestUtilities.generateTestFilePath('prop_out_0000001.h5')
+        xfel_photon_analyzer = XFELPhotonAnalysis(input_path=input_path)
+        lazy_analyzer = XFELPhotonAnalysis(input_path=input_path, lazy=True)
+
+        times, power = xfel_photon_analyzer.numpyTotalPower(all=True)
+        lazy_times, lazy_power = lazy_analyzer.numpyTotalPower(all=True)
+
+        self.assertTrue(numpy.allclose(times, lazy_times))
+        self.assertTrue(numpy.allclose(power, lazy_power, rtol=1e-5))
+        fwhm, lazy_fwhm = xfel_photon_analyzer.fwhm(), lazy_analyzer.fwhm()
+        for key in fwhm:
+            self.assertAlmostEqual(fwhm[key], lazy_fwhm[key], delta=1e-3*fwhm[key])
+
+        lazy_analyzer.plotTotalPower()
+        lazy_analyzer.plotOnAxisPowerDensity()
+        lazy_analyzer.plotIntensityMap()
+
+    def testIntensitySetterResetsStatistics(self):
+        """ Test that setting the intensity discards the memoized statistics. """
+        xfel_photon_analyzer = XFELPhotonAnalysis(input_path=TestUtilities.generateTestFilePath('prop_out_0000001.h5'))
+
+        self.assertNotEqual(xfel_photon_analyzer.fwhm()['fwhm_x'], 0.0)
+
+        xfel_photon_analyzer.intensity = numpy.zeros_like(xfel_photon_analyzer.intensity)
+        self.assertEqual(xfel_photon_analyzer.fwhm()['fwhm_x'], 0.0)
+
+    def testSpectrumMemoized(self):
+        """ Test that the frequency domain results are computed once and the wavefront is left in time domain. """
+        xfel_photon_analyzer = XFELPhotonAnalysis(input_path=TestUtilities.generateTestFilePath('prop_out_0000001.h5'))
+
+        statistics = xfel_photon_analyzer._intensityStatistics(spectrum=True)
+
+        self.assertIs(xfel_photon_analyzer._intensityStatistics(spectrum=True), statistics)
+        self.assertEqual(xfel_photon_analyzer.wavefront.params.wDomain, 'time')
+
 if __name__ == '__main__':
     unittest.main()
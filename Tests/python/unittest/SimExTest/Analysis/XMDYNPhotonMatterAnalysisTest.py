@@ -34,6 +34,7 @@ from SimEx.Analysis.XMDYNPhotonMatterAnalysis import read_h5_dataset
 from SimEx.Analysis.XMDYNPhotonMatterAnalysis import load_sample
 from SimEx.Analysis.XMDYNPhotonMatterAnalysis import calculate_ion_charge
 from SimEx.Analysis.XMDYNPhotonMatterAnalysis import calculate_displacement
+from SimEx.Analysis.XMDYNPhotonMatterAnalysis import lookup_ion_charge
 
 from TestUtilities import TestUtilities
 
@@ -226,6 +227,38 @@ class XMDYNPhotonMatterAnalysisTest(unittest.TestCase):
 
         analysis.plot_charge()
 
+    def test_lookup_ion_charge(self):
+        """ Test mapping electronic configurations to the number of bound electrons. """
+
+        T = numpy.array([30, 10, 20])
+        ff = numpy.array([[3.0, 0.1], [1.0, 0.2], [2.0, 0.3]])
+        xyz = numpy.array([10, 30, 30, 20])
+
+        self.assertTrue(numpy.array_equal(lookup_ion_charge(T, ff, xyz), [1.0, 3.0, 3.0, 2.0]))
+        self.assertRaises(ValueError, lookup_ion_charge, T, ff, numpy.array([40]))
+
+    def test_load_trajectory_blocks(self):
+        """ Test that the trajectory does not depend on the number of snapshots read at a time. """
+
+        analysis = XMDYNPhotonMatterAnalysis(
+                input_path=self.__test_data,
+                snapshot_indices=range(1,10),
+                sample_path=TestUtilities.generateTestFilePath('sample.h5'),
+                )
+        trajectory = analysis._XMDYNPhotonMatterAnalysis__trajectory
+
+        analysis.load_trajectory(block_size=2)
+        blocked_trajectory = analysis._XMDYNPhotonMatterAnalysis__trajectory
+
+        self.assertEqual(trajectory['charge'].shape, (9, len(load_sample(analysis.sample_path)['selZ'])))
+        self.assertTrue(numpy.allclose(trajectory['charge'], blocked_trajectory['charge']))
+        self.assertTrue(numpy.allclose(trajectory['displacement'], blocked_trajectory['displacement']))
+
+        # Same per-species values as from a single snapshot.
+        snapshot = analysis.load_snapshot(3)
+        sample = load_sample(analysis.sample_path)
+        self.assertTrue(numpy.allclose(trajectory['charge'][2], calculate_ion_charge(snapshot, sample)))
+
 
 if __name__ == '__main__':
     unittest.main()
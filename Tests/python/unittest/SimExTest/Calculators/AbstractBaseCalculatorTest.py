@@ -28,6 +28,7 @@
 """
 import unittest
 import os
+import shutil
 
 
 # Import the class to test.
@@ -35,6 +36,7 @@ from SimEx.Calculators.AbstractBaseCalculator import AbstractBaseCalculator
 from SimEx.Calculators.AbstractBaseCalculator import checkAndSetIO
 from SimEx.Calculators.AbstractBaseCalculator import checkAndSetParameters
 from SimEx.Parameters.AbstractCalculatorParameters import AbstractCalculatorParameters
+from SimEx.Utilities.ResultCache import ResultCache
 
 # Test parameter class.
 class DerivedParameters(AbstractCalculatorParameters):
@@ -55,11 +57,12 @@ class DerivedCalculator(AbstractBaseCalculator):
     def __init__(self, parameters=None, input_path=None, output_path=None):
         super(DerivedCalculator, self).__init__(parameters, input_path, output_path)
     def backengine(self):
-        pass
+        self.backengine_calls = getattr(self, 'backengine_calls', 0) + 1
     def _readH5(self):
         pass
     def saveH5(self):
-        pass
+        with open(self.output_path, 'w') as fh:
+            fh.write('out')
     def providedData(self):
         return ['/params/params1', '/params/params2', '/data/dat1', '/data/dat2']
     def expectedData(self):
@@ -181,6 +184,57 @@ class AbstractBaseCalculatorTest(unittest.TestCase):
         parameters = DerivedParameters()
         self.assertEqual( parameters, checkAndSetParameters( parameters ) )
 
+    def testCacheKey(self):
+        """ Check that the cache key depends on the parameters. """
+        abc1 = DerivedCalculator( parameters={'a' : 1}, input_path=__file__, output_path='out.h5')
+        abc2 = DerivedCalculator( parameters={'a' : 1}, input_path=__file__, output_path='out.h5')
+        abc3 = DerivedCalculator( parameters={'a' : 2}, input_path=__file__, output_path='out.h5')
+
+        self.assertEqual( abc1.cacheKey(), abc2.cacheKey() )
+        self.assertNotEqual( abc1.cacheKey(), abc3.cacheKey() )
+
+    def testCacheKeyReferencedFile(self):
+        """ Check that the cache key depends on the content of files named in the parameters. """
+        self.__files_to_be_removed.append('geom.txt')
+        with open('geom.txt', 'w') as fh:
+            fh.write('1')
+        abc = DerivedCalculator( parameters={'geometry' : 'geom.txt'}, input_path=__file__, output_path='out.h5')
+        key = abc.cacheKey()
+
+        with open('geom.txt', 'w') as fh:
+            fh.write('2')
+        self.assertNotEqual( key, abc.cacheKey() )
+
+    def testRunCached(self):
+        """ Check that a repeated calculation is taken from the cache. """
+        self.__files_to_be_removed.append('out.h5')
+        cache = ResultCache('test_cache')
+
+        try:
+            abc = DerivedCalculator( parameters={'a' : 1}, input_path=__file__, output_path='out.h5')
+            self.assertFalse( abc.runCached(cache) )
+            self.assertEqual( abc.backengine_calls, 1 )
+
+            os.remove('out.h5')
+            self.assertTrue( abc.runCached(cache) )
+            self.assertEqual( abc.backengine_calls, 1 )
+            self.assertTrue( os.path.isfile('out.h5') )
+        finally:
+            shutil.rmtree('test_cache')
+
+    def testRunCachedUnhashableParameters(self):
+        """ Check that a calculation whose parameters cannot be hashed runs without the cache. """
+        self.__files_to_be_removed.append('out.h5')
+        cache = ResultCache('test_cache')
+
+        try:
+            abc = DerivedCalculator( parameters={'function' : lambda x: x}, input_path=__file__, output_path='out.h5')
+            self.assertFalse( abc.runCached(cache) )
+            self.assertFalse( abc.runCached(cache) )
+            self.assertEqual( abc.backengine_calls, 2 )
+        finally:
+            shutil.rmtree('test_cache')
+
 
 class AbstractCalculatorParametersTest(unittest.TestCase):
     """
@@ -26,6 +26,7 @@
     @creation 20160404
 
 """
+import numpy
 import os
 import shutil
 
@@ -41,6 +42,8 @@ from TestUtilities import TestUtilities
 from SimEx.Calculators.ComptonScatteringCalculator import ComptonScatteringCalculator
 from SimEx.Calculators.ComptonScatteringCalculator import _fermiEnergy
 from SimEx.Calculators.ComptonScatteringCalculator import _chemicalPotential
+from SimEx.Calculators.ComptonScatteringCalculator import chemicalPotential
+from SimEx.Calculators.ComptonScatteringCalculator import comptonProfiles
 
 class ComptonScatteringCalculatorTest(unittest.TestCase):
     """
@@ -135,6 +138,45 @@ class ComptonScatteringCalculatorTest(unittest.TestCase):
         # Compare to reference value.
         self.assertAlmostEqual( mu, -7554., 0 )
 
+    def testChemicalPotentialArray(self):
+        """ Test the calculation of the chemical potential for a grid of densities and temperatures. """
+
+        # Setup grid.
+        ne = numpy.array([[1e29], [3e29]]) # m**-3
+        Te = numpy.array([1.0, 10.0, 1000.0])  # eV
+
+        # Get chemical potentials.
+        mu = chemicalPotential( ne, Te )
+
+        # Compare to scalar results.
+        self.assertEqual( mu.shape, (2,3) )
+        self.assertAlmostEqual( mu[0,0], 7.74839, 5 )
+        self.assertAlmostEqual( mu[0,2], -7554., 0 )
+        for i in range(2):
+            for j in range(3):
+                self.assertAlmostEqual( mu[i,j], _chemicalPotential( ne[i,0], Te[j] ), 6 )
+
+    def testComptonProfiles(self):
+        """ Test the calculation of Compton profiles for a grid of densities, temperatures and angles. """
+
+        calculator = ComptonScatteringCalculator(parameters=self.parameters,
+                                               input_path=self.input_path,
+                                               output_path='out')
+
+        angles = numpy.array([45., 90.]).reshape(2,1,1)
+        ne = numpy.array([1e35, 3e35]).reshape(1,2,1) # m**-3
+        Te = numpy.array([10.0, 20.0])  # eV
+
+        pzs, profiles = comptonProfiles(calculator.energy_shifts, calculator.source_energy, angles, ne, Te)
+
+        # Check shape.
+        self.assertEqual( profiles.shape, (2,2,2,len(calculator.energy_shifts)) )
+        self.assertEqual( pzs.shape, profiles.shape )
+
+        # Check against the profile of the calculator.
+        self.assertTrue( numpy.allclose( profiles[1,1,0], calculator.compton_profile ) )
+        self.assertTrue( numpy.allclose( pzs[1,1,0], calculator.pzs ) )
+
 
 
 if __name__ == '__main__':
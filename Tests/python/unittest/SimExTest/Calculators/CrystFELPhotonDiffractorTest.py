@@ -241,6 +241,38 @@ class CrystFELPhotonDiffractorTest(unittest.TestCase):
         # Check pattern was written.
         self.assertIn("diffr_out-1.h5" , os.listdir(output_path))
 
+    def testBackengineShards(self):
+        """ Check that sharded pattern_sim runs produce consecutively numbered patterns. """
+
+        # Ensure cleanup.
+        self.__dirs_to_remove.append("diffr")
+        self.__files_to_remove.append("diffr.h5")
+
+        parameters = CrystFELPhotonDiffractorParameters(sample=self.__sample,
+                        beam_parameters=self.__beam_parameters,
+                        detector_geometry=self.__geometry,
+                        number_of_diffraction_patterns=5,
+                        number_of_shards=2,
+                        uniform_rotation=True,
+                        )
+
+        diffractor = CrystFELPhotonDiffractor(parameters=parameters, input_path=None, output_path='diffr')
+
+        # Run backengine
+        status = diffractor.backengine()
+
+        # Check return code.
+        self.assertEqual(status, 0)
+
+        # Check all patterns were merged and shard directories removed.
+        self.assertEqual(sorted(os.listdir("diffr")), ["diffr_out_%07d.h5" % (i) for i in range(1, 6)])
+
+        # Link patterns.
+        diffractor.saveH5()
+
+        with h5py.File(diffractor.output_path, 'r') as h5:
+            self.assertEqual(sorted(h5["data"].keys()), ["%07d" % (i) for i in range(1, 6)])
+
     @unittest.skipIf(TestUtilities.runs_on_travisCI(), reason="Travis")
     def testBackengineGPU(self):
         """ Check a backengine calculation with openCL enabled. """
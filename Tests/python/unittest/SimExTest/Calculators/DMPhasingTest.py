@@ -26,11 +26,14 @@
     @creation 20151202
 
 """
+import h5py
+import numpy
 import os
 import unittest
 
 # Import the class to test.
 from SimEx.Calculators.DMPhasing import DMPhasing
+from SimEx.Calculators.DMPhasing import _align_object, _cluster_two_means, _random_start_object, _support_from_autocorr
 from SimEx.Parameters.DMPhasingParameters import DMPhasingParameters
 from TestUtilities import TestUtilities
 
@@ -103,6 +106,28 @@ class DMPhasingTest(unittest.TestCase):
         self.assertEqual( analyzer.parameters.number_of_shrink_cycles, 2 )
 
 
+    def testClusterTwoMeans(self):
+        """ Test the 2-means clustering of voxel values. """
+
+        values = numpy.array([0.0, 0.2, 0.1, 10.0, 12.0])
+
+        (v0, v1) = _cluster_two_means(values)
+
+        self.assertAlmostEqual(v0, 0.1)
+        self.assertAlmostEqual(v1, 11.0)
+
+    def testSupportFromAutocorr(self):
+        """ Test the support is the dilated set of significant voxels on the half resolution grid. """
+
+        auto = numpy.zeros((5,5,5))
+        auto[2,2,2] = 10.0
+
+        support = _support_from_autocorr(auto, 2, 0.0, 10.0, None, write=False)
+
+        # All 27 voxels of the dilated cube, halved.
+        self.assertEqual(support.shape, (27, 3))
+        expected = sorted((i,j,k) for i in [0,1,1] for j in [0,1,1] for k in [0,1,1])
+        self.assertEqual(sorted(map(tuple, support)), expected)
 
     def testBackengine(self):
         """ Test that we can start a test calculation. """
@@ -126,6 +151,62 @@ class DMPhasingTest(unittest.TestCase):
 
         self.assertEqual(status, 0)
 
+    def testBackengineEnsemble(self):
+        """ Test that independent trials can run at the same time. """
+
+        self.__files_to_remove.append('phasing_out.h5')
+
+        dm_parameters = DMPhasingParameters(number_of_trials=4,
+                                            number_of_iterations=2,
+                                            averaging_start=15,
+                                            leash=0.2,
+                                            number_of_shrink_cycles=2,
+                                            number_of_processes=2,
+                                            )
+
+        # Construct the object.
+        analyzer = DMPhasing(parameters=dm_parameters, input_path=self.input_h5, output_path='phasing_out.h5')
+
+        # Call backengine.
+        status = analyzer.backengine()
+
+        self.assertEqual(status, 0)
+
+        # Check average and best trial are saved.
+        with h5py.File('phasing_out.h5', 'r') as h5:
+            self.assertEqual(h5['history/trial_error'].shape, (4,))
+            self.assertIn(h5['history/best_trial'][()], [1,2,3,4])
+            self.assertEqual(h5['data/electronDensity'].shape, h5['data/bestElectronDensity'].shape)
+            self.assertEqual(h5['history/failed_trials'][()], 0)
+
+            # Trials start from different random objects and end with different errors.
+            self.assertEqual(len(numpy.unique(h5['history/trial_error'][()])), 4)
+
+    def testRandomStartObject(self):
+        """ Test that random start objects are confined to the support and differ between random states. """
+        support = numpy.array([[0,0,0], [1,2,3], [4,4,4]])
+
+        objects = [_random_start_object(support, 5, numpy.random.RandomState(seed)) for seed in [1, 2]]
+
+        for obj in objects:
+            self.assertEqual(obj.shape, (5,5,5))
+            self.assertEqual(numpy.count_nonzero(obj), 3)
+            self.assertTrue(numpy.all(obj[tuple(support.T)] > 0))
+        self.assertFalse(numpy.array_equal(objects[0], objects[1]))
+
+    def testAlignObject(self):
+        """ Test aligning shifted and inverted objects. """
+
+        reference = numpy.zeros((8,8,8))
+        reference[1:3,2:5,3] = 1.0
+        reference[5,6,7] = 2.0
+
+        shifted = numpy.roll(reference, (2,-3,1), axis=(0,1,2))
+        self.assertTrue(numpy.allclose(_align_object(reference, shifted), reference))
+
+        twin = numpy.roll(reference[::-1,::-1,::-1], (1,1,-2), axis=(0,1,2))
+        self.assertTrue(numpy.allclose(_align_object(reference, twin), reference))
+
 
 if __name__ == '__main__':
     unittest.main()
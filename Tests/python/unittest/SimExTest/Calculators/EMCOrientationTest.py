@@ -26,13 +26,15 @@
     @creation 20151109
 
 """
+import h5py
+import numpy
 import os
 import subprocess
 
 import unittest
 
 # Import the class to test.
-from SimEx.Calculators.EMCOrientation import EMCOrientation, _checkPaths
+from SimEx.Calculators.EMCOrientation import EMCOrientation, _checkPaths, _setDataset
 from SimEx.Parameters.EMCOrientationParameters import EMCOrientationParameters
 from TestUtilities import TestUtilities
 
@@ -258,6 +260,18 @@ class EMCOrientationTest(unittest.TestCase):
         self.assertRaises( IOError, _checkPaths, "emc_run", [1,2] )
 
 
+    def testSetDataset(self):
+        """ Check that datasets are created once and overwritten in later iterations. """
+
+        self.__files_to_remove.append('set_dataset.h5')
+
+        with h5py.File('set_dataset.h5', 'w') as h5:
+            _setDataset(h5, "data/data", numpy.zeros((3,3,3)))
+            _setDataset(h5, "data/data", numpy.ones((3,3,3)))
+
+            self.assertEqual(h5["data/data"].compression, "gzip")
+            self.assertEqual(h5["data/data"][()].sum(), 27.0)
+
     def testPhotonFileConsecutiveRuns(self):
         """ Check that the photons.dat from the previous run is reused. """
 
@@ -334,6 +348,34 @@ class EMCOrientationTest(unittest.TestCase):
         for ef in expected_run_files2:
             self.assertIn( ef, os.listdir(run_files_path2) )
 
+    def testPrepareSparsePhotonsParallel(self):
+        """ Check that splitting the sparse photon conversion over processes yields the serial result. """
+
+        photon_files = []
+        for number_of_processes in [1, 3]:
+            emc_parameters = EMCOrientationParameters(number_of_processes=number_of_processes)
+            emc = EMCOrientation(parameters=emc_parameters,
+                                 input_path=self.input_h5,
+                                 output_path='orient_out.h5',
+                                 tmp_files_path=None,
+                                 run_files_path=None,)
+
+            emc._setupPaths()
+            emc._prepare_photon_files()
+
+            with open(emc._sparsePhotonFile) as photons:
+                photon_files.append(photons.read())
+
+            with h5py.File(emc._avgPatternFile, 'r') as h5:
+                average = h5['average'][()]
+                self.assertIn('mask', h5)
+
+            # Partial files are removed.
+            self.assertEqual(sorted(os.listdir(emc.tmp_files_path)), ['avg_photon.h5', 'detector.dat', 'photons.dat'])
+
+        self.assertEqual(photon_files[0], photon_files[1])
+        self.assertEqual(len(photon_files[0].splitlines()) - 1, len(os.listdir(self.input_h5)))
+
     def testDiffr0_2(self):
         """ Test that we can handle diffr input version 0.2 """
 
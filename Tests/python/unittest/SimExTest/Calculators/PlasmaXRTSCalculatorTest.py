@@ -34,6 +34,8 @@ from SimEx.Calculators.AbstractBaseCalculator import AbstractBaseCalculator
 # Import the class to test.
 from SimEx.Calculators.PlasmaXRTSCalculator import PlasmaXRTSCalculator
 from SimEx.Calculators.PlasmaXRTSCalculator import _parseStaticData
+from SimEx.Calculators.PlasmaXRTSCalculator import runBatch
+from SimEx.Utilities.ResultCache import ResultCache
 
 from TestUtilities import TestUtilities
 
@@ -137,6 +139,51 @@ class PlasmaXRTSCalculatorTest(unittest.TestCase):
         # Check data shape.
         self.assertEqual( xrts_calculator._PlasmaXRTSCalculator__run_data.shape, (201, 4 ) )
 
+    def testRunBatch(self):
+        """ Check that a batch of parameter sets gives the same results as the backengine, and that results are cached. """
+
+        # Run the backengine for reference.
+        xrts_calculator = PlasmaXRTSCalculator( parameters=self.xrts_parameters,
+                                                input_path=self.input_path,
+                                                output_path='xrts_out'
+                                              )
+        xrts_calculator.backengine()
+        self.__dirs_to_remove.append(xrts_calculator.parameters._tmp_dir)
+
+        # Scan the electron temperature.
+        temperatures = [5.0, 10.0, 10.0, 20.0]
+        scan = [PlasmaXRTSCalculatorParameters(
+                            elements=[['Be', 1, -1]],
+                            photon_energy=4.96e3,
+                            electron_density=3.0e23,
+                            electron_temperature=temperature,
+                            ion_charge=2.3,
+                            scattering_angle=90.,
+                            energy_range={'min': -50.0, 'max': 50.0, 'step': 0.5},
+                            ) for temperature in temperatures]
+
+        cache = ResultCache('xrts_cache')
+        self.__dirs_to_remove.append('xrts_cache')
+
+        data, static_data = runBatch(scan, number_of_processes=2, cache=cache)
+
+        # Check shapes and values.
+        self.assertEqual(data.shape, (4, 201, 4))
+        self.assertEqual(static_data['Sk_total'].shape, (4,))
+        self.assertTrue(numpy.allclose(data[1], xrts_calculator.data))
+        self.assertTrue(numpy.array_equal(data[1], data[2]))
+
+        # One cache entry per distinct input deck.
+        self.assertEqual(len(os.listdir('xrts_cache')), 3)
+
+        # Temporary directories are removed.
+        self.assertFalse(any(os.path.isdir(p._tmp_dir) for p in scan))
+
+        # Second run reads from the cache.
+        cached_data, cached_static_data = runBatch(scan, cache=cache)
+        self.assertTrue(numpy.array_equal(cached_data, data))
+        self.assertTrue(numpy.array_equal(cached_static_data['Sk_total'], static_data['Sk_total']))
+
     def testSaveH5(self):
         """ Test hdf5 output generation. """
         # Make sure we clean up after ourselves.
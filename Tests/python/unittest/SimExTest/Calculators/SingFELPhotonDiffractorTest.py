@@ -285,6 +285,124 @@ class SingFELPhotonDiffractorTest(unittest.TestCase):
             self.assertIn("pixelHeight", geom.keys())
             self.assertIn("pixelWidth", geom.keys())
 
+    @unittest.skipIf(TRAVIS, "CI.")
+    def testConsolidatedOutput(self):
+        """ Test that all patterns are written into one chunked dataset with their orientations. """
+
+        # Ensure proper cleanup.
+        sample_file = TestUtilities.generateTestFilePath('2nip.pdb')
+        self.__dirs_to_remove.append( os.path.abspath( 'diffr' ) )
+        self.__files_to_remove.append( os.path.abspath( 'diffr.h5' ) )
+
+        # Set up parameters.
+        parameters=SingFELPhotonDiffractorParameters(
+                sample=sample_file,
+                uniform_rotation = True,
+                number_of_diffraction_patterns= 3,
+                beam_parameters=self.beam,
+                detector_geometry= self.detector_geometry,
+                forced_mpi_command='mpirun -np 2',
+                consolidate_output=True,
+                compression='gzip',
+                )
+
+        # Construct the object.
+        diffractor = SingFELPhotonDiffractor(parameters=parameters)
+
+        # Run and save.
+        diffractor.backengine()
+        diffractor.saveH5()
+
+        # No per process files.
+        self.assertEqual(os.listdir(diffractor.output_path), [])
+
+        with h5py.File(diffractor.output_path + '.h5', 'r') as h5:
+            self.assertEqual(h5['data/data'].shape, (3, 22, 22))
+            self.assertEqual(h5['data/data'].chunks, (1, 22, 22))
+            self.assertEqual(h5['data/diffr'].shape, (3, 22, 22))
+            self.assertEqual(h5['data/angle'].shape, (3, 4))
+            self.assertEqual(list(h5['data/pattern_id'][()]), [1, 2, 3])
+            self.assertIn("photonEnergy", h5["params/beam"].keys())
+            self.assertIn("mask", h5["params/geom"].keys())
+
+    @unittest.skipIf(TRAVIS, "CI.")
+    def testConsolidatedOutputStaleFiles(self):
+        """ Test that files left over from an earlier run are not merged into the consolidated output. """
+
+        # Ensure proper cleanup.
+        sample_file = TestUtilities.generateTestFilePath('2nip.pdb')
+        self.__dirs_to_remove.append( os.path.abspath( 'diffr' ) )
+        self.__files_to_remove.append( os.path.abspath( 'diffr.h5' ) )
+
+        # A per process file from an earlier run.
+        os.mkdir('diffr')
+        stale_file = os.path.join('diffr', 'diffr_out_0000001.h5')
+        with h5py.File(stale_file, 'w') as h5:
+            h5.create_group('data/0000009')
+
+        parameters=SingFELPhotonDiffractorParameters(
+                sample=sample_file,
+                uniform_rotation = True,
+                number_of_diffraction_patterns= 2,
+                beam_parameters=self.beam,
+                detector_geometry= self.detector_geometry,
+                forced_mpi_command='mpirun -np 2',
+                consolidate_output=True,
+                )
+
+        diffractor = SingFELPhotonDiffractor(parameters=parameters)
+        diffractor.backengine()
+        diffractor.saveH5()
+
+        self.assertEqual(os.listdir(diffractor.output_path), ['diffr_out_0000001.h5'])
+        with h5py.File(diffractor.output_path + '.h5', 'r') as h5:
+            self.assertEqual(list(h5['data/pattern_id'][()]), [1, 2])
+
+    def testConsolidatedSaveH5NoOutput(self):
+        """ Test that saving without any pattern files does not fail. """
+        parameters=SingFELPhotonDiffractorParameters(
+                sample=TestUtilities.generateTestFilePath('2nip.pdb'),
+                beam_parameters=self.beam,
+                detector_geometry= self.detector_geometry,
+                consolidate_output=True,
+                )
+
+        diffractor = SingFELPhotonDiffractor(parameters=parameters, output_path='does_not_exist')
+        diffractor.saveH5()
+
+        self.assertFalse(os.path.exists('does_not_exist.h5'))
+
+    @unittest.skipIf(TRAVIS, "CI.")
+    def testOrientationBatch(self):
+        """ Test that evaluating orientations in batches gives the patterns of one orientation at a time. """
+
+        # Ensure proper cleanup.
+        sample_file = TestUtilities.generateTestFilePath('2nip.pdb')
+        self.__dirs_to_remove.append( os.path.abspath( 'diffr' ) )
+        self.__files_to_remove.append( os.path.abspath( 'diffr.h5' ) )
+
+        patterns = []
+        for orientation_batch_size in [1, 3]:
+            parameters=SingFELPhotonDiffractorParameters(
+                    sample=sample_file,
+                    uniform_rotation = True,
+                    number_of_diffraction_patterns= 4,
+                    beam_parameters=self.beam,
+                    detector_geometry= self.detector_geometry,
+                    forced_mpi_command='mpirun -np 1',
+                    consolidate_output=True,
+                    orientation_batch_size=orientation_batch_size,
+                    )
+
+            diffractor = SingFELPhotonDiffractor(parameters=parameters)
+            diffractor.backengine()
+            diffractor.saveH5()
+
+            with h5py.File(diffractor.output_path + '.h5', 'r') as h5:
+                patterns.append(h5['data/diffr'][()])
+
+        self.assertTrue(numpy.allclose(patterns[0], patterns[1], rtol=1e-8))
+
     def testH5OutputThrice(self):
         """ Test whether the backengine behaves normally after multiple calculation"""
 
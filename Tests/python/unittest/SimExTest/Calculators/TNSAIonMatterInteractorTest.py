@@ -25,7 +25,11 @@ from SimEx.Calculators.TNSAIonMatterInteractor import TNSAIonMatterInteractor
 from SimEx.Parameters.IonMatterInteractorParameters import IonMatterInteractorParameters
 from SimEx.Calculators.AbstractIonInteractor import AbstractIonInteractor
 from TestUtilities import TestUtilities
+import math
+import numpy as np
+import openpmd_api as api
 import os
+from scipy.constants import e, m_p as mp
 
 
 class TNSAIonMatterInteractorTest(unittest.TestCase):
@@ -56,6 +60,38 @@ class TNSAIonMatterInteractorTest(unittest.TestCase):
         self.assertEqual(mysource.backengine(), 0)
         mysource.saveH5()
 
+    def testRunChunked(self):
+        input_file = TestUtilities.generateTestFilePath('0010.sdf')
+        self.params.chunk_size = 1000
+        mysource = TNSAIonMatterInteractor(parameters=self.params,
+                                           input_path=input_file,
+                                           output_path='Data/NeutronData.h5')
+
+        self.assertEqual(mysource.backengine(), 0)
+
+        # Particles are written by the backengine, not kept in memory.
+        self.assertEqual(len(mysource.data), 0)
+        self.assertGreater(mysource.Nn, mysource.parameters.chunk_size)
+        mysource.saveH5()
+
+        SCALAR = api.Mesh_Record_Component.SCALAR
+        series = api.Series(mysource.output_path, api.Access_Type.read_only)
+        neutrons = series.iterations[0].particles["neutrons"]
+        ids = neutrons["id"][SCALAR].load_chunk()
+        velocity = [neutrons["velocity"][axis].load_chunk() for axis in "xyz"]
+        series.flush()
+        del series
+
+        self.assertEqual(len(ids), mysource.Nn)
+        self.assertTrue(np.array_equal(ids, np.arange(1, mysource.Nn + 1)))
+
+        # Each velocity is the velocity of an energy bin along x plus an isotropic 2.45 MeV velocity.
+        vn = math.sqrt(2 * 2.45e6 * e / mp)
+        bin_velocities = np.sqrt(2 * mp * np.asarray(mysource.binedges) * e) / mp
+        residual = np.abs(np.sqrt((velocity[0][:, None] - bin_velocities[None, :])**2
+                                  + velocity[1][:, None]**2
+                                  + velocity[2][:, None]**2) - vn).min(axis=1)
+        self.assertTrue(np.all(residual < 1e-6 * vn))
 
 if __name__ == '__main__':
     unittest.main()
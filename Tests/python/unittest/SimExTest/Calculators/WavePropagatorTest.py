@@ -30,6 +30,9 @@ import unittest
 
 # Import the class to test.
 from SimEx.Calculators.WavePropagator import WavePropagator
+from SimEx.Calculators.WavePropagator import _numberOfLocalProcesses
+from SimEx.Calculators.WavePropagator import _scheduleMaster
+from SimEx.Parameters.WavePropagatorParameters import WavePropagatorParameters
 from TestUtilities import TestUtilities
 
 
@@ -138,6 +141,68 @@ class WavePropagatorTest(unittest.TestCase):
         # Ensure clean-up.
         self.__dirs_to_remove.append(xfel_propagator.output_path)
 
+    def testBackengineMultipleInputFileDynamic(self):
+        """ Test a backengine run with multiple input files and dynamic scheduling. """
+        # Construct the object.
+        xfel_propagator = WavePropagator(
+            parameters=WavePropagatorParameters(scheduling="dynamic"),
+            input_path=TestUtilities.generateTestFilePath('FELsource_out'),
+            output_path='prop_out')
+
+        # Ensure clean-up.
+        self.__dirs_to_remove.append(xfel_propagator.output_path)
+
+        # Call the backengine.
+        status = xfel_propagator.backengine()
+
+        # Check backengine returned sanely.
+        self.assertEqual(status, 0)
+
+        # Check one output file per input file.
+        self.assertEqual(len(os.listdir(xfel_propagator.output_path)),
+                         len(os.listdir(xfel_propagator.input_path)))
+
+
+    def testNumberOfLocalProcesses(self):
+        """ Test that the local pool is sized from the number of cores. """
+        number_of_cores = len(os.sched_getaffinity(0))
+
+        self.assertEqual(_numberOfLocalProcesses("MAX"), number_of_cores)
+        self.assertEqual(_numberOfLocalProcesses(number_of_cores), 1)
+        self.assertEqual(_numberOfLocalProcesses(2 * number_of_cores), 1)
+
+    def testScheduleMaster(self):
+        """ Test that the master rank hands out every job once, in the order of the requests, and does not propagate itself. """
+
+        class ScriptedComm(object):
+            """ Replays requests of two workers, worker 2 is always faster than worker 1. """
+            size = 3
+            def __init__(self):
+                self.requests = [(1, None), (2, None)]
+                self.sent = []
+            def recv(self, source=None):
+                return self.requests.pop(0)
+            def send(self, index, dest=None):
+                self.sent.append((dest, index))
+                if index is not None:
+                    request = (dest, (index, float(dest)))
+                    # The faster worker comes back before the slower one.
+                    if dest == 2:
+                        self.requests.insert(0, request)
+                    else:
+                        self.requests.append(request)
+
+        # Propagating one of these jobs on the master would fail.
+        jobs = [(i, None, None, None) for i in range(5)]
+        comm = ScriptedComm()
+
+        timings = _scheduleMaster(jobs, comm)
+
+        self.assertEqual([index for dest, index in comm.sent if index is not None], list(range(5)))
+        self.assertEqual(sorted(dest for dest, index in comm.sent if index is None), [1, 2])
+        # The fast worker takes all jobs after the one the slow worker got first.
+        self.assertEqual([index for dest, index in comm.sent if dest == 1], [0, None])
+        self.assertEqual(sorted(timings), [(0, 1.0), (1, 2.0), (2, 2.0), (3, 2.0), (4, 2.0)])
 
 if __name__ == '__main__':
     unittest.main()
@@ -22,6 +22,7 @@
 
 import os
 import h5py
+import numpy
 import shutil
 
 # Include needed directories in sys.path.
@@ -29,6 +30,7 @@ import unittest
 
 # Import the class to test.
 from SimEx.Calculators.XCSITPhotonDetector import XCSITPhotonDetector
+from SimEx.Calculators.XCSITPhotonDetector import _photonPixels
 from SimEx.Calculators.SingFELPhotonDiffractor import SingFELPhotonDiffractor
 from SimEx.Parameters.XCSITPhotonDetectorParameters import XCSITPhotonDetectorParameters
 from SimEx.Parameters.PhotonBeamParameters import PhotonBeamParameters
@@ -115,6 +117,24 @@ class XCSITPhotonDetectorTest(unittest.TestCase):
         # Check data shapes
         self.assertEqual(len(detector.getPhotonData()), 10)
 
+    def testPhotonPixels(self):
+        """ Test the positions and directions of photons in hit pixels. """
+        photons = numpy.zeros((4,2), dtype=int)
+        photons[0,1] = 2
+        photons[3,0] = 1
+
+        counts, positions, directions = _photonPixels(photons, 1e-3, 2e-3, 0.1)
+
+        # Pixels in row major order.
+        self.assertEqual(list(counts), [2, 1])
+
+        # Positions relative to the matrix center, y axis pointing up.
+        self.assertTrue(numpy.allclose(positions, [[-1.5e-3, -1e-3, 0.0], [1.5e-3, 1e-3, 0.0]]))
+
+        # Directions from the origin of diffraction.
+        self.assertTrue(numpy.allclose(numpy.linalg.norm(directions, axis=1), 1.0))
+        self.assertTrue(numpy.allclose(directions[0], numpy.array([-1.5e-3, -1e-3, 0.1])/numpy.sqrt(1.5e-3**2 + 1e-3**2 + 0.1**2)))
+
     def testCreateXCSITInteractions(self):
         """ """
 
@@ -221,6 +241,36 @@ class XCSITPhotonDetectorTest(unittest.TestCase):
         # Run the charge simulation.
         self.assertTrue(detector._XCSITPhotonDetector__backengineCP())
 
+    def testBackenginePool(self):
+        """ Test that patterns simulated in worker processes are written to the output file. """
+
+        self.__files_to_remove.append("detector_out_pool.h5")
+
+        parameters = XCSITPhotonDetectorParameters(detector_type="AGIPDSPB",
+                                                   patterns=range(2),
+                                                   number_of_processes=2,
+                                                   )
+        detector = XCSITPhotonDetector(
+                parameters=parameters,
+                input_path=TestUtilities.generateTestFilePath("diffr/diffr_out_0000001.h5"),
+                output_path="detector_out_pool.h5",
+                )
+
+        detector._readH5()
+        detector.backengine()
+        detector.saveH5()
+
+        # No containers are kept in memory.
+        self.assertIsNone(detector.getPhotonData())
+        self.assertIsNone(detector.getChargeData())
+
+        with h5py.File("detector_out_pool.h5", "r") as h5:
+            self.assertEqual(len(h5["data"]), 2)
+            for pid in h5["data"]:
+                self.assertEqual(h5["data/%s/data" % (pid)].ndim, 2)
+            self.assertIn("detectorDist", h5["params/geom"])
+            self.assertIn("photonEnergy", h5["params/beam"])
+
     def testMinimalExample(self):
         """ Check that beam parameters can be taken from a given propagation output file."""
 
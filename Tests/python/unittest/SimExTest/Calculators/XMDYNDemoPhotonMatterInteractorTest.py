@@ -29,6 +29,8 @@ import unittest
 # Import the class to test.
 from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import XMDYNDemoPhotonMatterInteractor
 from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import PMIDemo
+from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import s2e_gen_randrot_quat
+from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import s2e_rand_orient
 from TestUtilities import TestUtilities
 
 class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
@@ -77,6 +79,15 @@ class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
         self.assertIsInstance(interactor, XMDYNDemoPhotonMatterInteractor)
 
 
+    def testCacheKeySample(self):
+        """ Testing that the cache key depends on the sample. """
+        keys = [XMDYNDemoPhotonMatterInteractor(input_path=TestUtilities.generateTestFilePath('prop_out_0000001.h5'),
+                                                sample_path=TestUtilities.generateTestFilePath(sample),
+                                                ).cacheKey()
+                for sample in ['sample.h5', '2nip.pdb']]
+
+        self.assertNotEqual(keys[0], keys[1])
+
     def testConstructionNoSample(self):
         """ Test construction w/o sample path raises. """
         # Setup pmi parameters.
@@ -144,6 +155,33 @@ class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
         self.assertIn( 'pmi_out_0000001.h5' , os.listdir( test_interactor.output_path ) )
         self.assertIn( 'pmi_out_0000002.h5' , os.listdir( test_interactor.output_path ) )
 
+    def testBackengineParallel(self):
+        """ Check that the backengine distributes pulses over several processes. """
+
+        # Clean up.
+        self.__dirs_to_remove.append('pmi')
+
+        # Get test instance.
+        pmi_parameters = {'number_of_trajectories' : 1,
+                          'number_of_steps'        : 10,
+                          'number_of_processes'    : 2,
+                         }
+
+        test_interactor = XMDYNDemoPhotonMatterInteractor(parameters=pmi_parameters,
+                                                          input_path=TestUtilities.generateTestFilePath('prop_out'),
+                                                          output_path='pmi',
+                                                          sample_path = TestUtilities.generateTestFilePath('sample.h5') )
+
+        # Call backengine
+        status = test_interactor.backengine()
+
+        # Check that the backengine returned zero.
+        self.assertEqual(status, 0)
+
+        # Check we have generated the expected output.
+        self.assertIn( 'pmi_out_0000001.h5' , os.listdir( test_interactor.output_path ) )
+        self.assertIn( 'pmi_out_0000002.h5' , os.listdir( test_interactor.output_path ) )
+
     def testBackengine(self):
         """ Check that the backengine method works correctly. """
 
@@ -312,6 +350,32 @@ class XMDYNDemoPhotonMatterInteractorTest(unittest.TestCase):
             self.assertNotEqual( numpy.linalg.norm(angle), 0.)
 
 
+    def testRotationRandomSeeded(self):
+        """ Check that a serial run with random rotation is reproducible from the caller's seed."""
+
+        # Clean up.
+        self.__dirs_to_remove.append('pmi')
+
+        pmi_parameters = {'number_of_trajectories' : 1,
+                          'number_of_steps'        : 100,
+                          'random_rotation'        : True,
+                         }
+
+        angles = []
+        for run in range(2):
+            test_interactor = XMDYNDemoPhotonMatterInteractor(parameters=pmi_parameters,
+                                                              input_path=self.input_h5,
+                                                              output_path='pmi',
+                                                              sample_path = TestUtilities.generateTestFilePath('sample.h5') )
+            numpy.random.seed(42)
+            test_interactor.backengine()
+
+            with h5py.File( os.path.join(test_interactor.output_path, 'pmi_out_0000001.h5'), 'r') as h5:
+                angles.append(h5['data/angle'][()])
+            shutil.rmtree('pmi')
+
+        self.assertTrue( numpy.array_equal(angles[0], angles[1]) )
+
 class PMIDemoTest(unittest.TestCase):
     """
     Test class for the PMIDemo class.
@@ -352,6 +416,22 @@ class PMIDemoTest(unittest.TestCase):
 
         self.assertIsInstance(snapshot, dict)
 
+    def test_rand_orient(self):
+        """ Test that the sample rotation applies the rotation matrix to every atom. """
+        quaternion = numpy.zeros(4)
+        rotmat = numpy.zeros((9,))
+        s2e_gen_randrot_quat(quaternion, rotmat)
+
+        r0 = numpy.random.random((10,3))
+        r = r0.copy()
+        s2e_rand_orient(r, rotmat)
+
+        for ri, r0i in zip(r, r0):
+            self.assertTrue(numpy.allclose(ri, numpy.dot(rotmat.reshape((3,3)), r0i)))
+
+        # Rotations preserve distances.
+        self.assertTrue(numpy.allclose(numpy.linalg.norm(r, axis=1), numpy.linalg.norm(r0, axis=1)))
+
 if __name__ == '__main__':
     unittest.main()
 
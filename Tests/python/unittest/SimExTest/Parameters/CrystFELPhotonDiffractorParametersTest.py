@@ -280,6 +280,23 @@ class CrystFELPhotonDiffractorParametersTest(unittest.TestCase):
         parameters.gpus_per_task = 1
         self.assertTrue(parameters.gpus_per_task == 1)
 
+    def testNumberOfShards(self):
+        """ Check the number_of_shards parameter handling."""
+
+        # Check default.
+        parameters = CrystFELPhotonDiffractorParameters(sample=self.__sample,
+        number_of_diffraction_patterns=10,
+        )
+        self.assertEqual(parameters.number_of_shards, 1)
+
+        # Set and check new value.
+        parameters.number_of_shards = 4
+        self.assertEqual(parameters.number_of_shards, 4)
+
+        # Check exceptions.
+        self.assertRaises(TypeError, setattr, parameters, "number_of_shards", 2.0)
+        self.assertRaises(ValueError, setattr, parameters, "number_of_shards", 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -80,6 +80,15 @@ class DMPhasingParametersTest(unittest.TestCase):
         self.assertEqual( parameters.averaging_start, 15 )
         self.assertEqual( parameters.leash, 0.2)
         self.assertEqual( parameters.number_of_shrink_cycles, 10 )
+        self.assertEqual( parameters.number_of_processes, 1 )
+
+    def testNumberOfProcesses(self):
+        """ Check the number of concurrent trials is a positive integer. """
+        parameters = DMPhasingParameters(number_of_processes=4)
+        self.assertEqual( parameters.number_of_processes, 4 )
+
+        self.assertRaises( ValueError, DMPhasingParameters, number_of_processes=0 )
+        self.assertRaises( TypeError, DMPhasingParameters, number_of_processes=2.0 )
 
     def testLegacyDictionary(self):
         """ Check parameter object can be initialized via a old-style dictionary. """
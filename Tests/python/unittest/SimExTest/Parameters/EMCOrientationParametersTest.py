@@ -79,6 +79,15 @@ class EMCOrientationParametersTest(unittest.TestCase):
         self.assertEqual( parameters.max_number_of_quaternions, 2)
         self.assertEqual( parameters.min_error, 1.e-5 )
         self.assertEqual( parameters.max_number_of_iterations, 100 )
+        self.assertEqual( parameters.number_of_processes, 1 )
+
+    def testNumberOfProcesses(self):
+        """ Check the number of processes parameter. """
+        parameters = EMCOrientationParameters(number_of_processes=4)
+        self.assertEqual( parameters.number_of_processes, 4 )
+
+        self.assertRaises( ValueError, EMCOrientationParameters, number_of_processes=0 )
+        self.assertRaises( TypeError, EMCOrientationParameters, number_of_processes=2.0 )
 
     def testLegacyDictionary(self):
         """ Check parameter object can be initialized via a old-style dictionary. """
@@ -40,6 +40,16 @@ class IonMatterInteractorParametersTest(unittest.TestCase):
         self.assertEqual(parameters.ibeam_radius, 1.5e-5)
         self.assertEqual(parameters.target_density, 6.e28)
 
+    def testChunkSize(self):
+        parameters = IonMatterInteractorParameters()
+        self.assertIsNone(parameters.chunk_size)
+
+        parameters.chunk_size = 100000
+        self.assertEqual(parameters.chunk_size, 100000)
+
+        self.assertRaises(TypeError, setattr, parameters, "chunk_size", 1.e5)
+        self.assertRaises(ValueError, setattr, parameters, "chunk_size", 0)
+
 
 if __name__ == '__main__':
     unittest.main()
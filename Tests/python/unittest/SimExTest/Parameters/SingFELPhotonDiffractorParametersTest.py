@@ -104,6 +104,9 @@ class SingFELPhotonDiffractorParametersTest(unittest.TestCase):
         self.assertEqual(parameters.pmi_stop_ID, 1)
         self.assertEqual(parameters.beam_parameters, None)
         self.assertEqual(parameters.detector_geometry, None)
+        self.assertFalse(parameters.consolidate_output)
+        self.assertIsNone(parameters.compression)
+        self.assertEqual(parameters.orientation_batch_size, 1)
 
     def testConstructionWithGeometry(self):
         """ Testing the construction of the class with a DetectorGeometry instance. """
@@ -344,6 +347,12 @@ class SingFELPhotonDiffractorParametersTest(unittest.TestCase):
 
         parameters.detector_geometry = self.detector_geometry
 
+        # compression not a known filter.
+        self.assertRaises(ValueError, setattr, parameters, 'compression', 'zip')
+
+        # orientation_batch_size not positive.
+        self.assertRaises(ValueError, setattr, parameters, 'orientation_batch_size', 0)
+
     def testLegacyDictionary(self):
         """ Check parameter object can be initialized via a old-style dictionary. """
         parameters_dict = {'uniform_rotation'               : False,
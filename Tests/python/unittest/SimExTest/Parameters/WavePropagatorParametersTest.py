@@ -85,6 +85,7 @@ class WavePropagatorParametersTest(unittest.TestCase):
 
         # Check all parameters are set to default values.
         self.assertFalse( parameters.use_opmd )
+        self.assertEqual( parameters.scheduling, "static" )
 
         # Check default inherited parameters.
         self.assertEqual( parameters.cpus_per_task, "MAX")
@@ -104,6 +105,14 @@ class WavePropagatorParametersTest(unittest.TestCase):
         # Check all parameters are set to default values.
         self.assertTrue( parameters.use_opmd )
 
+    def testScheduling(self):
+        """ Check the scheduling parameter. """
+        parameters = WavePropagatorParameters(scheduling="dynamic")
+        self.assertEqual( parameters.scheduling, "dynamic" )
+
+        self.assertRaises( ValueError, WavePropagatorParameters, scheduling="round-robin" )
+        self.assertRaises( TypeError, WavePropagatorParameters, scheduling=1 )
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -78,6 +78,10 @@ class XCSITPhotonDetectorParametersTest(unittest.TestCase):
         self.assertEqual( detector_parameters.plasma_search_flag, "BLANK")
         self.assertEqual( detector_parameters.plasma_simulation_flag, "BLANKPLASMA")
         self.assertEqual( detector_parameters.point_simulation_method, "FULL")
+        self.assertEqual( detector_parameters.number_of_processes, 1)
+
+        # Number of processes must be positive.
+        self.assertRaises( ValueError, XCSITPhotonDetectorParameters, detector_type='AGIPDSPB', number_of_processes=0)
 
     def testSettersAndQueries(self):
         """ Testing the default construction of the class using a dictionary. """
@@ -20,6 +20,7 @@
 #                                                                        #
 ##########################################################################
 
+import copy
 import h5py
 import os, shutil
 import unittest
@@ -31,6 +32,7 @@ from SimEx.Calculators.WavePropagator import WavePropagator as XFELPhotonPropaga
 from SimEx.Calculators.XFELPhotonSource import XFELPhotonSource
 from SimEx.Calculators.XMDYNDemoPhotonMatterInteractor import XMDYNDemoPhotonMatterInteractor
 from SimEx.PhotonExperimentSimulation.PhotonExperimentSimulation import PhotonExperimentSimulation
+from SimEx.PhotonExperimentSimulation.PhotonExperimentSimulation import _collectPulseOutput
 from SimEx.Parameters.SingFELPhotonDiffractorParameters import SingFELPhotonDiffractorParameters
 
 from TestUtilities import TestUtilities
@@ -992,6 +994,157 @@ class PhotonExperimentSimulationTest(unittest.TestCase):
                                              output_path="diffr_out.h5")
         diffractor.backengine()
 
+    def testSimS2EWorkflowPipelined(self):
+        """ Testing that a pipelined workflow yields as many, uniquely numbered, patterns as a serial one. """
+
+        # Setup directories.
+        working_directory = 'SPI'
+        self.__dirs_to_remove.append(working_directory)
+
+        source_dir = os.path.join(working_directory, 'FELsource')
+        prop_dir = os.path.join(working_directory, 'prop')
+        pmi_dir = os.path.join(working_directory, 'pmi')
+        diffr_dir = os.path.join(working_directory, 'diffr')
+        recon_dir = os.path.join(working_directory, 'recon')
+
+        for directory in [working_directory, source_dir, prop_dir, pmi_dir, diffr_dir, recon_dir]:
+            os.mkdir(directory)
+
+        photon_source = XFELPhotonSource(parameters=None,
+                                         input_path=TestUtilities.generateTestFilePath('FELsource_out'),
+                                         output_path=source_dir)
+
+        photon_propagator = XFELPhotonPropagator(parameters=None,
+                                                 input_path=source_dir,
+                                                 output_path=prop_dir)
+
+        photon_interactor = XMDYNDemoPhotonMatterInteractor(
+            parameters=None,
+            input_path=prop_dir,
+            output_path=pmi_dir,
+            sample_path=self.__sample_path)
+
+        # Two patterns in total.
+        photon_diffractor = SingFELPhotonDiffractor(
+            parameters=self.diffractorParam_1,
+            input_path=pmi_dir,
+            output_path=diffr_dir)
+
+        reconstructor = S2EReconstruction(parameters={
+            'EMC_Parameters': {
+                'initial_number_of_quaternions': 1,
+                'max_number_of_quaternions': 9,
+                'max_number_of_iterations': 3,
+                'min_error': 1.0e-8,
+                'beamstop': True,
+                'detailed_output': False
+            },
+            'DM_Parameters': {
+                'number_of_trials': 5,
+                'number_of_iterations': 2,
+                'averaging_start': 15,
+                'leash': 0.2,
+                'number_of_shrink_cycles': 2,
+            }
+        },
+                                          input_path=diffr_dir,
+                                          output_path=recon_dir)
+
+        pxs = PhotonExperimentSimulation(
+            photon_source=photon_source,
+            photon_propagator=photon_propagator,
+            photon_interactor=photon_interactor,
+            photon_diffractor=photon_diffractor,
+            photon_analyzer=reconstructor,
+        )
+
+        pxs.run(pipelined=True)
+
+        # One pmi file per pulse, no per-pulse work directories left.
+        number_of_pulses = len(os.listdir(prop_dir))
+        self.assertEqual(sorted(os.listdir(pmi_dir)),
+                         ['pmi_out_%07d.h5' % (i + 1) for i in range(number_of_pulses)])
+
+        # The patterns are shared by the pulses.
+        with h5py.File(diffr_dir + '.h5', 'r') as h5:
+            self.assertEqual(sorted(h5['data'].keys()), ['0000001', '0000002'])
+            for key in h5['data']:
+                self.assertIn('data', h5['data'][key])
+
+    def testPipelinedConsolidatedOutput(self):
+        """ Test that a pipelined run with consolidated diffractor output is rejected before any stage runs. """
+        photon_source = XFELPhotonSource(parameters=None,
+                                         input_path=TestUtilities.generateTestFilePath('FELsource_out'),
+                                         output_path='FELsource_out')
+        photon_propagator = XFELPhotonPropagator(parameters=None,
+                                                 input_path='FELsource_out',
+                                                 output_path='prop_out')
+        photon_interactor = XMDYNDemoPhotonMatterInteractor(
+            parameters=None,
+            input_path='prop_out',
+            output_path='pmi_out',
+            sample_path=self.__sample_path)
+
+        diffraction_parameters = copy.deepcopy(self.diffractorParam_1)
+        diffraction_parameters.consolidate_output = True
+        photon_diffractor = SingFELPhotonDiffractor(
+            parameters=diffraction_parameters,
+            input_path='pmi_out',
+            output_path='diffr_out')
+
+        photon_analyzer = S2EReconstruction(parameters=None,
+                                            input_path='diffr_out',
+                                            output_path='analyzer_out.h5')
+
+        pxs = PhotonExperimentSimulation(
+            photon_source=photon_source,
+            photon_propagator=photon_propagator,
+            photon_interactor=photon_interactor,
+            photon_diffractor=photon_diffractor,
+            photon_analyzer=photon_analyzer,
+        )
+
+        self.assertRaises(RuntimeError, pxs.run, pipelined=True)
+
+        # Nothing ran.
+        self.assertFalse(os.path.exists('FELsource_out'))
+
+    def testCollectPulseOutput(self):
+        """ Test that per-pulse outputs of a pipelined run are collected and renumbered. """
+
+        class PulseCalculator(object):
+            """ Stands in for the copy of a calculator that ran one pulse. """
+            def __init__(self, output_path):
+                self.output_path = output_path
+
+            def saveH5(self):
+                pass
+
+        diffr_dir = 'diffr'
+        self.__dirs_to_remove.append(diffr_dir)
+        os.mkdir(diffr_dir)
+
+        pulse_calculators = []
+        for i in range(3):
+            pulse_output = os.path.join(diffr_dir, '.pulse_%07d' % (i + 1), 'diffr')
+            os.makedirs(pulse_output)
+            with h5py.File(os.path.join(pulse_output, 'diffr_out_0000001.h5'), 'w') as h5:
+                h5.create_group('data/0000001')
+                h5.create_group('data/0000002')
+            pulse_calculators.append(PulseCalculator(pulse_output))
+
+        _collectPulseOutput(pulse_calculators, diffr_dir)
+
+        self.assertEqual(sorted(os.listdir(diffr_dir)),
+                         ['diffr_out_0000001.h5', 'diffr_out_0000002.h5', 'diffr_out_0000003.h5'])
+
+        # Pattern ids are unique across pulses.
+        keys = []
+        for f in sorted(os.listdir(diffr_dir)):
+            with h5py.File(os.path.join(diffr_dir, f), 'r') as h5:
+                keys += list(h5['data'].keys())
+        self.assertEqual(sorted(keys), ['%07d' % (i + 1) for i in range(6)])
+
 
 if __name__ == '__main__':
     unittest.main()
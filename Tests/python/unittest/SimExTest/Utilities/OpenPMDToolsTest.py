@@ -20,6 +20,7 @@
 #                                                                        #
 ##########################################################################
 
+import h5py
 import numpy
 import os
 import unittest
@@ -28,7 +29,7 @@ import openpmd_api as opmd
 import wpg
 from SimEx.Utilities import checkOpenPMD_h5 as opmd_validator
 from SimEx.Utilities.hydro_txt_to_opmd import convertTxtToOPMD
-from SimEx.Utilities.wpg_to_opmd import convertToOPMD, convertToOPMDLegacy
+from SimEx.Utilities.wpg_to_opmd import convertToOPMD, convertToOPMDLegacy, convertDirectory
 from TestUtilities.TestUtilities import generateTestFilePath
 
 class OpenPMDToolsTest(unittest.TestCase):
@@ -139,6 +140,42 @@ class OpenPMDToolsTest(unittest.TestCase):
         # Check the beamline serialization
         self.assertIsInstance(series.get_attribute("beamline"), str)
 
+    def testWpgToOPMDConverterSlabs(self):
+        """ Test that reading the wpg fields in slabs of time slices preserves the data."""
+
+        # Get sample file.
+        h5_input = generateTestFilePath('prop_out/prop_out_0000011.h5')
+
+        # Convert reading three time slices at once.
+        convertToOPMD(h5_input, slab_size=3)
+
+        opmd_h5_file = h5_input.replace(".h5", ".opmd.h5")
+        self.__files_to_remove.append(opmd_h5_file)
+
+        with h5py.File(h5_input, 'r') as h5:
+            number_of_time_steps = h5['params/Mesh/nSlices'][()]
+            ever = h5['data/arrEver'][:, :, number_of_time_steps-1, 0]
+
+        # Read back the vertical field of the last time slice.
+        series = opmd.Series(opmd_h5_file, opmd.Access_Type.read_only)
+        E_ver_real = series.iterations[number_of_time_steps].meshes["E_real"]["y"].load_chunk()
+        series.flush()
+
+        self.assertAlmostEqual(numpy.linalg.norm(E_ver_real - ever), 0.0)
+
+    def testWpgToOPMDDirectory(self):
+        """ Test the parallel conversion of a directory of wpg output files."""
+
+        # Get sample directory.
+        input_path = generateTestFilePath('prop_out')
+
+        converted = convertDirectory(input_path, number_of_processes=2)
+        self.__files_to_remove += [f.replace(".h5", ".opmd.h5") for f in converted]
+
+        self.assertGreater(len(converted), 0)
+        for f in converted:
+            self.assertTrue( os.path.isfile( f.replace(".h5", ".opmd.h5") ) )
+
     def testLoadOPMDWavefront(self):
         """ Test if loading a wavefront from openpmd-hdf into a WPG structure works."""
 
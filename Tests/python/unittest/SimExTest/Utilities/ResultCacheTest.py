@@ -0,0 +1,143 @@
+##########################################################################
+#                                                                        #
+# Copyright (C) 2015 Carsten Fortmann-Grote                              #
+# Contact: Carsten Fortmann-Grote <carsten.grote@xfel.eu>                #
+#                                                                        #
+# This file is part of simex_platform.                                   #
+# simex_platform is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by   #
+# the Free Software Foundation, either version 3 of the License, or      #
+# (at your option) any later version.                                    #
+#                                                                        #
+# simex_platform is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+# GNU General Public License for more details.                           #
+#                                                                        #
+# You should have received a copy of the GNU General Public License      #
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+# Include needed directories in sys.path.                                #
+#                                                                        #
+##########################################################################
+
+""" Test module for the ResultCache. """
+import os
+import shutil
+import unittest
+
+from SimEx.Utilities.ResultCache import ResultCache, hashContent, hashObject, referencedFiles
+
+
+class ResultCacheTest(unittest.TestCase):
+    """ Test class for the ResultCache class. """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Setting up the test class. """
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Tearing down the test class. """
+
+    def setUp(self):
+        """ Setting up a test. """
+        self.__files_to_remove = []
+        self.__dirs_to_remove = ['simex_cache']
+
+    def tearDown(self):
+        """ Tearing down a test. """
+        for f in self.__files_to_remove:
+            if os.path.isfile(f):
+                os.remove(f)
+        for d in self.__dirs_to_remove:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+
+    def testDefaultConstruction(self):
+        """ Testing the default construction of the class. """
+        cache = ResultCache()
+
+        self.assertIsInstance(cache, ResultCache)
+        self.assertTrue(os.path.isdir(cache.cache_path))
+        self.assertIsNone(cache.max_size)
+
+    def testStoreFetch(self):
+        """ Testing that a stored output can be fetched again. """
+        cache = ResultCache()
+
+        self.__files_to_remove.append('out.txt')
+        with open('out.txt', 'w') as fh:
+            fh.write('result')
+
+        self.assertFalse(cache.fetch('key', 'out.txt'))
+        cache.store('key', 'out.txt')
+
+        os.remove('out.txt')
+        self.assertTrue(cache.fetch('key', 'out.txt'))
+        with open('out.txt', 'r') as fh:
+            self.assertEqual(fh.read(), 'result')
+
+    def testEviction(self):
+        """ Testing that the least recently used entries are evicted first. """
+        cache = ResultCache(max_size=10)
+
+        self.__files_to_remove.append('out.txt')
+        for key in ['a', 'b']:
+            with open('out.txt', 'w') as fh:
+                fh.write('x' * 6)
+            cache.store(key, 'out.txt')
+
+        self.assertFalse(cache.fetch('a', 'out.txt'))
+        self.assertTrue(cache.fetch('b', 'out.txt'))
+
+    def testHashObject(self):
+        """ Testing that parameter hashes are independent of dict ordering. """
+        self.assertEqual(hashObject({'a': 1, 'b': [1.0, 2.0]}),
+                         hashObject({'b': [1.0, 2.0], 'a': 1}))
+        self.assertNotEqual(hashObject({'a': 1}), hashObject({'a': 2}))
+
+    def testStoreFetchMultipleOutputs(self):
+        """ Testing that all outputs stored together are restored together. """
+        cache = ResultCache()
+
+        self.__files_to_remove += ['out', 'out.h5']
+        for f in ['out', 'out.h5']:
+            with open(f, 'w') as fh:
+                fh.write(f)
+
+        cache.store('key', ['out', 'out.h5'])
+
+        for f in ['out', 'out.h5']:
+            os.remove(f)
+        self.assertTrue(cache.fetch('key', ['out', 'out.h5']))
+        for f in ['out', 'out.h5']:
+            with open(f, 'r') as fh:
+                self.assertEqual(fh.read(), f)
+
+    def testHashObjectUnstable(self):
+        """ Testing that objects without a stable representation are rejected. """
+        with self.assertRaises(TypeError):
+            hashObject({'callback': lambda x: x})
+
+    def testReferencedFiles(self):
+        """ Testing that files named in nested parameters are found. """
+        self.__files_to_remove.append('in.txt')
+        with open('in.txt', 'w') as fh:
+            fh.write('1')
+
+        self.assertEqual(referencedFiles({'a': [1, 'in.txt'], 'b': 'not_a_file'}), ['in.txt'])
+
+    def testHashContent(self):
+        """ Testing that content hashes change with the file content. """
+        self.__files_to_remove.append('in.txt')
+        with open('in.txt', 'w') as fh:
+            fh.write('1')
+        first = hashContent('in.txt')
+        with open('in.txt', 'w') as fh:
+            fh.write('2')
+
+        self.assertNotEqual(first, hashContent('in.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()
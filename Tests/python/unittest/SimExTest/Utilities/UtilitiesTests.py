@@ -26,6 +26,7 @@ from .EntityChecksTest import EntityChecksTest
 from .IOUtilitiesTest import IOUtilitiesTest
 from .ParallelUtilitiesTest import ParallelUtilitiesTest
 from .OpenPMDToolsTest import OpenPMDToolsTest
+from .ResultCacheTest import ResultCacheTest
 
 # Setup the suite.
 def suite():
@@ -34,6 +35,7 @@ def suite():
              unittest.makeSuite(IOUtilitiesTest,       'test'),
              unittest.makeSuite(ParallelUtilitiesTest,       'test'),
              unittest.makeSuite(OpenPMDToolsTest,       'test'),
+             unittest.makeSuite(ResultCacheTest,       'test'),
              )
 
     return unittest.TestSuite(suites)